@@ -1,13 +1,54 @@
 import os
+import pickle
+import sqlite3
+import tempfile
 import unittest
-from unittest.mock import MagicMock, AsyncMock
+from unittest.mock import MagicMock, AsyncMock, call
 from unittest.mock import patch
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+import asyncio
+import collections
+import datetime
+import json
+import socket
+import threading
+import time
+import zlib
+import httpx
+import pytz
 import ticketpy
-from bot import (ARTIST_INFO, ARTIST_SEARCH_RESULTS, START_ROUTES, generate_buttons, main, start, start_over, buscar_artista, artist_button,
+from ticketpy.model import Event, Attraction, Page
+from callbacks import CallbackTokens, CallbackCodec, truncate_utf8
+from persistence import SQLitePersistence
+from rate_limiter import TelegramRateLimiter, PRIORITY_BULK
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import ConversationHandler, PicklePersistence
+from ticketmaster import TicketmasterClient, ResponseCache, ApiException
+from event_diff import last_change
+from search_index import SearchIndex
+from resilience import CircuitBreaker, CircuitOpenError
+import benchmark
+import bot
+from metrics import REGISTRY, Registry, SamplingProfiler, start_metrics_server
+from fake_servers import FakeTelegram, FakeTicketmaster
+from update_processor import OrderedUpdateProcessor, ShardedUpdateProcessor, shard_for
+from bot import (renderizar_evento, _renderizar_evento, LOGO, enviar_imagen, notificar_nuevos_eventos, detectar_nuevos_eventos, registrar_eventos, programar_notificaciones, construir_aplicacion, ARTIST_INFO, EVENT_INFO, NEXT_PAGE, MAX_BUTTONS, buscar_pagina, siguiente_pagina, ARTIST_SEARCH_RESULTS, callback_codec, START_ROUTES, generate_buttons, main, start, start_over, buscar_artista, artist_button,
                          buscar_evento, event_button, mostrar_info_evento,
                          artistas_siguiendo, mostrar_info_artista,
-                         seguir_dejar_seguir_artista, showCreators)
+                         seguir_dejar_seguir_artista, showCreators, consulta_inline, respuestas_inline,
+                         Perezoso, crear_cliente_ticketmaster, configurar_zona, configurar_hora, preferencia_notificacion,
+                         usuarios_pendientes, repartir_franja, cargar_usuarios, enviar_eventos_nuevos, HORA_NOTIFICACION, ZONA_NOTIFICACION, MINUTOS_FRANJA,
+                         REPARTO_NOTIFICACION)
+
+def paginas(*pages):
+    """Simula tm_client.search_pages devolviendo las páginas indicadas."""
+    async def search_pages(*args, **kwargs):
+        for number, items in enumerate(pages):
+            page = Page(number, len(items), None, len(pages))
+            page += items
+            yield page
+    return MagicMock(side_effect=search_pages)
+
 
 class TestIntegration(unittest.IsolatedAsyncioTestCase):
     """
@@ -20,6 +61,7 @@ class TestIntegration(unittest.IsolatedAsyncioTestCase):
         update_mock = MagicMock()
         context_mock = MagicMock()
         context_mock.bot = AsyncMock()
+        context_mock.bot_data = {}
         
         result = await start(update_mock, context_mock)
 
@@ -42,27 +84,47 @@ class TestIntegration(unittest.IsolatedAsyncioTestCase):
             for button in row:
                 self.assertIsInstance(button, InlineKeyboardButton)
 
-    """
-    Prueba la carga de variables de entorno y la inicialización del ApiClient.
+        # The second time the logo is sent by its Telegram file_id instead of being uploaded again
+        file_id = context_mock.bot.send_photo.return_value.photo[-1].file_id
+        self.assertEqual(context_mock.bot_data['file_ids'], {'Resources/Bot-beatTracker-Logo.jpg': file_id})
+        await start(update_mock, context_mock)
+        self.assertEqual(context_mock.bot.send_photo.call_args.kwargs['photo'], file_id)
 
-    Esta prueba verifica que las variables de entorno 'API_TICKETMASTER_TOKEN' y 'API_TELEGRAM_TOKEN'
-    se cargan correctamente y que el ApiClient se inicializa con el token correcto.
-    """
-    class TestEnvironmentVariables(unittest.TestCase):
-        @patch.object(os, 'getenv')
-        @patch.object(ticketpy, 'ApiClient')
-        def test_environment_variables(self, MockApiClient, mock_getenv):
-            mock_getenv.side_effect = lambda x: 'test_token' if x in ['API_TICKETMASTER_TOKEN', 'API_TELEGRAM_TOKEN'] else None
-            from bot import ticketmaster_token, telegram_token, tm_client
+    async def test_enviar_imagen_file_id_rechazado(self):
+        """
+        Prueba que si Telegram rechaza el file_id guardado del logo, la imagen se vuelve a subir.
+        """
+        context_mock = MagicMock()
+        context_mock.bot = AsyncMock()
+        context_mock.bot_data = {'file_ids': {LOGO: 'caducado'}}
+        context_mock.bot.send_photo.side_effect = [BadRequest('Wrong file identifier'), MagicMock()]
 
-            mock_getenv.assert_any_call('API_TICKETMASTER_TOKEN')
-            mock_getenv.assert_any_call('API_TELEGRAM_TOKEN')
+        await enviar_imagen(context_mock, 1, LOGO)
 
-            MockApiClient.assert_called_once_with('test_token')
+        self.assertEqual(context_mock.bot.send_photo.await_count, 2)
+        self.assertEqual(context_mock.bot.send_photo.call_args.kwargs['photo'].name, LOGO)
+        self.assertNotEqual(context_mock.bot_data['file_ids'][LOGO], 'caducado')
+
+    def test_configuracion_diferida(self):
+        """
+        Prueba la carga diferida de la configuración y del cliente de Ticketmaster.
+
+        Esta prueba verifica que el cliente no se crea hasta que se usa, que entonces toma el token
+        del entorno, que los tokens se leen al pedirlos (ValueError si faltan) y que un intérprete nuevo
+        puede importar el bot y construir la aplicación sin ningún token.
+        """
+        cliente = Perezoso(crear_cliente_ticketmaster)
+        with patch.dict(os.environ, {'API_TICKETMASTER_TOKEN': 'test_token', 'API_TELEGRAM_TOKEN': 'test_token'}):
+            self.assertFalse(cliente.creado)
+            self.assertEqual(cliente.api_key, 'test_token')
+            self.assertTrue(cliente.creado)
+            self.assertEqual(bot.telegram_token, 'test_token')
+            os.environ.pop('API_TELEGRAM_TOKEN')
+            with self.assertRaises(ValueError):
+                bot.telegram_token
+
+        self.assertEqual(benchmark.measure_cold_start(1)['calls'], 1)
 
-            self.assertEqual(ticketmaster_token, 'test_token')
-            self.assertEqual(telegram_token, 'test_token')
-    
     """
     Prueba la función buscar_artista.
 
@@ -86,7 +148,7 @@ class TestIntegration(unittest.IsolatedAsyncioTestCase):
         Prueba la función artist_button.
 
         Esta prueba verifica que la función artist_button envía un mensaje con el texto correcto,
-        llama a tm_client.attractions.find con el texto del mensaje de actualización como argumento,
+        llama a tm_client.search_pages sobre 'attractions' con el texto del mensaje de actualización como argumento,
         y devuelve el valor correcto de generate_buttons.
         """
         update_mock = MagicMock()
@@ -96,13 +158,13 @@ class TestIntegration(unittest.IsolatedAsyncioTestCase):
         mock_attraction = MagicMock()
         mock_attraction.id = 'test_id'
 
-        tm_client_mock.attractions.find.return_value.all.return_value = [mock_attraction]
+        tm_client_mock.search_pages = paginas([mock_attraction])
 
         result = await artist_button(update_mock, context_mock)
 
         context_mock.bot.send_message.assert_any_call(chat_id=update_mock.effective_chat.id, text="Buscando al artista, por favor espera...")
 
-        tm_client_mock.attractions.find.assert_called_once_with(keyword=update_mock.message.text, source=['ticketmaster', 'frontgate', 'tmr'])
+        tm_client_mock.search_pages.assert_called_once_with('attractions', start_page=0, keyword=update_mock.message.text, source=['ticketmaster', 'frontgate', 'tmr'])
 
         self.assertEqual(result, await generate_buttons([mock_attraction], ARTIST_INFO, update_mock, context_mock, "artista", include_follow=True))
 
@@ -135,6 +197,1107 @@ class TestIntegration(unittest.IsolatedAsyncioTestCase):
 
         # Check that the artist was unfollowed
         self.assertEqual(context_mock.user_data['followed_artists'], {})        
-        
+
+    async def test_ticketmaster_client_search(self):
+        """
+        Prueba el cliente asíncrono de Ticketmaster.
+
+        Esta prueba verifica que TicketmasterClient recorre todas las páginas del resultado,
+        traduce los parámetros al formato de la API, devuelve objetos de ticketpy y que con pace
+        cada página espera su turno.
+        """
+        requests_seen = []
+
+        def handler(request):
+            requests_seen.append(request.url.params)
+            page = int(request.url.params['page'])
+            return httpx.Response(200, json={
+                'page': {'number': page, 'size': 1, 'totalPages': 2, 'totalElements': 2},
+                '_embedded': {'events': [{'id': f'ev{page}', 'name': f'Evento {page}'}]},
+            })
+
+        client = TicketmasterClient('test_token', transport=httpx.MockTransport(handler))
+        events = await client.search('events', attraction_id='K8', source=['ticketmaster'])
+        pace = MagicMock()
+        pace.acquire = AsyncMock()
+        await client.search('events', priority=PRIORITY_BULK, pace=pace, attraction_id='K9')
+        await client.aclose()
+
+        self.assertEqual(pace.acquire.await_args_list, [call(PRIORITY_BULK)] * 2)
+
+        self.assertEqual([event.id for event in events], ['ev0', 'ev1'])
+        self.assertIsInstance(events[0], ticketpy.model.Event)
+        self.assertEqual(requests_seen[0]['attractionId'], 'K8')
+        self.assertEqual(requests_seen[0]['apikey'], 'test_token')
+
+    async def test_ticketmaster_client_error(self):
+        """
+        Prueba que los errores HTTP del cliente asíncrono se elevan como ApiException.
+        """
+        client = TicketmasterClient('test_token', transport=httpx.MockTransport(lambda request: httpx.Response(500, text='error')))
+        with self.assertRaises(ApiException):
+            await client.search('attractions', keyword='test')
+        await client.aclose()
+
+    async def test_indice_busqueda(self):
+        """
+        Prueba el índice local de búsqueda y su uso como respaldo de la API.
+
+        Esta prueba verifica que el índice encuentra nombres por prefijo, por palabra y con erratas,
+        sin distinguir mayúsculas ni acentos, sin esperar a las escrituras, que convierte los índices del
+        formato anterior y que el cliente responde desde él cuando la API falla o tarda.
+        """
+        caida = False
+
+        async def handler(request):
+            if caida:
+                return httpx.Response(503, text='error')
+            if request.url.params['keyword'].startswith('lento'):
+                await asyncio.sleep(1)
+            return httpx.Response(200, json={
+                'page': {'number': 0, 'size': 3, 'totalPages': 1, 'totalElements': 3},
+                '_embedded': {'attractions': [
+                    {'id': 'K1', 'name': 'Rosalía', 'classifications': []},
+                    {'id': 'K2', 'name': 'Los Rosales', 'classifications': []},
+                    {'id': 'K3', 'name': 'Metallica', 'classifications': []}]},
+            })
+
+        with tempfile.TemporaryDirectory() as directory:
+            index = SearchIndex(os.path.join(directory, 'indice.sqlite3'))
+            client = TicketmasterClient('test_token', transport=httpx.MockTransport(handler), index=index,
+                                        fallback_after=0.2)
+            # La respuesta no espera a que se escriba en el índice
+            escribir = index.add_sync
+            liberar = threading.Event()
+            with patch.object(index, 'add_sync', lambda *args: liberar.wait(5) and escribir(*args)):
+                await asyncio.wait_for(client.page('attractions', keyword='rosalia'), 1)
+                self.assertEqual(index.search_sync('attractions', 'ROSA'), [])
+                liberar.set()
+                await asyncio.to_thread(index.flush)
+
+            self.assertEqual([a.id for a in index.search_sync('attractions', 'ROSA')], ['K1', 'K2'])
+            self.assertEqual([a.id for a in index.search_sync('attractions', 'rosales')], ['K2', 'K1'])
+            self.assertEqual([a.id for a in index.search_sync('attractions', 'metalica')], ['K3'])
+            self.assertEqual(index.search_sync('attractions', 'xyz'), [])
+            # Las búsquedas no esperan a las escrituras
+            with index._lock:
+                busqueda = asyncio.to_thread(index.search_sync, 'attractions', 'rosa')
+                self.assertEqual(len(await asyncio.wait_for(busqueda, 1)), 2)
+
+            # Un índice del formato anterior, con los trigramas en una tabla, se convierte al abrirlo
+            antiguo = os.path.join(directory, 'antiguo.sqlite3')
+            with sqlite3.connect(antiguo) as connection:
+                connection.executescript(
+                    "CREATE TABLE items (kind TEXT NOT NULL, id TEXT NOT NULL, name TEXT NOT NULL, norm TEXT NOT NULL, "
+                    "data BLOB NOT NULL, updated REAL NOT NULL, PRIMARY KEY (kind, id));"
+                    "CREATE TABLE grams (gram TEXT NOT NULL, kind TEXT NOT NULL, id TEXT NOT NULL, "
+                    "PRIMARY KEY (gram, kind, id)) WITHOUT ROWID;")
+                connection.execute("INSERT INTO items VALUES ('attractions', 'K1', 'Rosalía', 'rosalia', ?, 0)",
+                                   (zlib.compress(json.dumps({'id': 'K1', 'name': 'Rosalía', 'classifications': []}).encode()),))
+            connection.close()
+            convertido = SearchIndex(antiguo)
+            self.assertEqual([a.id for a in convertido.search_sync('attractions', 'rosalai')], ['K1'])
+            convertido.close()
+
+            lento = await client.page('attractions', keyword='lento metallica')
+            self.assertEqual([a.id for a in lento], ['K3'])
+
+            caida = True
+            resultado = await client.page('attractions', keyword='rosali')
+            self.assertEqual(resultado[0].name, 'Rosalía')
+            self.assertEqual(resultado.total_pages, 1)
+            with self.assertRaises(ApiException):
+                await client.page('attractions', keyword='desconocido')
+            await client.aclose()
+            index.close()
+
+    async def test_resiliencia_ticketmaster(self):
+        """
+        Prueba los reintentos, el cortocircuito y la cuota del cliente de Ticketmaster.
+
+        Esta prueba verifica que un 429 se reintenta, que tras varios fallos seguidos el circuito se abre,
+        se sirve la respuesta caducada de la caché y no se llama a la API hasta pasado el tiempo de espera,
+        y que con la cuota diaria agotada las peticiones fallan sin llegar a la API.
+        """
+        now = [0.0]
+        respuestas = []
+        peticiones = []
+        pagina = {'page': {'number': 0, 'size': 1, 'totalPages': 1, 'totalElements': 1},
+                  '_embedded': {'attractions': [{'id': 'K1', 'name': 'Rosalía', 'classifications': []}]}}
+
+        def handler(request):
+            peticiones.append(request.url.params['keyword'])
+            return respuestas.pop(0) if respuestas else httpx.Response(200, json=pagina)
+
+        breaker = CircuitBreaker('prueba', failure_threshold=3, reset_timeout=30, clock=lambda: now[0])
+        client = TicketmasterClient('x', transport=httpx.MockTransport(handler), breaker=breaker,
+                                    cache=ResponseCache(ttls={'attractions': 10}, clock=lambda: now[0]))
+
+        respuestas.append(httpx.Response(429, headers={'Retry-After': '0'}, text='throttled'))
+        resultado = await client.page('attractions', keyword='rosalia')
+        self.assertEqual((resultado[0].id, len(peticiones)), ('K1', 2))
+
+        now[0] = 11
+        respuestas.extend(httpx.Response(503, text='error') for _ in range(3))
+        resultado = await client.page('attractions', keyword='rosalia')
+        self.assertEqual((resultado[0].id, len(peticiones)), ('K1', 5))
+        self.assertEqual(breaker.state, 'open')
+        with self.assertRaises(CircuitOpenError):
+            await client.page('attractions', keyword='otra')
+        self.assertEqual(len(peticiones), 5)
+
+        now[0] = 42
+        await client.page('attractions', keyword='otra')
+        self.assertEqual(breaker.state, 'closed')
+
+        reinicio = str(int((time.time() + 3600) * 1000))
+        respuestas.append(httpx.Response(200, json=pagina, headers={'Rate-Limit-Available': '0', 'Rate-Limit-Reset': reinicio}))
+        await client.page('attractions', keyword='tercera')
+        with self.assertRaises(ApiException) as error:
+            await client.page('attractions', keyword='cuarta')
+        self.assertEqual(error.exception.args[0], 429)
+        self.assertEqual(peticiones[-1], 'tercera')
+        self.assertTrue(client.stats()['quota_exhausted'])
+        await client.aclose()
+
+    async def test_response_cache(self):
+        """
+        Prueba la caché de respuestas de Ticketmaster.
+
+        Esta prueba verifica que las búsquedas equivalentes comparten entrada (y petición en curso),
+        que las entradas caducan según el TTL del endpoint y que se expulsa la menos usada.
+        """
+        now = [0.0]
+        cache = ResponseCache(maxsize=2, ttls={'events': 10}, clock=lambda: now[0])
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0)
+            return ['resultado']
+
+        results = await asyncio.gather(
+            cache.get_or_fetch('events', {'keyword': 'Rosalía ', 'source': ['tmr', 'ticketmaster']}, fetch),
+            cache.get_or_fetch('events', {'keyword': 'rosalía', 'source': ['ticketmaster', 'tmr']}, fetch),
+        )
+        self.assertEqual(results, [['resultado'], ['resultado']])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        now[0] = 11
+        await cache.get_or_fetch('events', {'keyword': 'rosalía', 'source': ['ticketmaster', 'tmr']}, fetch)
+        self.assertEqual(len(calls), 2)
+
+        await cache.get_or_fetch('events', {'keyword': 'a'}, fetch)
+        await cache.get_or_fetch('events', {'keyword': 'b'}, fetch)
+        self.assertEqual(cache.stats()['size'], 2)
+        self.assertFalse(cache.get(cache.make_key('events', {'keyword': 'rosalía', 'source': ['ticketmaster', 'tmr']}))[0])
+        self.assertNotEqual(cache.make_key('event', {'id': 'vvG1AbC'}), cache.make_key('event', {'id': 'vvg1abc'}))
+        self.assertNotEqual(cache.make_key('events', {'attractionId': 'K8vZ'}),
+                            cache.make_key('events', {'attractionId': 'k8vz'}))
+
+    @patch('bot.tm_client')
+    async def test_buscar_pagina(self, tm_client_mock):
+        """
+        Prueba la paginación de las búsquedas.
+
+        Esta prueba verifica que buscar_pagina deja de leer en cuanto reúne MAX_BUTTONS resultados distintos,
+        que no pide la página siguiente hasta que se pulsa el botón (tampoco para colocar el cursor), que
+        siguiente_pagina continúa desde el cursor guardado en user_data y que los nombres ya mostrados no se
+        repiten en las páginas siguientes.
+        """
+        def evento(numero, nombre=None):
+            event = MagicMock()
+            event.id, event.name = f'ev{numero}', nombre or f'Evento {numero}'
+            return event
+
+        paginas_servidas = []
+        async def search_pages(method, start_page=0, **params):
+            for number in range(start_page, 3):
+                paginas_servidas.append(number)
+                pagina = Page(number, 25, 75, 3)
+                pagina += [evento(number * 25 + i) for i in range(25)]
+                if number == 1:
+                    pagina[0] = evento(25, 'Evento 3')
+                yield pagina
+        tm_client_mock.search_pages = MagicMock(side_effect=search_pages)
+        context_mock = MagicMock()
+        context_mock.user_data = {}
+        context_mock.bot = AsyncMock()
+
+        items, cursor = await buscar_pagina(context_mock, 'events', {'keyword': 'test'})
+
+        self.assertEqual([item.id for item in items], [f'ev{i}' for i in range(MAX_BUTTONS)])
+        self.assertEqual(paginas_servidas, [0])
+        self.assertEqual((cursor['method'], cursor['params'], cursor['page'], cursor['index']),
+                         ('events', {'keyword': 'test'}, 0, MAX_BUTTONS))
+        self.assertEqual(context_mock.user_data['search_cursor'], cursor)
+
+        update_mock = MagicMock()
+        update_mock.callback_query = AsyncMock()
+        await siguiente_pagina(update_mock, context_mock)
+
+        # El resto de la página 0, sin pedir todavía la 1
+        self.assertEqual(paginas_servidas, [0, 0])
+        reply_markup = context_mock.bot.send_message.call_args.kwargs['reply_markup']
+        self.assertEqual([fila[0].text for fila in reply_markup.inline_keyboard[:-2]], [f'Evento {i}' for i in range(20, 25)])
+        self.assertEqual(reply_markup.inline_keyboard[-2][0].callback_data, str(NEXT_PAGE))
+        self.assertEqual(context_mock.user_data['search_cursor']['page'], 1)
+
+        await siguiente_pagina(update_mock, context_mock)
+        self.assertEqual(paginas_servidas, [0, 0, 1])
+        reply_markup = context_mock.bot.send_message.call_args.kwargs['reply_markup']
+        self.assertEqual(reply_markup.inline_keyboard[0][0].text, 'Evento 26')
+
+        # Última página: sin cursor ni botón de página siguiente
+        items, cursor = await buscar_pagina(context_mock, 'events', {'keyword': 'test'}, 2, 10)
+        self.assertEqual([item.id for item in items], [f'ev{i}' for i in range(60, 75)])
+        self.assertIsNone(cursor)
+        self.assertIsNone(context_mock.user_data['search_cursor'])
+
+    @patch('bot.tm_client')
+    @patch('bot.detectar_nuevos_eventos', new_callable=AsyncMock)
+    @patch.dict('bot.eventos_recientes', clear=True)
+    @patch.dict('bot.estados_notificacion', clear=True)
+    @patch.dict('bot.eventos_vistos', clear=True)
+    async def test_notificar_nuevos_eventos(self, detectar_mock, tm_client_mock):
+        """
+        Prueba la tarea de notificaciones de cada franja.
+
+        Esta prueba verifica que la tarea consulta una sola vez cada artista seguido (aunque lo sigan
+        varios usuarios), revisa una vez a cada seguidor al que ya le toca (aunque falle la notificación de otro),
+        guarda la fecha de la notificación en su estado sin tocar sus datos y que en la siguiente franja no vuelve
+        a revisarlos ni a consultar. Con base de datos, la instantánea de eventos vistos se guarda por artista
+        fuera de bot_data, también la que guardaban ahí las versiones anteriores.
+        """
+        def eventos(method, attraction_id, **params):
+            return [Event.from_json(FakeTicketmaster.event(attraction_id + '_evento', 'Concierto'))]
+        tm_client_mock.search = AsyncMock(side_effect=eventos)
+
+        async def detectar(context, chat_id, *args):
+            if chat_id == 10:
+                raise KeyError('images')
+        detectar_mock.side_effect = detectar
+        context_mock = MagicMock()
+        context_mock.application.user_data = {
+            1: {'followed_artists': {'K8': 'Artista'}, 'chat_id': 10, 'hora_notificacion': '00:00'},
+            2: {'followed_artists': {}},
+            3: {'followed_artists': {'K8': 'Artista', 'K9': 'Otro'}, 'hora_notificacion': '00:00'},
+            4: {'followed_artists': {'K7': 'Tarde'}, 'hora_notificacion': '23:59', 'zona_horaria': 'Etc/GMT+12'},
+        }
+        context_mock.application.bot_data = {}
+        context_mock.application.persistence = None
+        bot.estados_notificacion[4] = {'ultima_notificacion': '9999-12-31'}
+
+        await notificar_nuevos_eventos(context_mock)
+
+        self.assertEqual(sorted(call.kwargs['attraction_id'] for call in tm_client_mock.search.await_args_list), ['K8', 'K9'])
+        self.assertEqual(sorted(call.args[1] for call in detectar_mock.await_args_list), [3, 10])
+        eventos_por_artista = detectar_mock.await_args.args[3]
+        self.assertEqual({artist_id: [event.id for event in events] for artist_id, events in eventos_por_artista.items()},
+                         {'K8': ['K8_evento'], 'K9': ['K9_evento']})
+        self.assertEqual(set(bot.eventos_vistos), {'K8', 'K9'})
+        self.assertEqual(context_mock.application.bot_data, {})
+        estados = {call.args[1]: call.args[7] for call in detectar_mock.await_args_list}
+        self.assertEqual(estados, {10: bot.estados_notificacion[1], 3: bot.estados_notificacion[3]})
+        self.assertIn('ultima_notificacion', bot.estados_notificacion[1])
+        self.assertIn('ultima_notificacion', bot.estados_notificacion[3])
+        self.assertEqual(bot.estados_notificacion[4], {'ultima_notificacion': '9999-12-31'})
+        context_mock.application.mark_data_for_update_persistence.assert_not_called()
+
+        await notificar_nuevos_eventos(context_mock)
+        self.assertEqual(tm_client_mock.search.await_count, 2)
+        self.assertEqual(detectar_mock.await_count, 2)
+
+        with tempfile.TemporaryDirectory() as directory:
+            persistence = SQLitePersistence(os.path.join(directory, 'bot.sqlite3'))
+            context_mock.application.persistence = persistence
+            context_mock.application.bot_data = {'eventos_vistos': {'K8': {}, 'K6': {}}}
+            for estado in (bot.eventos_vistos, bot.eventos_recientes, bot.estados_notificacion):
+                estado.clear()
+            bot.estados_notificacion[4] = {'ultima_notificacion': '9999-12-31'}
+            with patch.object(persistence, 'update_job_data', wraps=persistence.update_job_data) as update_mock:
+                await notificar_nuevos_eventos(context_mock)
+            self.assertEqual(context_mock.application.bot_data, {})
+            self.assertEqual(set(await persistence.get_job_data('eventos_vistos')), {'K8', 'K9'})
+            # La instantánea anterior se guarda entera una vez; después, solo los artistas que cambian
+            self.assertEqual([set(call.args[1]) for call in update_mock.await_args_list], [{'K8', 'K6'}, {'K8', 'K9'}])
+            context_mock.application.update_persistence.assert_not_called()
+            await persistence.flush()
+
+    @patch('bot.tm_client')
+    @patch.dict('bot.eventos_recientes', clear=True)
+    @patch.dict('bot.estados_notificacion', clear=True)
+    @patch.dict('bot.eventos_vistos', clear=True)
+    async def test_franjas_notificacion(self, tm_client_mock):
+        """
+        Prueba el reparto de las notificaciones a lo largo del día.
+
+        Esta prueba verifica que la hora por defecto se reparte entre HORA_NOTIFICACION y REPARTO_NOTIFICACION,
+        que se respetan la zona y la hora elegidas con /zona y /hora, que solo está pendiente quien ya pasó su
+        hora local y que cada franja se llena por orden de llegada sin pasar del cupo de consultas, dejando
+        al resto (con sus artistas) para la siguiente.
+        """
+        zona, hora = preferencia_notificacion(1234, {})
+        self.assertEqual(zona.zone, ZONA_NOTIFICACION)
+        self.assertEqual((zona, hora), preferencia_notificacion(1234, {}))
+        inicio = HORA_NOTIFICACION[0] * 60 + HORA_NOTIFICACION[1]
+        self.assertTrue(inicio <= hora.hour * 60 + hora.minute < inicio + REPARTO_NOTIFICACION)
+        self.assertEqual(len({preferencia_notificacion(user_id, {})[1] for user_id in range(200)}),
+                         REPARTO_NOTIFICACION // MINUTOS_FRANJA)
+
+        update_mock = MagicMock()
+        update_mock.message.reply_text = AsyncMock()
+        context_mock = MagicMock(user_data={})
+        context_mock.args = ['America/Mexico_City']
+        await configurar_zona(update_mock, context_mock)
+        context_mock.args = ['8:5']
+        await configurar_hora(update_mock, context_mock)
+        context_mock.args = ['25:00']
+        await configurar_hora(update_mock, context_mock)
+        self.assertEqual(context_mock.user_data, {'zona_horaria': 'America/Mexico_City', 'hora_notificacion': '08:05'})
+        self.assertIn('HH:MM', update_mock.message.reply_text.await_args.args[0])
+
+        ahora = datetime.datetime(2030, 1, 1, 8, 30, tzinfo=datetime.timezone.utc)
+        users = {
+            1: {'followed_artists': {'K1': 'a', 'K2': 'b'}, 'hora_notificacion': '08:00', 'zona_horaria': 'Europe/Madrid'},
+            2: {'followed_artists': {'K2': 'b'}, 'hora_notificacion': '09:00', 'zona_horaria': 'Europe/Madrid'},
+            3: {'followed_artists': {'K3': 'c'}, 'hora_notificacion': '08:00', 'zona_horaria': 'America/New_York'},
+            4: {'followed_artists': {'K4': 'd'}, 'hora_notificacion': '08:00', 'zona_horaria': 'Europe/Madrid'},
+            5: {'followed_artists': {'K5': 'e', 'K6': 'f'}, 'hora_notificacion': '08:10', 'zona_horaria': 'Europe/London'},
+            6: {'followed_artists': {}, 'hora_notificacion': '00:00'},
+        }
+        estados = {3: {'ultima_notificacion': '2029-12-31'}, 4: {'ultima_notificacion': '2030-01-01'}}
+        pendientes = usuarios_pendientes(users, estados, ahora)
+        self.assertEqual([user_id for _, user_id, _ in pendientes], [1, 2, 5])
+        self.assertEqual(pendientes[0][2], '2030-01-01')
+        # Sin notificación previa, toca la de ayer si hoy aún no ha llegado su hora
+        self.assertEqual(usuarios_pendientes({3: users[3]}, {}, ahora)[0][1:], (3, '2029-12-31'))
+
+        # Una hora posterior a la última franja del día se atiende en la primera del día siguiente, una vez al día
+        tarde = {7: {'followed_artists': {'K7': 'g'}, 'hora_notificacion': '23:50', 'zona_horaria': 'Europe/Madrid'}}
+        estados = {7: {'ultima_notificacion': '2029-12-31'}}
+        notificaciones = []
+        franja = datetime.datetime(2030, 1, 1, tzinfo=datetime.timezone.utc)
+        while franja < datetime.datetime(2030, 1, 4, tzinfo=datetime.timezone.utc):
+            for _, user_id, dia in usuarios_pendientes(tarde, estados, franja):
+                notificaciones.append((franja.astimezone(pytz.timezone('Europe/Madrid')).strftime('%d %H:%M'), dia))
+                estados[user_id]['ultima_notificacion'] = dia
+            franja += datetime.timedelta(minutes=MINUTOS_FRANJA)
+        self.assertEqual(notificaciones, [('02 00:00', '2030-01-01'), ('03 00:00', '2030-01-02'), ('04 00:00', '2030-01-03')])
+
+        elegidos, por_buscar = repartir_franja(pendientes, users, set(), max_peticiones=3, max_envios=10)
+        self.assertEqual([user_id for _, user_id, _ in elegidos], [1, 2])
+        self.assertEqual(por_buscar, {'K1', 'K2'})
+        elegidos, por_buscar = repartir_franja(pendientes, users, {'K1', 'K2'}, max_peticiones=3, max_envios=2)
+        self.assertEqual(([user_id for _, user_id, _ in elegidos], por_buscar), ([1, 2], set()))
+        elegidos, _ = repartir_franja(pendientes[2:], users, set(), max_peticiones=1, max_envios=1)
+        self.assertEqual([user_id for _, user_id, _ in elegidos], [5])
+        # Cada página de eventos de un artista cuenta como una petición
+        elegidos, _ = repartir_franja(pendientes, users, set(), max_peticiones=4, max_envios=10)
+        self.assertEqual([user_id for _, user_id, _ in elegidos], [1, 2, 5])
+        elegidos, por_buscar = repartir_franja(pendientes, users, set(), max_peticiones=4, max_envios=10,
+                                               paginas=lambda artist_id: 2 if artist_id == 'K1' else 1)
+        self.assertEqual(([user_id for _, user_id, _ in elegidos], por_buscar), ([1, 2], {'K1', 'K2'}))
+
+        # Con un cupo de 1 consulta por minuto, cada franja atiende a los usuarios que caben en MINUTOS_FRANJA consultas
+        tm_client_mock.search = AsyncMock(return_value=[])
+        context_mock = MagicMock()
+        context_mock.application.user_data = {user_id: {'followed_artists': {f'K{user_id}': 'x'}, 'hora_notificacion': '00:00'}
+                                              for user_id in range(MINUTOS_FRANJA + 5)}
+        context_mock.application.bot_data = {}
+        context_mock.application.persistence = None
+        # Sin el reparto de turnos dentro de la franja, que a 1 consulta por minuto haría esperar a la prueba
+        with patch.dict(os.environ, {'MAX_PETICIONES_MINUTO': '1'}), patch('bot.ritmo_por_minuto', return_value=None):
+            await notificar_nuevos_eventos(context_mock)
+            self.assertEqual(tm_client_mock.search.await_count, MINUTOS_FRANJA)
+            await notificar_nuevos_eventos(context_mock)
+        self.assertEqual(tm_client_mock.search.await_count, MINUTOS_FRANJA + 5)
+        self.assertTrue(all('ultima_notificacion' in bot.estados_notificacion[user_id] for user_id in context_mock.application.user_data))
+
+    async def test_detectar_nuevos_eventos(self):
+        """
+        Prueba la detección de eventos nuevos con el índice de eventos vistos.
+
+        Esta prueba verifica que solo se notifican los eventos vistos por primera vez después de la
+        marca del usuario, que la marca avanza, que varios eventos nuevos se envían juntos en un
+        resumen y un álbum, y que los eventos ya celebrados se olvidan.
+        """
+        def evento(event_id, fecha):
+            return Event.from_json({
+                'id': event_id, 'name': event_id, 'url': 'https://example.com',
+                'dates': {'start': {'dateTime': fecha}, 'status': {'code': 'onsale'}},
+                'images': [{'url': 'https://example.com/img.jpg'}],
+            })
+        context_mock = MagicMock()
+        context_mock.bot = AsyncMock()
+        user_data = {'followed_artists': {'K8': 'Artista'}, 'events': ['viejo']}
+        vistos = {}
+
+        eventos = [evento('viejo', '2030-01-01T20:00:00Z'), evento('ev1', '2030-02-01T20:00:00Z')]
+        registrar_eventos(vistos, eventos, 100.0)
+        await detectar_nuevos_eventos(context_mock, 10, user_data, {'K8': eventos}, {'K8': vistos})
+        context_mock.bot.send_photo.assert_awaited_once()
+        self.assertIn('Evento nuevo de Artista', context_mock.bot.send_photo.call_args.kwargs['caption'])
+        self.assertEqual(user_data['vistos_hasta'], {'K8': 100.0})
+
+        user_data.pop('events')
+        eventos = eventos + [evento('ev2', '2030-03-01T20:00:00Z'), evento('ev3', '2030-04-01T20:00:00Z')]
+        registrar_eventos(vistos, eventos, 200.0)
+        await detectar_nuevos_eventos(context_mock, 10, user_data, {'K8': eventos}, {'K8': vistos})
+        context_mock.bot.send_photo.assert_awaited_once()
+        self.assertIn('2 eventos nuevos', context_mock.bot.send_message.call_args.kwargs['text'])
+        media = context_mock.bot.send_media_group.call_args.kwargs['media']
+        self.assertEqual([photo.caption.split('</i>')[0] for photo in media], ['<b><i>ev2', '<b><i>ev3'])
+        self.assertEqual(user_data['vistos_hasta'], {'K8': 200.0})
+
+        registrar_eventos(vistos, [], datetime.datetime(2030, 1, 5, tzinfo=datetime.timezone.utc).timestamp())
+        self.assertEqual(set(vistos), {'ev1', 'ev2', 'ev3'})
+
+        # Los eventos sin imagen van en un mensaje de texto aparte del álbum
+        context_mock.bot.reset_mock()
+        await enviar_eventos_nuevos(context_mock, 10, [('Artista', 'x', 'ficha x', None, ()),
+                                                       ('Artista', 'y', 'ficha y', 'https://example.com/y.jpg', ()),
+                                                       ('Artista', 'z', 'ficha z', None, ())])
+        self.assertEqual(context_mock.bot.send_photo.call_args.kwargs['photo'], 'https://example.com/y.jpg')
+        self.assertEqual(context_mock.bot.send_message.call_args.kwargs['text'], 'ficha x\nficha z')
+
+    async def test_cambios_eventos(self):
+        """
+        Prueba la detección incremental de cambios en los eventos.
+
+        Esta prueba verifica que se detectan los cambios de estado, precio y fecha, que las entradas del
+        formato anterior se actualizan sin notificarse como cambios y que al usuario se le avisa del cambio
+        una sola vez.
+        """
+        def evento(status='offsale', precio=None, fecha='2030-02-01T20:00:00Z'):
+            return Event.from_json({
+                'id': 'ev1', 'name': 'ev1', 'url': 'https://example.com',
+                'dates': {'start': {'dateTime': fecha}, 'status': {'code': status}},
+                'priceRanges': [{'min': precio, 'max': precio}] if precio else [],
+                'images': [{'url': 'https://example.com/img.jpg'}],
+            })
+        vistos = {'ev1': (50.0, 4e9)}
+        self.assertEqual(registrar_eventos(vistos, [evento()], 100.0), ([], []))
+        self.assertEqual(last_change(vistos), 50.0)
+
+        self.assertEqual(registrar_eventos(vistos, [evento('onsale', 30)], 200.0), ([], ['ev1']))
+        self.assertEqual(vistos['ev1'].changes, ('status', 'price'))
+        self.assertEqual(registrar_eventos(vistos, [evento('onsale', 30, '2030-03-01T20:00:00Z')], 300.0), ([], ['ev1']))
+        self.assertEqual(vistos['ev1'].changes, ('date',))
+        self.assertEqual((vistos['ev1'].first_seen, last_change(vistos)), (50.0, 300.0))
+
+        context_mock = MagicMock()
+        context_mock.bot = AsyncMock()
+        user_data = {'followed_artists': {'K8': 'Artista'}, 'vistos_hasta': {'K8': 50.0}}
+        eventos = {'K8': [evento('onsale', 30, '2030-03-01T20:00:00Z')]}
+        await detectar_nuevos_eventos(context_mock, 10, user_data, eventos, {'K8': vistos}, {'K8': 300.0})
+        context_mock.bot.send_photo.assert_awaited_once()
+        self.assertIn('Cambios en un evento de Artista: cambio de fecha', context_mock.bot.send_photo.call_args.kwargs['caption'])
+        self.assertEqual(user_data['vistos_hasta'], {'K8': 300.0})
+
+        await detectar_nuevos_eventos(context_mock, 10, user_data, eventos, {'K8': vistos}, {'K8': 300.0})
+        context_mock.bot.send_photo.assert_awaited_once()
+
+    def test_renderizar_evento(self):
+        """
+        Prueba el renderizado de fichas de eventos.
+
+        Esta prueba verifica que la ficha convierte la hora a la de España, que se reutiliza para el
+        mismo evento sin cambios, que se vuelve a generar si el evento cambia y que admite eventos sin imagen.
+        """
+        def evento(status):
+            return Event.from_json({
+                'id': 'ev_render', 'name': 'Concierto', 'url': 'https://example.com',
+                'dates': {'start': {'dateTime': '2030-07-01T18:00:00Z'}, 'status': {'code': status}},
+                'priceRanges': [{'min': 20, 'max': 45}],
+                '_embedded': {'venues': [{'name': 'WiZink Center', 'city': {'name': 'Madrid'}}]},
+                'images': [{'url': 'https://example.com/img.jpg'}],
+            })
+        _renderizar_evento.cache_clear()
+
+        event_info, main_image = renderizar_evento(evento('onsale'))
+        self.assertEqual(main_image, 'https://example.com/img.jpg')
+        self.assertIn('<b>Hora (España):</b> 20:00', event_info)
+        self.assertIn('Desde <b>20€</b> hasta <b>45€</b>', event_info)
+        self.assertIn('WiZink Center, Madrid', event_info)
+
+        self.assertEqual(renderizar_evento(evento('onsale')), (event_info, main_image))
+        self.assertEqual(_renderizar_evento.cache_info().hits, 1)
+        self.assertIn('OFFSALE', renderizar_evento(evento('offsale'))[0])
+
+        sin_imagen = Event.from_json({'id': 'ev_sin_imagen', 'name': 'Concierto', 'dates': {'status': {'code': 'onsale'}}})
+        self.assertIsNone(renderizar_evento(sin_imagen)[1])
+
+    async def test_rate_limiter(self):
+        """
+        Prueba el limitador de envíos a Telegram.
+
+        Esta prueba verifica que, con el cubo global agotado, las peticiones interactivas pasan antes
+        que las notificaciones y que un RetryAfter se reintenta.
+        """
+        limiter = TelegramRateLimiter(overall_rate=1000, max_retries=1)
+        limiter.overall.bucket.pause(0.01)
+        orden = []
+
+        async def enviar(nombre):
+            orden.append(nombre)
+            return nombre
+
+        await asyncio.gather(
+            limiter.process_request(enviar, ('notificacion',), {}, 'sendMessage', {'chat_id': 1}, PRIORITY_BULK),
+            limiter.process_request(enviar, ('respuesta',), {}, 'sendMessage', {'chat_id': 2}, None),
+        )
+        self.assertEqual(orden, ['respuesta', 'notificacion'])
+
+        intentos = []
+        async def flood():
+            intentos.append(1)
+            if len(intentos) == 1:
+                raise RetryAfter(0)
+            return True
+        self.assertTrue(await limiter.process_request(flood, (), {}, 'sendMessage', {'chat_id': 3}, None))
+        self.assertEqual(limiter.retries, 1)
+
+    async def test_programar_notificaciones(self):
+        """
+        Prueba que la tarea de notificaciones se registra una sola vez y se repite en cada franja.
+        """
+        application_mock = MagicMock()
+        application_mock.job_queue.get_jobs_by_name.return_value = []
+
+        await programar_notificaciones(application_mock)
+        application_mock.job_queue.get_jobs_by_name.return_value = [MagicMock()]
+        await programar_notificaciones(application_mock)
+
+        application_mock.job_queue.run_repeating.assert_called_once()
+        llamada = application_mock.job_queue.run_repeating.call_args
+        self.assertIs(llamada.args[0], notificar_nuevos_eventos)
+        self.assertEqual(llamada.kwargs['interval'], MINUTOS_FRANJA * 60)
+        self.assertTrue(0 < llamada.kwargs['first'] <= MINUTOS_FRANJA * 60)
+        application_mock.job_queue.run_daily.assert_not_called()
+
+    async def test_sqlite_persistence(self):
+        """
+        Prueba la persistencia en SQLite.
+
+        Esta prueba verifica que los datos de usuario se guardan por filas, que solo se reescriben
+        las filas que cambian y que un fichero de PicklePersistence se migra una única vez, aunque
+        arranquen a la vez varios procesos.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            pickle_path = os.path.join(directory, 'conversationbot.pickle')
+            pickle_persistence = PicklePersistence(filepath=pickle_path)
+            await pickle_persistence.update_user_data(1, {'followed_artists': {'K8': 'Artista'}})
+            await pickle_persistence.update_bot_data({'ultima_notificacion': '2030-01-01'})
+
+            db_path = os.path.join(directory, 'bot.sqlite3')
+            persistence = SQLitePersistence(db_path, migrate_from=pickle_path)
+            self.assertEqual(await persistence.get_user_data(), {1: {'followed_artists': {'K8': 'Artista'}}})
+            self.assertEqual(await persistence.get_bot_data(), {'ultima_notificacion': '2030-01-01'})
+
+            # Otro proceso migra la base de datos mientras este lee el fichero
+            compartida = os.path.join(directory, 'compartida.sqlite3')
+            primero = SQLitePersistence(compartida, migrate_from=pickle_path)
+            segundo = SQLitePersistence(compartida, migrate_from=pickle_path)
+            existe = os.path.exists
+            def exists(path):
+                if path == pickle_path and segundo._connection is None:
+                    segundo._connect()
+                return existe(path)
+            with patch('persistence.os.path.exists', side_effect=exists):
+                self.assertEqual(await primero.get_user_data(), {1: {'followed_artists': {'K8': 'Artista'}}})
+            self.assertEqual(await primero._run("SELECT COUNT(*) FROM meta"), [(1,)])
+            await primero.flush()
+            await segundo.flush()
+
+            with patch.object(persistence, '_run', wraps=persistence._run) as run_mock:
+                await persistence.update_user_data(1, {'followed_artists': {'K8': 'Artista'}})
+                run_mock.assert_not_awaited()
+                await persistence.update_user_data(2, {'chat_id': 2})
+                run_mock.assert_awaited_once()
+            await persistence.update_conversation('conv', (2, 2), 1)
+            await persistence.drop_user_data(1)
+            await persistence.flush()
+
+            os.remove(pickle_path)
+            reopened = SQLitePersistence(db_path, migrate_from=pickle_path)
+            self.assertEqual(await reopened.get_user_data(), {2: {'chat_id': 2}})
+            self.assertEqual(await reopened.get_conversations('conv'), {(2, 2): 1})
+            await reopened.flush()
+
+    def test_callback_tokens(self):
+        """
+        Prueba el mapa de tokens de callback.
+
+        Esta prueba verifica que un token resuelve al id original hasta que caduca.
+        """
+        now = [0.0]
+        tokens = CallbackTokens(ttl=60, clock=lambda: now[0])
+        token = tokens.register('vvG1zZ9Ll0dNZ0')
+
+        self.assertEqual(tokens.resolve(token), 'vvG1zZ9Ll0dNZ0')
+        self.assertEqual(token, tokens.register('vvG1zZ9Ll0dNZ0'))
+        now[0] = 61
+        self.assertIsNone(tokens.resolve(token))
+
+    def test_callback_codec(self):
+        """
+        Prueba la codificación del callback_data de los botones.
+
+        Esta prueba verifica que el resultado nunca supera los 64 bytes, que el nombre se recorta sin
+        partir caracteres multibyte y que el id original se recupera, también cuando no cabe tal cual.
+        """
+        codec = CallbackCodec()
+        nombre = 'Café Tacvba ' * 10
+
+        data = codec.encode(5, 'K8vZ9171oZ7', nombre)
+        self.assertLessEqual(len(data.encode('utf-8')), 64)
+        self.assertEqual(codec.decode(data), ('5', 'K8vZ9171oZ7', data.split('_', 2)[2]))
+        self.assertTrue(nombre.startswith(codec.decode(data)[2]))
+
+        id_largo = 'id_con_guiones_bajos_y_muy_largo_' * 2
+        data = codec.encode(10, id_largo, 'Nombre_con_guiones')
+        self.assertLessEqual(len(data.encode('utf-8')), 64)
+        self.assertEqual(codec.decode(data), ('10', id_largo, 'Nombre_con_guiones'))
+
+        self.assertEqual(truncate_utf8('ñandú', 3), 'ña')
+        self.assertEqual(truncate_utf8('ññ', 3), 'ñ')
+        self.assertEqual(truncate_utf8('ñandú', 1), '')
+
+    @patch('bot.tm_client')
+    async def test_mostrar_info_evento(self, tm_client_mock):
+        """
+        Prueba la función mostrar_info_evento.
+
+        Esta prueba verifica que el evento pulsado se obtiene por su id (sin repetir la búsqueda
+        por palabra clave) y que se envía una única foto con su información.
+        """
+        event = Event.from_json({
+            'id': 'ev1', 'name': 'Concierto', 'url': 'https://example.com/ev1',
+            'dates': {'start': {'dateTime': '2030-05-01T19:30:00Z'}, 'status': {'code': 'onsale'}},
+            'images': [{'url': 'https://example.com/ev1.jpg'}],
+        })
+        tm_client_mock.event_by_id = AsyncMock(return_value=event)
+        update_mock = MagicMock()
+        update_mock.callback_query = AsyncMock()
+        update_mock.callback_query.data = callback_codec.encode(EVENT_INFO, 'ev1', 'Concierto')
+        context_mock = MagicMock()
+        context_mock.bot = AsyncMock()
+
+        await mostrar_info_evento(update_mock, context_mock)
+
+        tm_client_mock.event_by_id.assert_awaited_once_with('ev1')
+        tm_client_mock.search.assert_not_called()
+        context_mock.bot.send_photo.assert_called_once()
+        call_args = context_mock.bot.send_photo.call_args
+        self.assertEqual(call_args.kwargs['photo'], 'https://example.com/ev1.jpg')
+        self.assertIn('EN VENTA', call_args.kwargs['caption'])
+        self.assertIn('21:30', call_args.kwargs['caption'])
+
+    @patch('bot.ESPERA_TECLEO', 0.05)
+    @patch('bot.tm_client')
+    async def test_consulta_inline(self, tm_client_mock):
+        """
+        Prueba el modo inline (@bot texto).
+
+        Esta prueba verifica que solo se busca la última consulta de un usuario que teclea deprisa,
+        que se responde con los artistas antes que los eventos (con su ficha) y que el mismo texto,
+        aunque cambien mayúsculas o acentos, se responde desde la caché sin volver a buscar. Los nombres
+        con & o < se escapan en el HTML de los mensajes. Con índice local, se responde primero desde él y la
+        búsqueda en Ticketmaster solo lo completa.
+        """
+        async def page(method, **params):
+            pagina = Page(0, 1, 1, 1)
+            if method == 'attractions':
+                pagina.append(Attraction.from_json(FakeTicketmaster.attraction('K1', params['keyword'])))
+            else:
+                pagina.append(Event.from_json(FakeTicketmaster.event('E1', f"{params['keyword']} en directo")))
+            return pagina
+
+        tm_client_mock.page = AsyncMock(side_effect=page)
+        tm_client_mock.index = None
+        respuestas_inline.clear()
+
+        def consulta(user_id, texto):
+            update_mock = MagicMock()
+            update_mock.inline_query = AsyncMock()
+            update_mock.inline_query.id = f"{user_id}-{texto}"
+            update_mock.inline_query.query = texto
+            update_mock.inline_query.from_user.id = user_id
+            return update_mock
+
+        primera, segunda = consulta(1, 'meta'), consulta(1, 'metal')
+        await asyncio.gather(consulta_inline(primera, MagicMock()), consulta_inline(segunda, MagicMock()))
+
+        primera.inline_query.answer.assert_not_called()
+        self.assertEqual(sorted(call.args[0] for call in tm_client_mock.page.await_args_list), ['attractions', 'events'])
+        self.assertEqual({call.kwargs['keyword'] for call in tm_client_mock.page.await_args_list}, {'metal'})
+        resultados = segunda.inline_query.answer.call_args.args[0]
+        self.assertEqual([r.title for r in resultados], ['metal', 'metal en directo'])
+        self.assertIn('EN VENTA', resultados[1].input_message_content.message_text)
+
+        otra = consulta(2, ' MÉTAL')
+        await consulta_inline(otra, MagicMock())
+        self.assertEqual(otra.inline_query.answer.call_args.args[0], resultados)
+        self.assertEqual(tm_client_mock.page.await_count, 2)
+
+        html = consulta(3, 'AC&DC <live>')
+        await consulta_inline(html, MagicMock())
+        artista, evento = html.inline_query.answer.call_args.args[0]
+        self.assertEqual(artista.title, 'AC&DC <live>')
+        self.assertIn('<b>AC&amp;DC &lt;live&gt;</b>', artista.input_message_content.message_text)
+        self.assertIn('<b><i>AC&amp;DC &lt;live&gt; en directo</i></b>', evento.input_message_content.message_text)
+
+        with tempfile.TemporaryDirectory() as directory:
+            tm_client_mock.index = SearchIndex(os.path.join(directory, 'indice.sqlite3'))
+            try:
+                tm_client_mock.index.add_sync('attractions', [
+                    Attraction.from_json(FakeTicketmaster.attraction('K7', 'Rosalía'))])
+                local = consulta(4, 'rosal')
+                with patch('bot.ESPERA_TECLEO', 0.5):
+                    tarea = asyncio.create_task(consulta_inline(local, MagicMock()))
+                    await asyncio.sleep(0.1)
+                    # Respondida desde el índice antes de buscar en Ticketmaster
+                    self.assertEqual([r.title for r in local.inline_query.answer.call_args.args[0]], ['Rosalía'])
+                    self.assertEqual(local.inline_query.answer.call_args.kwargs['cache_time'], 0)
+                    self.assertEqual(tm_client_mock.page.await_count, 4)
+                    await tarea
+                local.inline_query.answer.assert_called_once()
+                self.assertEqual(tm_client_mock.page.await_count, 6)
+                self.assertIsNotNone(respuestas_inline.get(respuestas_inline.make_key('inline', {'q': 'rosal'}))[1])
+            finally:
+                tm_client_mock.index.close()
+
+    async def test_webhook(self):
+        """
+        Prueba el modo webhook contra un servidor de Telegram local.
+
+        Esta prueba verifica que al arrancar se registra el webhook y que una actualización /start recibida
+        por HTTP (con el token secreto) se procesa y responde con el logo.
+        """
+        telegram = FakeTelegram()
+        base_url = await telegram.start()
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            puerto = s.getsockname()[1]
+
+        application = construir_aplicacion('123:ABC', base_url=base_url, max_concurrent_updates=4)
+        try:
+            async with application:
+                await application.start()
+                await application.updater.start_webhook(listen='127.0.0.1', port=puerto, url_path='webhook',
+                                                        webhook_url='https://bot.example.com/webhook',
+                                                        secret_token='secreto')
+                self.assertIn('setWebhook', [m for m, _ in telegram.calls])
+
+                update = {'update_id': 1, 'message': {
+                    'message_id': 1, 'date': 0, 'text': '/start',
+                    'chat': {'id': 5, 'type': 'private'},
+                    'from': {'id': 5, 'is_bot': False, 'first_name': 'Ana'},
+                    'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]}}
+                async with httpx.AsyncClient() as http:
+                    rechazada = await http.post(f'http://127.0.0.1:{puerto}/webhook', json=update)
+                    aceptada = await http.post(f'http://127.0.0.1:{puerto}/webhook', json=update,
+                                               headers={'X-Telegram-Bot-Api-Secret-Token': 'secreto'})
+                self.assertEqual(rechazada.status_code, 403)
+                self.assertEqual(aceptada.status_code, 200)
+
+                await telegram.wait_for('sendPhoto')
+                self.assertEqual([p['chat_id'] for m, p in telegram.calls if m == 'sendPhoto'], ['5'])
+
+                await application.updater.stop()
+                await application.stop()
+        finally:
+            await telegram.stop()
+
+    async def test_ordered_update_processor(self):
+        """
+        Prueba el procesado concurrente de actualizaciones.
+
+        Esta prueba verifica que las actualizaciones de una misma conversación se procesan en orden y de una
+        en una, mientras que las de otras conversaciones avanzan a la vez, y que las que esperan su turno
+        no ocupan los huecos del procesador.
+        """
+        processor = OrderedUpdateProcessor(4)
+        orden = []
+
+        def update(chat_id):
+            update_mock = MagicMock(spec=Update)
+            update_mock.effective_chat.id = chat_id
+            update_mock.effective_user.id = chat_id
+            return update_mock
+
+        async def handler(nombre, espera):
+            orden.append(('inicio', nombre))
+            await asyncio.sleep(espera)
+            orden.append(('fin', nombre))
+
+        await asyncio.gather(
+            processor.process_update(update(1), handler('a1', 0.05)),
+            processor.process_update(update(1), handler('a2', 0)),
+            processor.process_update(update(2), handler('b1', 0)),
+        )
+
+        self.assertLess(orden.index(('fin', 'a1')), orden.index(('inicio', 'a2')))
+        self.assertLess(orden.index(('fin', 'b1')), orden.index(('fin', 'a1')))
+        self.assertEqual(processor.active_conversations, 0)
+
+        # Cuatro actualizaciones lentas del usuario 1 no bloquean la del usuario 2
+        orden.clear()
+        lentas = [asyncio.create_task(processor.process_update(update(1), handler(f"a{n}", 0.2))) for n in range(4)]
+        await asyncio.sleep(0)
+        await asyncio.wait_for(processor.process_update(update(2), handler('b', 0)), 0.1)
+        self.assertEqual(orden, [('inicio', 'a0'), ('inicio', 'b'), ('fin', 'b')])
+        for tarea in lentas:
+            tarea.cancel()
+        await asyncio.gather(*lentas, return_exceptions=True)
+        self.assertEqual(processor.active_conversations, 0)
+
+    async def test_shared_sqlite_persistence(self):
+        """
+        Prueba la base de datos SQLite compartida por varios procesos.
+
+        Esta prueba verifica que un proceso ve los datos de usuario que escribe otro, que la revisión de eventos
+        solo lee de la base de datos las filas que otros procesos cambiaron (y ninguna con un solo proceso),
+        que se actualizan las bases de datos sin versiones y que el lease de la revisión solo lo tiene un proceso a la vez.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            db_path = os.path.join(directory, 'bot.sqlite3')
+            with sqlite3.connect(db_path) as antigua:
+                antigua.execute("CREATE TABLE user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL)")
+                antigua.execute("INSERT INTO user_data VALUES (9, ?)", (pickle.dumps({'chat_id': 9}),))
+            antigua.close()
+            proceso_a = SQLitePersistence(db_path)
+            proceso_b = SQLitePersistence(db_path)
+            user_data = {}
+            await proceso_b.refresh_user_data(1, user_data)
+            self.assertEqual(user_data, {})
+
+            await proceso_a.update_user_data(1, {'followed_artists': {'K8': 'Artista'}})
+            await proceso_b.refresh_user_data(1, user_data)
+            self.assertEqual(user_data, {'followed_artists': {'K8': 'Artista'}})
+            user_data['chat_id'] = 1 # Cambio local aún sin persistir
+            await proceso_b.refresh_user_data(1, user_data)
+            self.assertEqual(user_data['chat_id'], 1)
+
+            # Lo que la revisión guarda de un usuario no pisa sus datos, que escribe el proceso que lo atiende
+            await proceso_b.update_job_user_data('notificaciones', 1, {'vistos_hasta': {'K8': 1.0}})
+            self.assertEqual(await proceso_a.get_job_user_data('notificaciones'), {1: {'vistos_hasta': {'K8': 1.0}}})
+            self.assertEqual(await proceso_a.get_user_data(), {1: {'followed_artists': {'K8': 'Artista'}}, 9: {'chat_id': 9}})
+            self.assertEqual(await proceso_a.get_job_user_data_changes('notificaciones'), {})
+
+            await proceso_b.get_user_data()
+            await proceso_a.update_user_data(2, {'chat_id': 2})
+            await proceso_b.update_user_data(3, {'chat_id': 3})
+            await proceso_a.update_job_user_data('notificaciones', 2, {'ultima_notificacion': '2030-01-01'})
+            self.assertEqual(await proceso_b.get_user_data_changes(), {2: {'chat_id': 2}})
+            self.assertEqual(await proceso_b.get_user_data_changes(), {})
+            # La fila del usuario 1 la escribió el propio proceso b
+            self.assertEqual(await proceso_b.get_job_user_data_changes('notificaciones'),
+                             {2: {'ultima_notificacion': '2030-01-01'}})
+            self.assertEqual(await proceso_a.get_job_user_data_changes('notificaciones'), {})
+
+            # El estado de una tarea se escribe por clave y solo se reescriben las que cambian
+            await proceso_a.update_job_data('eventos_vistos', {'K8': {'E1': 1}, 'K9': {'E2': 2}})
+            self.assertEqual(await proceso_b.get_job_data_changes('eventos_vistos'), {'K8': {'E1': 1}, 'K9': {'E2': 2}})
+            with patch.object(proceso_a, '_connect', wraps=proceso_a._connect) as connect_mock:
+                await proceso_a.update_job_data('eventos_vistos', {'K8': {'E1': 1}})
+                connect_mock.assert_not_called()
+            await proceso_a.update_job_data('eventos_vistos', {'K8': {'E1': 1, 'E3': 3}, 'K9': {'E2': 2}})
+            self.assertEqual(await proceso_b.get_job_data_changes('eventos_vistos'), {'K8': {'E1': 1, 'E3': 3}})
+            await proceso_a.drop_job_data('eventos_vistos', ['K9'])
+            self.assertEqual(await proceso_b.get_job_data('eventos_vistos'), {'K8': {'E1': 1, 'E3': 3}})
+
+            # cargar_usuarios solo va a la base de datos con varios procesos
+            await proceso_a.update_user_data(2, {'chat_id': 20})
+            application_mock = MagicMock(persistence=proceso_b, user_data=collections.defaultdict(dict, {2: {'chat_id': 2}}))
+            self.assertEqual(await cargar_usuarios(application_mock), {2: {'chat_id': 2}})
+            application_mock.update_processor = ShardedUpdateProcessor(1, 1, ['http://a', 'http://b'])
+            self.assertEqual(await cargar_usuarios(application_mock), {2: {'chat_id': 20}})
+
+            self.assertTrue(await proceso_a.acquire_lease('notificaciones', 'a', 60))
+            self.assertFalse(await proceso_b.acquire_lease('notificaciones', 'b', 60))
+            self.assertTrue(await proceso_a.acquire_lease('notificaciones', 'a', 60))
+            await proceso_a.release_lease('notificaciones', 'a')
+            self.assertTrue(await proceso_b.acquire_lease('notificaciones', 'b', 60))
+            await proceso_a.flush()
+            await proceso_b.flush()
+
+    async def test_lease_perdido(self):
+        """
+        Prueba que la revisión de eventos nuevos se detiene si otro proceso se queda con su lease.
+        """
+        revisando = asyncio.Event()
+
+        async def revision_lenta(context, persistence=None):
+            revisando.set()
+            await asyncio.sleep(10)
+
+        with tempfile.TemporaryDirectory() as directory:
+            persistence = SQLitePersistence(os.path.join(directory, 'bot.sqlite3'))
+            context_mock = MagicMock()
+            context_mock.application.persistence = persistence
+            context_mock.application.bot_data = {}
+            context_mock.application.update_persistence = AsyncMock()
+            with patch('bot.medir_revision', side_effect=revision_lenta), patch('bot.DURACION_LEASE', 0.2):
+                tarea = asyncio.create_task(notificar_nuevos_eventos(context_mock))
+                await revisando.wait()
+                await persistence._run("UPDATE leases SET owner = 'otro'")
+                await asyncio.wait_for(tarea, 1)
+            context_mock.application.update_persistence.assert_not_awaited()
+            self.assertFalse(await persistence.acquire_lease('notificaciones', bot.WORKER_ID, 60))
+            await persistence.flush()
+
+    async def test_sharded_update_processor(self):
+        """
+        Prueba el reparto de actualizaciones entre varios procesos.
+
+        Esta prueba verifica que cada proceso atiende solo a sus usuarios y reenvía al webhook del
+        proceso correspondiente las actualizaciones de los demás, reintentando si no responde y sin
+        atenderlas nunca él mismo.
+        """
+        reenviadas = []
+        fallos = [0]
+        def webhook(request):
+            if fallos[0]:
+                fallos[0] -= 1
+                return httpx.Response(503)
+            reenviadas.append((str(request.url), request.headers.get('X-Telegram-Bot-Api-Secret-Token'), json.loads(request.content)))
+            return httpx.Response(200)
+        urls = ['http://worker0/webhook', 'http://worker1/webhook']
+        processor = ShardedUpdateProcessor(4, 0, urls, secret_token='secreto', transport=httpx.MockTransport(webhook),
+                                           retries=2, retry_delay=0)
+        propio = next(user_id for user_id in range(1, 100) if shard_for((user_id, user_id), 2) == 0)
+        ajeno = next(user_id for user_id in range(1, 100) if shard_for((user_id, user_id), 2) == 1)
+
+        def update(user_id):
+            return Update.de_json({'update_id': user_id, 'message': {
+                'message_id': 1, 'date': 0, 'text': 'hola',
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': 'Ana'}}}, None)
+
+        procesadas = []
+        async def handler(user_id):
+            procesadas.append(user_id)
+
+        await processor.initialize()
+        try:
+            await processor.process_update(update(propio), handler(propio))
+            await processor.process_update(update(ajeno), handler(ajeno))
+            fallos[0] = 2
+            await processor.process_update(update(ajeno), handler(ajeno))
+            fallos[0] = 3
+            await processor.process_update(update(ajeno), handler(ajeno))
+        finally:
+            await processor.shutdown()
+
+        self.assertEqual(procesadas, [propio])
+        self.assertEqual(processor.forwarded, 2)
+        self.assertEqual([(url, secreto, cuerpo['update_id']) for url, secreto, cuerpo in reenviadas],
+                         [('http://worker1/webhook', 'secreto', ajeno)] * 2)
+        self.assertEqual(fallos[0], 0)
+        self.assertEqual(processor.active_conversations, 0)
+
+    async def test_benchmark(self):
+        """
+        Prueba el banco de pruebas de rendimiento.
+
+        Esta prueba verifica que todos los escenarios se ejecutan contra los servidores locales,
+        que las métricas de varias ejecuciones se resumen con la mediana y que la comparación con la
+        referencia detecta una regresión, pero solo si la referencia se midió en la misma máquina.
+        """
+        resultados = await benchmark.run_benchmark(users=2, iterations=1, catalog_size=5)
+
+        self.assertEqual(set(resultados), set(benchmark.SCENARIOS))
+        for metricas in resultados.values():
+            self.assertEqual(metricas['calls'], 2)
+            self.assertLessEqual(metricas['p50_ms'], metricas['p99_ms'])
+            self.assertGreater(metricas['peak_memory_kib'], 0)
+
+        referencia = {nombre: dict(metricas, p95_ms=metricas['p95_ms'] / 2) for nombre, metricas in resultados.items()}
+        self.assertEqual(benchmark.compare(resultados, resultados, 0.25), [])
+        self.assertEqual(len(benchmark.compare(resultados, referencia, 0.25)), len(benchmark.SCENARIOS))
+
+        ejecuciones = [{'artist_button': {'calls': 2, 'p50_ms': p50}} for p50 in (10.0, 90.0, 12.0)]
+        with patch.object(benchmark, 'run_benchmark', AsyncMock(side_effect=ejecuciones)):
+            self.assertEqual(await benchmark.run_repeated(3), {'artist_button': {'calls': 2, 'p50_ms': 12.0}})
+
+        lenta = {'artist_button': {'calls': 2, 'rps': 1.0, 'p50_ms': 100.0, 'p95_ms': 100.0, 'p99_ms': 100.0}}
+        rapida = {'artist_button': dict(lenta['artist_button'], rps=10.0, p50_ms=10.0)}
+        argumentos = ['--cold-start', '0', '--repeat', '1']
+        with tempfile.TemporaryDirectory() as directory, \
+                patch.object(benchmark, 'run_repeated', AsyncMock(side_effect=[rapida, lenta, lenta])), \
+                patch('builtins.print'):
+            argumentos += ['--baseline', os.path.join(directory, 'referencia.json')]
+            self.assertEqual(await asyncio.to_thread(benchmark.main, argumentos + ['--save-baseline']), 0)
+            self.assertEqual(await asyncio.to_thread(benchmark.main, argumentos), 1)
+            with patch.object(benchmark, 'machine_info', return_value={'cpus': 64}):
+                self.assertEqual(await asyncio.to_thread(benchmark.main, argumentos), 0)
+
+    async def test_metricas(self):
+        """
+        Prueba las métricas y su exportación.
+
+        Esta prueba verifica el formato de contadores e histogramas, que las llamadas a Ticketmaster y los
+        handlers quedan medidos y que todo se sirve en /metrics.
+        """
+        registry = Registry()
+        peticiones = registry.counter('peticiones_total', "Peticiones", ('endpoint',))
+        duracion = registry.histogram('duracion_seconds', "Duración", buckets=(0.1, 1))
+        peticiones.inc(endpoint='events')
+        peticiones.inc(2, endpoint='events')
+        duracion.observe(0.5)
+        duracion.observe(5)
+        texto = registry.expose()
+        self.assertIn('# TYPE peticiones_total counter\npeticiones_total{endpoint="events"} 3', texto)
+        self.assertIn('duracion_seconds_bucket{le="0.1"} 0\nduracion_seconds_bucket{le="1"} 1\n'
+                      'duracion_seconds_bucket{le="+Inf"} 2\nduracion_seconds_sum 5.5\nduracion_seconds_count 2', texto)
+
+        client = TicketmasterClient('x', transport=httpx.MockTransport(lambda request: httpx.Response(500, text='error')),
+                                    max_retries=0)
+        errores_antes = REGISTRY.get('ticketmaster_requests_total').value(endpoint='event', outcome='500')
+        with self.assertRaises(ApiException):
+            await client.event_by_id('ev1')
+        await client.aclose()
+        self.assertEqual(REGISTRY.get('ticketmaster_requests_total').value(endpoint='event', outcome='500'), errores_antes + 1)
+
+        application = construir_aplicacion('123:ABC')
+        conversacion, = [handler for handler in application.handlers[0] if isinstance(handler, ConversationHandler)]
+        handler = conversacion.entry_points[0]
+        medidas_antes = REGISTRY.get('bot_handler_seconds').count(handler='start')
+        await handler.callback(MagicMock(), MagicMock(bot=AsyncMock(), bot_data={}))
+        self.assertEqual(REGISTRY.get('bot_handler_seconds').count(handler='start'), medidas_antes + 1)
+
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            puerto = s.getsockname()[1]
+        servidor = start_metrics_server(puerto)
+        try:
+            async with httpx.AsyncClient() as http:
+                respuesta = await http.get(f'http://127.0.0.1:{puerto}/metrics')
+        finally:
+            servidor.stop()
+        self.assertIn('ticketmaster_requests_total{endpoint="event",outcome="500"}', respuesta.text)
+        self.assertIn('bot_handler_seconds_count{handler="start"}', respuesta.text)
+        self.assertIn('bot_update_queue_size 0', respuesta.text)
+
+    def test_sampling_profiler(self):
+        """
+        Prueba el perfilador por muestreo.
+
+        Esta prueba verifica que las pilas de la función que ocupa el hilo aparecen en el perfil.
+        """
+        def ocupado():
+            fin = time.perf_counter() + 0.2
+            while time.perf_counter() < fin:
+                pass
+
+        with SamplingProfiler(interval=0.002) as profiler:
+            ocupado()
+
+        self.assertTrue(any('ocupado' in pila for pila in profiler.samples))
+        self.assertRegex(profiler.folded().splitlines()[0], r' \d+$')
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,322 @@
+"""Latency and throughput benchmark for the bot handlers.
+
+Drives ``artist_button``, ``event_button``, ``mostrar_info_evento``,
+``generate_buttons`` and ``detectar_nuevos_eventos`` end to end, with N
+concurrent simulated users, against the local fake Telegram and Ticketmaster
+servers of ``fake_servers.py``. For every scenario it reports p50/p95/p99
+latency and calls per second, then repeats the workload with tracemalloc on to
+report the peak memory it allocates (tracing would triple the latencies).
+``--cold-start N`` also times, in N fresh interpreters, how long importing
+``bot`` and building the application takes, which is what a container
+restart waits for before handling updates.
+
+The whole workload runs ``--repeat`` times and every metric is the median of
+the runs, since a single run varies by tens of percent. Save a baseline once
+and later runs with the same settings on the same machine are compared
+against it; the exit status is 1 when a scenario regressed beyond
+``--tolerance``. Baselines record the machine they were measured on and are
+never compared with runs from another one::
+
+    python benchmark.py --users 50 --iterations 5 --save-baseline
+    python benchmark.py --users 50 --iterations 5
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from telegram import Update
+from telegram.ext import BaseRateLimiter, CallbackContext
+
+import bot
+from fake_servers import FakeTelegram, FakeTicketmaster
+from ticketmaster import TicketmasterClient, ResponseCache
+
+BASELINE = 'benchmark_baseline.json'
+SCENARIOS = ('artist_button', 'event_button', 'mostrar_info_evento', 'generate_buttons', 'detectar_nuevos_eventos')
+#: Artists followed by every simulated user in ``detectar_nuevos_eventos``
+FOLLOWED_ARTISTS = 3
+#: Run in a fresh interpreter by ``measure_cold_start``; prints the seconds until the application is built
+COLD_START = """
+import time
+start = time.perf_counter()
+import bot
+bot.construir_aplicacion('123:COLDSTART')
+print(time.perf_counter() - start)
+"""
+
+
+class UnlimitedRateLimiter(BaseRateLimiter):
+    """Sends every request immediately, to measure the bot rather than Telegram's quotas."""
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        return await callback(*args, **kwargs)
+
+
+def percentile(samples, p):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+class Harness:
+    """Builds real ``Update``/``CallbackContext`` objects for the simulated users and runs the scenarios."""
+
+    def __init__(self, application):
+        self.application = application
+        self.update_ids = 0
+        self.attractions = []
+        self.events_by_artist = {}
+        self.seen_events = {}
+
+    async def prepare(self):
+        """Fetches the fixed data used by ``generate_buttons`` and ``detectar_nuevos_eventos``."""
+        self.attractions = list(await bot.tm_client.page('attractions', keyword='benchmark'))
+        for n in range(FOLLOWED_ARTISTS):
+            artist_id = f"artist{n}"
+            events = await bot.tm_client.search('events', attraction_id=artist_id)
+            self.events_by_artist[artist_id] = events
+            bot.registrar_eventos(self.seen_events.setdefault(artist_id, {}), events, time.time())
+
+    def _update(self, user_id, **fields):
+        self.update_ids += 1
+        return Update.de_json({'update_id': self.update_ids, **fields}, self.application.bot)
+
+    @staticmethod
+    def _user(user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"}
+
+    def message(self, user_id, text):
+        return self._update(user_id, message={
+            'message_id': 1, 'date': 0, 'text': text,
+            'chat': {'id': user_id, 'type': 'private'}, 'from': self._user(user_id)})
+
+    def callback(self, user_id, data):
+        return self._update(user_id, callback_query={
+            'id': str(self.update_ids), 'chat_instance': str(user_id), 'data': data, 'from': self._user(user_id),
+            'message': {'message_id': 1, 'date': 0, 'chat': {'id': user_id, 'type': 'private'}}})
+
+    def context(self, update):
+        return CallbackContext.from_update(update, self.application)
+
+    async def artist_button(self, user_id, iteration):
+        update = self.message(user_id, f"artist {user_id} {iteration}")
+        await bot.artist_button(update, self.context(update))
+
+    async def event_button(self, user_id, iteration):
+        update = self.message(user_id, f"event {user_id} {iteration}")
+        await bot.event_button(update, self.context(update))
+
+    async def mostrar_info_evento(self, user_id, iteration):
+        event_id = f"E{user_id:06d}{iteration:04d}"
+        update = self.callback(user_id, bot.callback_codec.encode(bot.EVENT_INFO, event_id, event_id))
+        await bot.mostrar_info_evento(update, self.context(update))
+
+    async def generate_buttons(self, user_id, iteration):
+        update = self.message(user_id, 'benchmark')
+        await bot.generate_buttons(self.attractions, bot.ARTIST_INFO, update, self.context(update), "artista",
+                                   include_follow=True)
+
+    async def detectar_nuevos_eventos(self, user_id, iteration):
+        user_data = {'followed_artists': {artist_id: artist_id for artist_id in self.events_by_artist}}
+        update = self.message(user_id, '')
+        await bot.detectar_nuevos_eventos(self.context(update), user_id, user_data, self.events_by_artist,
+                                          self.seen_events)
+
+
+async def run_scenario(harness, name, users, iterations, first_iteration=0):
+    """Runs ``users`` concurrent simulated users, ``iterations`` calls each; returns the latencies and wall time."""
+    scenario = getattr(harness, name)
+    latencies = []
+
+    async def simulated_user(user_id):
+        for iteration in range(first_iteration, first_iteration + iterations):
+            start = time.perf_counter()
+            await scenario(user_id, iteration)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(simulated_user(user_id) for user_id in range(1, users + 1)))
+    return latencies, time.perf_counter() - start
+
+
+async def measure(harness, name, users, iterations, measure_memory=True):
+    # Warm-up: opens the connections and fills the import and render caches outside the timed run
+    await run_scenario(harness, name, 1, 1, first_iteration=-1)
+    latencies, elapsed = await run_scenario(harness, name, users, iterations)
+    metrics = {
+        'calls': len(latencies),
+        'rps': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+    if measure_memory:
+        # Same workload on new ids, so nothing comes from the caches filled by the timed run
+        tracemalloc.start()
+        try:
+            await run_scenario(harness, name, users, iterations, first_iteration=iterations)
+            metrics['peak_memory_kib'] = tracemalloc.get_traced_memory()[1] / 1024
+        finally:
+            tracemalloc.stop()
+    return metrics
+
+
+async def run_benchmark(users=10, iterations=3, telegram_latency=0.0, ticketmaster_latency=0.0, catalog_size=60,
+                        rate_limit=False, scenarios=SCENARIOS, measure_memory=True):
+    """Runs every scenario in turn and returns ``{scenario: metrics}``."""
+    telegram = FakeTelegram(telegram_latency, record=False)
+    ticketmaster = FakeTicketmaster(ticketmaster_latency, catalog_size)
+    telegram_url = await telegram.start()
+    ticketmaster_url = await ticketmaster.start()
+    tm_client = bot.tm_client
+    bot.tm_client = TicketmasterClient('benchmark', base_url=ticketmaster_url, cache=ResponseCache(),
+                                       requests_per_second=None)
+    application = bot.construir_aplicacion('123:BENCHMARK', base_url=telegram_url,
+                                           rate_limiter=None if rate_limit else UnlimitedRateLimiter())
+    try:
+        async with application:
+            harness = Harness(application)
+            await harness.prepare()
+            return {name: await measure(harness, name, users, iterations, measure_memory) for name in scenarios}
+    finally:
+        await bot.tm_client.aclose()
+        bot.tm_client = tm_client
+        await telegram.stop()
+        await ticketmaster.stop()
+
+
+def measure_cold_start(runs=5):
+    """Times ``COLD_START`` in ``runs`` new processes, without any token in the environment."""
+    env = {name: value for name, value in os.environ.items() if not name.startswith('API_')}
+    directory = os.path.dirname(os.path.abspath(__file__))
+    latencies = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', COLD_START], cwd=directory, env=env, check=True,
+                                capture_output=True, text=True).stdout
+        latencies.append(float(output.split()[-1]))
+    return {
+        'calls': runs,
+        'rps': runs / sum(latencies),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+async def run_repeated(repeat, **kwargs):
+    """Runs ``run_benchmark`` ``repeat`` times and returns the median of every metric."""
+    runs = [await run_benchmark(**kwargs) for _ in range(repeat)]
+    return {name: {metric: statistics.median(run[name][metric] for run in runs) for metric in runs[0][name]}
+            for name in runs[0]}
+
+
+def machine_info():
+    """Describes the machine and interpreter; absolute latencies are only comparable when it is the same."""
+    processor = platform.processor()
+    try:
+        with open('/proc/cpuinfo') as file:
+            processor = next(line.split(':', 1)[1].strip() for line in file if line.startswith('model name'))
+    except (OSError, StopIteration):
+        pass
+    return {
+        'system': f"{platform.system()} {platform.machine()}",
+        'processor': processor,
+        'cpus': os.cpu_count(),
+        'python': platform.python_version(),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Returns a description of every metric that is worse than the baseline by more than ``tolerance``."""
+    regressions = []
+    for name, metrics in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'peak_memory_kib'):
+            if metric in metrics and metric in base and metrics[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f"{name}: {metric} {metrics[metric]:.1f} > baseline {base[metric]:.1f}")
+        if metrics['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append(f"{name}: rps {metrics['rps']:.1f} < baseline {base['rps']:.1f}")
+    return regressions
+
+
+def print_report(results):
+    print(f"{'scenario':<26}{'calls':>7}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'peak KiB':>10}")
+    for name, m in results.items():
+        print(f"{name:<26}{m['calls']:>7}{m['rps']:>9.1f}{m['p50_ms']:>9.1f}{m['p95_ms']:>9.1f}"
+              f"{m['p99_ms']:>9.1f}{m.get('peak_memory_kib', math.nan):>10.0f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=10, help="concurrent simulated users")
+    parser.add_argument('--iterations', type=int, default=3, help="calls per user and scenario")
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help="seconds per Telegram request")
+    parser.add_argument('--ticketmaster-latency', type=float, default=0.0, help="seconds per Ticketmaster request")
+    parser.add_argument('--catalog-size', type=int, default=60, help="results per search and events per artist")
+    parser.add_argument('--rate-limit', action='store_true', help="apply TelegramRateLimiter to the sends")
+    parser.add_argument('--no-memory', action='store_true', help="skip the traced run that measures memory")
+    parser.add_argument('--cold-start', type=int, default=5, metavar='N',
+                        help="fresh interpreters used to time import and application build (0 to skip)")
+    parser.add_argument('--repeat', type=int, default=5, help="runs of the workload; metrics are their medians")
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help="run only these scenarios")
+    parser.add_argument('--baseline', default=BASELINE, help="baseline file")
+    parser.add_argument('--save-baseline', action='store_true', help="store this run as the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed relative regression")
+    args = parser.parse_args(argv)
+
+    config = {
+        'users': args.users, 'iterations': args.iterations, 'telegram_latency': args.telegram_latency,
+        'ticketmaster_latency': args.ticketmaster_latency, 'catalog_size': args.catalog_size,
+        'rate_limit': args.rate_limit, 'cold_start': args.cold_start, 'repeat': args.repeat,
+    }
+    machine = machine_info()
+    logging.disable(logging.WARNING)
+    results = asyncio.run(run_repeated(args.repeat, scenarios=args.scenario or SCENARIOS,
+                                       measure_memory=not args.no_memory,
+                                       **{k: v for k, v in config.items() if k not in ('cold_start', 'repeat')}))
+    if args.cold_start:
+        results['cold_start'] = measure_cold_start(args.cold_start)
+    logging.disable(logging.NOTSET)
+    print_report(results)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump({'config': config, 'machine': machine, 'results': results}, file, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    if baseline['config'] != config:
+        print(f"{args.baseline} was recorded with other settings ({baseline['config']}), not comparing")
+        return 0
+    if baseline.get('machine') != machine:
+        print(f"{args.baseline} was recorded on another machine ({baseline.get('machine')}), not comparing; "
+              f"record a baseline here with --save-baseline")
+        return 0
+    regressions = compare(results, baseline['results'], args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,41 +1,151 @@
 import time
 import functools
-import hashlib
+import html
 import logging
 from warnings import filterwarnings
 from telegram.warnings import PTBUserWarning
-from telegram import CallbackQuery, Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import (ApplicationBuilder, PicklePersistence, ContextTypes, 
+from telegram import (CallbackQuery, Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto,
+                      InlineQueryResultArticle, InputTextMessageContent)
+from telegram.error import BadRequest, TelegramError
+from telegram.ext import (ApplicationBuilder, ContextTypes, 
                           ConversationHandler, CommandHandler, CallbackQueryHandler, MessageHandler,
-                          filters)
-import ticketpy
+                          InlineQueryHandler, filters)
+from telegram.request import HTTPXRequest
+import httpx
+from ticketmaster import TicketmasterClient, ResponseCache, ApiException, next_page_number
+from search_index import SearchIndex, normalize
+from callbacks import CallbackCodec
+from event_diff import diff_events, last_change
+from persistence import SQLitePersistence
+from rate_limiter import TelegramRateLimiter, PriorityBucket, TokenBucket, PRIORITY_BULK
+from update_processor import OrderedUpdateProcessor, ShardedUpdateProcessor
+from metrics import REGISTRY, SamplingProfiler, start_metrics_server, timed
 import pytz
 import datetime
-import threading
 import asyncio
 import os
-from dotenv import load_dotenv
-load_dotenv('token.env')
-
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logging.getLogger("httpx").setLevel(logging.WARNING)
+import socket
+import zlib
+
 logger = logging.getLogger(__name__)
 
 filterwarnings(action="ignore", message=r".*CallbackQueryHandler", category=PTBUserWarning)
 
-ticketmaster_token = os.getenv('API_TICKETMASTER_TOKEN')
-if ticketmaster_token is None:
-    raise ValueError('API_TICKETMASTER_TOKEN is not set')
-tm_client = ticketpy.ApiClient(ticketmaster_token)
-
-telegram_token = os.getenv('API_TELEGRAM_TOKEN')
-if telegram_token is None:
-    raise ValueError('API_TELEGRAM_TOKEN is not set')
-
-HORA_NOTIFICACION = (9,0)# Hora a la que se notificarán los eventos nuevos 09:00
+# Importar el módulo no lee la configuración ni crea clientes: eso se hace la primera vez que se necesitan,
+# para que el arranque (y las pruebas) no dependan de token.env ni paguen por lo que no usan.
+
+@functools.lru_cache(maxsize=None)
+def cargar_entorno():
+    """Carga token.env en las variables de entorno, una sola vez."""
+    from dotenv import load_dotenv
+    load_dotenv('token.env')
+
+def variable_obligatoria(nombre):
+    cargar_entorno()
+    valor = os.getenv(nombre)
+    if valor is None:
+        raise ValueError(f'{nombre} is not set')
+    return valor
+
+def __getattr__(nombre):
+    # ticketmaster_token y telegram_token se leen al pedirlos
+    if nombre == 'ticketmaster_token':
+        return variable_obligatoria('API_TICKETMASTER_TOKEN')
+    if nombre == 'telegram_token':
+        return variable_obligatoria('API_TELEGRAM_TOKEN')
+    raise AttributeError(f"module {__name__!r} has no attribute {nombre!r}")
+
+@functools.lru_cache(maxsize=None)
+def contexto_ssl():
+    """Contexto SSL compartido por todos los clientes HTTP: cargar los certificados cuesta ~40 ms cada vez."""
+    return httpx.create_ssl_context()
+
+class PeticionTelegram(HTTPXRequest):
+    """HTTPXRequest que usa el contexto SSL compartido en vez de crear uno propio."""
+
+    def _build_client(self):
+        return httpx.AsyncClient(verify=contexto_ssl(), **self._client_kwargs)
+
+class Perezoso:
+    """Crea el objeto con factoria() la primera vez que se usa uno de sus atributos y le delega todo."""
+
+    def __init__(self, factoria):
+        self._factoria = factoria
+        self._objeto = None
+
+    @property
+    def creado(self):
+        return self._objeto is not None
+
+    def __getattr__(self, nombre):
+        if nombre.startswith('_'):
+            # Las comprobaciones de mock, asyncio, copy o pickle no deben crear el objeto
+            raise AttributeError(nombre)
+        if self._objeto is None:
+            self._objeto = self._factoria()
+        return getattr(self._objeto, nombre)
+
+def crear_cliente_ticketmaster():
+    # Índice local de artistas y eventos: responde las búsquedas si la API falla o tarda más de ESPERA_MAXIMA_API segundos
+    cargar_entorno()
+    search_index = SearchIndex(os.getenv('SEARCH_INDEX_PATH', 'search_index.sqlite3'))
+    return TicketmasterClient(variable_obligatoria('API_TICKETMASTER_TOKEN'), cache=ResponseCache(), index=search_index,
+                              fallback_after=float(os.getenv('ESPERA_MAXIMA_API', 3)), verify=contexto_ssl())
+
+tm_client = Perezoso(crear_cliente_ticketmaster)
+callback_codec = CallbackCodec()
+servidor_metricas = None
+
+HORA_NOTIFICACION = (9,0)# Primera hora a la que se notifican los eventos nuevos a quien no ha elegido otra: 09:00
+ZONA_NOTIFICACION = 'Europe/Madrid' # Zona horaria de quien no ha elegido otra con /zona
+MINUTOS_FRANJA = 15 # Cada cuántos minutos se revisan los usuarios a los que ya les toca la notificación
+REPARTO_NOTIFICACION = 3 * 60 # Minutos desde HORA_NOTIFICACION entre los que se reparte a quien no ha elegido hora
+MAX_PETICIONES_MINUTO = 60 # Peticiones (páginas) a Ticketmaster por minuto de la revisión de eventos nuevos
+MAX_ENVIOS_MINUTO = 600 # Envíos por minuto de notificaciones de eventos nuevos
+FRESCURA_EVENTOS = 4 * 60 * 60 # Segundos que se reutilizan los eventos de un artista en las franjas siguientes
+ZONA_EVENTOS = pytz.timezone('Europe/Madrid') # Zona en la que se muestran las fechas de los eventos
+MAX_ARTISTAS_CONCURRENTES = 5 # Consultas de artistas simultáneas durante la revisión diaria
+MARGEN_CADUCIDAD = 24 * 60 * 60 # Segundos que se recuerda un evento después de celebrarse
+MAX_ALBUM = 10 # Fotos por álbum (límite de Telegram)
+MAX_TEXTO = 4096 # Caracteres por mensaje de texto (límite de Telegram)
+MAX_LINEAS_RESUMEN = 30 # Eventos listados en el mensaje resumen de notificaciones
+TAMANO_PAGINA_REVISION = 200 # Eventos por página en la revisión diaria (máximo de la API)
+DESCRIPCION_CAMBIOS = {'status': 'cambio de estado', 'price': 'precios nuevos', 'date': 'cambio de fecha'}
+MAX_UPDATES_CONCURRENTES = 32 # Actualizaciones de Telegram procesadas a la vez
+DURACION_LEASE = 10 * 60 # Segundos que un proceso se reserva la revisión diaria sin renovarla
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}" # Identifica a este proceso en los leases
+ESPERA_TECLEO = 0.3 # Segundos sin teclear antes de lanzar la búsqueda de una consulta inline
+RESULTADOS_INLINE = {'attractions': 5, 'events': 15} # Resultados de cada tipo por consulta inline (máximo total: 50)
+CACHE_INLINE = 5 * 60 # Segundos que Telegram y el bot guardan la respuesta a una consulta inline
+
+DURACION_HANDLER = REGISTRY.histogram('bot_handler_seconds', "Time spent in each handler", ('handler',))
+ERRORES_HANDLER = REGISTRY.counter('bot_handler_errors_total', "Exceptions raised by each handler", ('handler',))
+DURACION_REVISION = REGISTRY.histogram('bot_notification_job_seconds', "Duration of the daily new events scan",
+                                       buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200))
+EVENTOS_NOTIFICADOS = REGISTRY.counter('bot_notified_events_total', "Events sent in notifications", ('kind',))
+respuestas_inline = ResponseCache(maxsize=4096, ttls={'inline': CACHE_INLINE}) # Por texto normalizado de la consulta
+consultas_inline = {} # user_id -> id de la última consulta inline pendiente de ese usuario
+eventos_recientes = {} # artist_id -> (time.monotonic() de la consulta, eventos): los reutilizan las franjas siguientes
+# user_id -> lo que la revisión guarda de cada usuario ('vistos_hasta', 'ultima_notificacion'). Va aparte de
+# user_data porque con varios procesos los datos de un usuario solo los escribe el proceso que lo atiende
+estados_notificacion = {}
+# artist_id -> {event_id: EventSnapshot}: la instantánea compartida de la revisión. Se guarda por artista en la
+# tabla job_data y no en bot_data, que cada proceso copia y reescribe entera en cada volcado
+eventos_vistos = {}
+USUARIOS_PENDIENTES = REGISTRY.gauge('bot_notification_backlog', "Users due for the new events scan and left for the "
+                                     "next slot")
+
+
+def estadistica_cache(clave):
+    """Dato de tm_client.cache.stats(), sin crear el cliente si aún no se ha usado."""
+    if not getattr(tm_client, 'creado', True) or tm_client.cache is None:
+        return None
+    return tm_client.cache.stats()[clave]
+
+REGISTRY.gauge_callback('ticketmaster_cache_hit_ratio', "Share of Ticketmaster lookups answered by the cache",
+                        functools.partial(estadistica_cache, 'hit_ratio'))
+REGISTRY.gauge_callback('ticketmaster_cache_entries', "Responses held in the Ticketmaster cache",
+                        functools.partial(estadistica_cache, 'size'))
 
 
 START_ROUTES, END_ROUTES = 0, 1
@@ -48,40 +158,66 @@ FOLLOW, UNFOLLOW, START_OVER, END = range(9, 13)
 
 SHOW_CREATORS = 13
 
+LOGO = 'Resources/Bot-beatTracker-Logo.jpg'
+
+NEXT_PAGE = 14
+
+MAX_BUTTONS = 20 # Resultados distintos por teclado
+MAX_PAGINAS_BUSQUEDA = 3 # Páginas de Ticketmaster por teclado como mucho, si las primeras solo traen nombres repetidos
+
+# Teclados y textos fijos: se construyen una vez (los objetos de telegram son inmutables y se pueden reutilizar)
+TECLADO_INICIO = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔍 Buscar artista", callback_data=str(ARTIST_SEARCH)),
+     InlineKeyboardButton("📅 Buscar evento", callback_data=str(EVENT_SEARCH)),
+     InlineKeyboardButton("❤️ Siguiendo", callback_data=str(FOLLOWING))],
+    [InlineKeyboardButton("👥 Creadores", callback_data=str(SHOW_CREATORS))]
+])
+BOTON_VOLVER = InlineKeyboardButton("<-- Volver", callback_data=str(START_OVER))
+TECLADO_VOLVER = InlineKeyboardMarkup([[BOTON_VOLVER]])
+TEXTO_BIENVENIDA = "Te damos la bienvenida a <b>BeatTracker</b>🎶\n\nEmpieza tu aventura gracias a <i>Ticketmaster</i> 🎫, selecciona una opción:"
+
+# Tipo de resultado de cada búsqueda de Ticketmaster: (prefijo del callback, tipo, incluir botón de seguir)
+SEARCH_RESULTS = {
+    'attractions': (ARTIST_INFO, "artista", True),
+    'events': (EVENT_INFO, "evento", False),
+}
+
+async def enviar_imagen(context: ContextTypes.DEFAULT_TYPE, chat_id, ruta, **kwargs):
+    """
+    Envía una imagen estática del bot subiéndola a Telegram solo la primera vez.
+
+    El file_id que devuelve Telegram se guarda en context.bot_data['file_ids'] (persistido) y se reutiliza
+    en los siguientes envíos. Si Telegram lo rechaza, la imagen se vuelve a subir.
+    """
+    file_ids = context.bot_data.setdefault('file_ids', {})
+    file_id = file_ids.get(ruta)
+    if file_id is not None:
+        try:
+            return await context.bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except BadRequest as e:
+            logger.warning("Telegram rechazó el file_id de %s (%s), se vuelve a subir.", ruta, e)
+            del file_ids[ruta]
+
+    with open(ruta, 'rb') as photo:
+        message = await context.bot.send_photo(chat_id=chat_id, photo=photo, **kwargs)
+    file_ids[ruta] = message.photo[-1].file_id
+    return message
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     logger.info("User %s started the conversation.", user.first_name)
 
-    if context.user_data.get('followed_artists') is not None:
-        thread = threading.Thread(target=asyncio.run, args=(notificar_nuevos_eventos(update, context),), name="Notificaciones")
-        thread.daemon = True
-        thread.start()
-
-    keyboard = [
-        [InlineKeyboardButton("🔍 Buscar artista", callback_data=str(ARTIST_SEARCH)),
-         InlineKeyboardButton("📅 Buscar evento", callback_data=str(EVENT_SEARCH)),
-         InlineKeyboardButton("❤️ Siguiendo", callback_data=str(FOLLOWING))],
-        [InlineKeyboardButton("👥 Creadores", callback_data=str(SHOW_CREATORS))]
-    ]
+    # Las notificaciones las envía una única tarea diaria (ver programar_notificaciones)
+    context.user_data['chat_id'] = update.effective_chat.id
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await context.bot.send_photo(chat_id=update.effective_chat.id, photo=open('Resources/Bot-beatTracker-Logo.jpg', 'rb'), caption="Te damos la bienvenida a <b>BeatTracker</b>🎶\n\nEmpieza tu aventura gracias a <i>Ticketmaster</i> 🎫, selecciona una opción:", reply_markup=reply_markup, parse_mode='HTML')
+    await enviar_imagen(context, update.effective_chat.id, LOGO, caption=TEXTO_BIENVENIDA, reply_markup=TECLADO_INICIO, parse_mode='HTML')
     return START_ROUTES
 
 async def start_over(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query=update.callback_query
     await query.answer()
-    keyboard = [
-        [InlineKeyboardButton("🔍 Buscar artista", callback_data=str(ARTIST_SEARCH)),
-         InlineKeyboardButton("📅 Buscar evento", callback_data=str(EVENT_SEARCH)),
-         InlineKeyboardButton("❤️ Siguiendo", callback_data=str(FOLLOWING))],
-        [InlineKeyboardButton("👥 Creadores", callback_data=str(SHOW_CREATORS))]
-    ]
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
 
-    await context.bot.send_photo(chat_id=update.effective_chat.id, photo=open('Resources/Bot-beatTracker-Logo.jpg', 'rb'), caption="Te damos la bienvenida a <b>BeatTracker</b>🎶\n\nEmpieza tu aventura gracias a <i>Ticketmaster</i> 🎫, selecciona una opción:", reply_markup=reply_markup, parse_mode='HTML')
+    await enviar_imagen(context, update.effective_chat.id, LOGO, caption=TEXTO_BIENVENIDA, reply_markup=TECLADO_INICIO, parse_mode='HTML')
     return START_ROUTES
 
 async def buscar_artista(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -91,16 +227,24 @@ async def buscar_artista(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def artist_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(chat_id=update.effective_chat.id, text="Buscando al artista, por favor espera...")
-    resp = tm_client.attractions.find(keyword=update.message.text, source=["ticketmaster", "frontgate", "tmr"]).all()
+    try:
+        resp, cursor = await buscar_pagina(context, 'attractions', {'keyword': update.message.text, 'source': ["ticketmaster", "frontgate", "tmr"]})
+    except (KeyError, ApiException) as e:
+        logging.error(f"{type(e).__name__}: {e}")
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="Ocurrió un error al procesar la búsqueda ⚠️. Prueba una búsqueda diferente.")
+        return
     
-    return await generate_buttons(resp, ARTIST_INFO, update, context, "artista", include_follow=True)
+    return await generate_buttons(resp, ARTIST_INFO, update, context, "artista", include_follow=True, next_page=cursor is not None)
 
 async def seguir_dejar_seguir_artista(update: Update, context: ContextTypes.DEFAULT_TYPE, follow: bool):
     query = update.callback_query
     await query.answer()
-    data = query.data.split("_")
-    artist_id = data[1]
-    artist_name = data[2]
+    _, artist_id, artist_name = callback_codec.decode(query.data)
+    reply_markup = TECLADO_VOLVER
+
+    if artist_id is None:
+        await query.edit_message_text("Artista no encontrado. Vuelve a buscarlo.", reply_markup=reply_markup)
+        return
     
     followed_artists = context.user_data.get('followed_artists', {})
 
@@ -114,9 +258,6 @@ async def seguir_dejar_seguir_artista(update: Update, context: ContextTypes.DEFA
 
     context.user_data['followed_artists'] = followed_artists
     
-    keyboard = [[InlineKeyboardButton("<-- Volver", callback_data=str(START_OVER))]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await query.edit_message_text(message_text, reply_markup=reply_markup, parse_mode='HTML')
 
 async def buscar_evento(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -126,76 +267,184 @@ async def buscar_evento(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def event_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(chat_id=update.effective_chat.id, text="Buscando el evento, por favor espera...")
     try:
-        resp = tm_client.events.find(keyword=update.message.text, source=["ticketmaster", "frontgate", "tmr"]).all()
-        return await generate_buttons(resp, EVENT_INFO, update, context, "evento")
-    except KeyError as e:
-        logging.error(f"KeyError: {e}")
+        resp, cursor = await buscar_pagina(context, 'events', {'keyword': update.message.text, 'source': ["ticketmaster", "frontgate", "tmr"]})
+        return await generate_buttons(resp, EVENT_INFO, update, context, "evento", next_page=cursor is not None)
+    except (KeyError, ApiException) as e:
+        logging.error(f"{type(e).__name__}: {e}")
         await context.bot.send_message(chat_id=update.effective_chat.id, text="Ocurrió un error al procesar la búsqueda ⚠️. Prueba una búsqueda diferente.")
 
 async def mostrar_info_evento(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    data = query.data.split("_")
-    event_id = data[1]
-    event_name = data[2]
-    
-    if event_name:
-        event_search = tm_client.events.find(keyword=event_name, source=["ticketmaster", "frontgate", "tmr"]).all()
-        
-        if not event_search:
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=f"Sin información para el evento <b>{event_name}</b>.", parse_mode='HTML')
-            return
-        
-        for index, event in enumerate(event_search):
-            event_info = f"<b><i>{event.name}</i></b>\n\n"
-            
-            if event.status.lower() == 'onsale':
-                event_info += f"🟢 <b>EN VENTA</b>\n"
-            else:
-                event_info += f"🟠 <b>{event.status.upper()}</b>\n"
-            
-            if event.price_ranges:
-                min_price = event.price_ranges[0]['min']
-                max_price = event.price_ranges[0]['max']
-                event_info += f"Desde <b>{min_price}€</b> hasta <b>{max_price}€</b>\n\n"
-            else:
-                event_info += "\n"
+    _, event_id, event_name = callback_codec.decode(query.data)
 
-            try:
-                if event.utc_datetime:
-                    utc_datetime = event.utc_datetime.replace(tzinfo=pytz.utc)
-                    spain_datetime = utc_datetime.astimezone(pytz.timezone('Europe/Madrid'))
-                elif event.local_datetime:
-                    spain_datetime = event.local_datetime
-                spain_date_str = spain_datetime.strftime('%d-%m-%Y')
-                spain_time_str = spain_datetime.strftime('%H:%M')
-            except AttributeError:
-                spain_date_str = 'No disponible'
-                spain_time_str = 'No disponible'
-
-            event_info += f"<b>Fecha (España):</b> {spain_date_str}\n"
-            event_info += f"<b>Hora (España):</b> {spain_time_str}\n"
-            event_info += f"<b>Lugar:</b> {', '.join([f'{venue.name}, {venue.city}' for venue in event.venues])}\n\n"
-            
-            try:
-                url = event.json['url']
-            except KeyError:
-                url = 'No disponible'
-
-            event_info += "<b>Link:</b> <a href='" + url + "'>" + url + "</a>\n"
-            
-            images = event.json['images']
-            main_image = images[0]['url']
-
-            if index == len(event_search) - 1:
-                keyboard = [[InlineKeyboardButton("<-- Volver", callback_data=str(START_OVER))]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await context.bot.send_photo(chat_id=update.effective_chat.id, photo=main_image, caption=event_info, parse_mode='HTML', reply_markup=reply_markup)
-            else:
-                await context.bot.send_photo(chat_id=update.effective_chat.id, photo=main_image, caption=event_info, parse_mode='HTML')
+    if event_id is None:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="Evento no encontrado. Vuelve a buscarlo.")
+        return
+
+    try:
+        event = await tm_client.event_by_id(event_id)
+    except (KeyError, ApiException) as e:
+        logging.error(f"{type(e).__name__}: {e}")
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=f"Sin información para el evento <b>{html.escape(event_name)}</b>.", parse_mode='HTML')
+        return
+
+    event_info, main_image = renderizar_evento(event)
+
+    reply_markup = TECLADO_VOLVER
+    if main_image is None:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=event_info, parse_mode='HTML', reply_markup=reply_markup)
+        return
+    await context.bot.send_photo(chat_id=update.effective_chat.id, photo=main_image, caption=event_info, parse_mode='HTML', reply_markup=reply_markup)
+
+def renderizar_evento(event):
+    """
+    Devuelve el texto (HTML) de la ficha de un evento y la URL de su imagen principal (None si no tiene).
+
+    Las fichas se memorizan por el id del evento junto con los datos que muestran: si Ticketmaster
+    cambia el evento cambia la clave, y en la revisión diaria cada evento se renderiza una sola vez
+    aunque se envíe a muchos usuarios.
+    """
+    try:
+        url = event.json['url']
+    except KeyError:
+        url = 'No disponible'
+    price_range = (event.price_ranges[0]['min'], event.price_ranges[0]['max']) if event.price_ranges else None
+    venues = tuple((venue.name, venue.city) for venue in event.venues)
+    images = event.json.get('images') or [{}]
+    return _renderizar_evento(event.id, event.name, event.status, price_range, event.utc_datetime, venues, url, images[0].get('url'))
+
+@functools.lru_cache(maxsize=4096)
+def _renderizar_evento(event_id, name, status, price_range, utc_datetime, venues, url, main_image):
+    # Los textos vienen de Ticketmaster: se escapan para que un & o un < no invaliden el HTML
+    event_info = f"<b><i>{html.escape(name)}</i></b>\n\n"
+
+    if status.lower() == 'onsale':
+        event_info += f"🟢 <b>EN VENTA</b>\n"
+    else:
+        event_info += f"🟠 <b>{html.escape(status.upper())}</b>\n"
 
+    if price_range:
+        min_price, max_price = price_range
+        event_info += f"Desde <b>{min_price}€</b> hasta <b>{max_price}€</b>\n\n"
     else:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text="Event not found.")
+        event_info += "\n"
+
+    if utc_datetime:
+        spain_datetime = pytz.utc.localize(utc_datetime).astimezone(ZONA_EVENTOS)
+        spain_date_str = spain_datetime.strftime('%d-%m-%Y')
+        spain_time_str = spain_datetime.strftime('%H:%M')
+    else:
+        spain_date_str = 'No disponible'
+        spain_time_str = 'No disponible'
+
+    event_info += f"<b>Fecha (España):</b> {spain_date_str}\n"
+    event_info += f"<b>Hora (España):</b> {spain_time_str}\n"
+    event_info += f"<b>Lugar:</b> {html.escape(', '.join([f'{venue_name}, {venue_city}' for venue_name, venue_city in venues]))}\n\n"
+    event_info += "<b>Link:</b> <a href='" + html.escape(url) + "'>" + html.escape(url) + "</a>\n"
+    return event_info, main_image
+
+def ratio_fichas_memorizadas():
+    info = _renderizar_evento.cache_info()
+    consultas = info.hits + info.misses
+    return info.hits / consultas if consultas else 0.0
+
+REGISTRY.gauge_callback('bot_event_card_cache_hit_ratio', "Share of event cards served from the render cache",
+                        ratio_fichas_memorizadas)
+
+def resultado_inline(method, item):
+    """Convierte un artista o un evento en un resultado inline; los eventos se envían con su ficha."""
+    if method == 'attractions':
+        imagen = item.images[0]['url'] if item.images else None
+        return InlineQueryResultArticle(
+            id=f"{ARTIST_INFO}:{item.id}", title=item.name, description="Artista", thumbnail_url=imagen,
+            input_message_content=InputTextMessageContent(f"<b>{html.escape(item.name)}</b>\n{html.escape(item.url or '')}", parse_mode='HTML'))
+
+    event_info, main_image = renderizar_evento(item)
+    lugares = ', '.join(venue.city for venue in item.venues if venue.city)
+    return InlineQueryResultArticle(
+        id=f"{EVENT_INFO}:{item.id}", title=item.name, description=f"{item.local_start_date or ''} {lugares}".strip(),
+        thumbnail_url=main_image, input_message_content=InputTextMessageContent(event_info, parse_mode='HTML'))
+
+async def resultados_inline(texto):
+    """
+    Busca a la vez artistas y eventos para una consulta inline.
+
+    Devuelve los resultados inline ordenados como los da Ticketmaster, primero los artistas y luego los eventos,
+    sin nombres repetidos. Solo se eleva ApiException si fallan las dos búsquedas.
+    """
+    busquedas = await asyncio.gather(*(tm_client.page(method, keyword=texto, size=tamano, source=["ticketmaster", "frontgate", "tmr"])
+                                       for method, tamano in RESULTADOS_INLINE.items()), return_exceptions=True)
+    errores = [pagina for pagina in busquedas if isinstance(pagina, BaseException)]
+    for error in errores:
+        if not isinstance(error, ApiException):
+            raise error
+        logging.error(f"{type(error).__name__}: {error}")
+    if len(errores) == len(busquedas):
+        raise errores[0]
+    return combinar_inline(busquedas)
+
+def combinar_inline(busquedas):
+    """Resultados inline de una búsqueda por cada tipo de RESULTADOS_INLINE (las fallidas se omiten), sin nombres repetidos."""
+    resultados = []
+    seen_names = set()
+    for method, pagina in zip(RESULTADOS_INLINE, busquedas):
+        if isinstance(pagina, BaseException):
+            continue
+        for item in pagina[:RESULTADOS_INLINE[method]]:
+            if item.name in seen_names:
+                continue
+            seen_names.add(item.name)
+            resultados.append(resultado_inline(method, item))
+    return resultados
+
+async def resultados_locales(texto):
+    """Resultados inline desde el índice local de búsqueda: en milisegundos y sin gastar cuota. Vacío si no hay índice."""
+    index = tm_client.index
+    if index is None:
+        return []
+    return combinar_inline(await asyncio.gather(*(index.search(method, texto, tamano)
+                                                  for method, tamano in RESULTADOS_INLINE.items())))
+
+async def consulta_inline(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Responde a las consultas inline (@bot texto) con artistas y eventos, sin pasar por la conversación.
+
+    Telegram envía una consulta por cada tecla. Si el índice local tiene resultados, se responde con ellos al
+    momento. La búsqueda en Ticketmaster solo se lanza cuando el usuario deja de escribir durante ESPERA_TECLEO
+    segundos, y no para las consultas a las que ya ha sustituido otra; si ya se respondió desde el índice, solo
+    sirve para completarlo. Las respuestas de Ticketmaster se guardan por texto normalizado en respuestas_inline,
+    así que cualquier prefijo ya buscado, por este u otro usuario, se responde al momento con ellas.
+    """
+    inline_query = update.inline_query
+    texto = normalize(inline_query.query)
+    if len(texto) < 2:
+        await inline_query.answer([], cache_time=CACHE_INLINE)
+        return
+
+    params = {'q': texto}
+    encontrado, _ = respuestas_inline.get(respuestas_inline.make_key('inline', params))
+    locales = []
+    if not encontrado:
+        locales = await resultados_locales(inline_query.query)
+        if locales:
+            # Sin cache_time: cuando el índice se complete con Ticketmaster, Telegram volverá a preguntar
+            await inline_query.answer(locales, cache_time=0)
+        user_id = inline_query.from_user.id
+        consultas_inline[user_id] = inline_query.id
+        await asyncio.sleep(ESPERA_TECLEO)
+        if consultas_inline.get(user_id) != inline_query.id:
+            return
+        del consultas_inline[user_id]
+
+    try:
+        resultados = await respuestas_inline.get_or_fetch('inline', params, lambda: resultados_inline(inline_query.query))
+    except ApiException:
+        if not locales:
+            await inline_query.answer([], cache_time=0)
+        return
+    if not locales:
+        await inline_query.answer(resultados, cache_time=CACHE_INLINE)
 
 async def artistas_siguiendo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     followed_artists = context.user_data.get('followed_artists')
@@ -213,28 +462,87 @@ async def artistas_siguiendo(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def mostrar_info_artista(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    data = query.data.split("_")
-    artist_id = data[1]
-    artist_name = data[2]
+    _, artist_id, artist_name = callback_codec.decode(query.data)
     
     events= []
+    cursor = None
 
     if artist_name:
         try:
-            events = tm_client.events.find(keyword=artist_name, source=["ticketmaster", "frontgate", "tmr"]).all()
-        except KeyError as e:
-            logging.error(f"KeyError: {e}")
+            events, cursor = await buscar_pagina(context, 'events', {'keyword': artist_name, 'source': ["ticketmaster", "frontgate", "tmr"]})
+        except (KeyError, ApiException) as e:
+            logging.error(f"{type(e).__name__}: {e}")
             await context.bot.send_message(chat_id=update.effective_chat.id, text="Ocurrió un error al procesar la búsqueda ⚠️. Prueba una búsqueda diferente.")
 
         if not events:
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=f"Sin eventos para el artista <b>{artist_name}</b>.", parse_mode='HTML')
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=f"Sin eventos para el artista <b>{html.escape(artist_name)}</b>.", parse_mode='HTML')
             return
 
-        return await generate_buttons(events, EVENT_INFO, query, context, "evento")
+        return await generate_buttons(events, EVENT_INFO, query, context, "evento", next_page=cursor is not None)
     else:
         await context.bot.send_message(chat_id=update.effective_chat.id, text="Artista no encontrado.")
 
-async def generate_buttons(items, callback_prefix, update, context, item_type, chat_id=None, include_follow=False):
+async def buscar_pagina(context: ContextTypes.DEFAULT_TYPE, method, params, page=0, index=0, seen_names=()):
+    """
+    Reúne hasta MAX_BUTTONS resultados de una búsqueda desde (page, index), sin repetir los nombres de seen_names.
+
+    Cada página de Ticketmaster es una petición: se para en cuanto se llena el teclado o se acaba una página que
+    ya dio algún resultado, así que la página siguiente solo se pide cuando el usuario pulsa el botón (como mucho
+    MAX_PAGINAS_BUSQUEDA por teclado si solo llegan nombres repetidos). La posición del siguiente resultado y los
+    nombres ya mostrados se guardan en context.user_data['search_cursor'] para el botón de página siguiente.
+    Devuelve los resultados y el cursor (None si no quedan más).
+    """
+    items = []
+    seen_names = set(seen_names)
+    siguiente = None
+    pedidas = 0
+    page_number = page
+    async for result_page in tm_client.search_pages(method, start_page=page, **params):
+        pedidas += 1
+        for position in range(index if page_number == page else 0, len(result_page)):
+            if len(items) >= MAX_BUTTONS:
+                siguiente = (page_number, position)
+                break
+            item = result_page[position]
+            if item.name in seen_names:
+                continue
+            seen_names.add(item.name)
+            items.append(item)
+        else:
+            page_number = next_page_number(page_number, result_page)
+            if page_number is not None and (items or pedidas >= MAX_PAGINAS_BUSQUEDA):
+                siguiente = (page_number, 0)
+        if siguiente is not None or page_number is None:
+            break
+
+    cursor = None
+    if siguiente is not None:
+        cursor = {'method': method, 'params': params, 'page': siguiente[0], 'index': siguiente[1],
+                  'seen_names': sorted(seen_names)}
+    context.user_data['search_cursor'] = cursor
+    return items, cursor
+
+async def siguiente_pagina(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    cursor = context.user_data.get('search_cursor')
+
+    if cursor is None:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="No hay más resultados.")
+        return
+
+    callback_prefix, item_type, include_follow = SEARCH_RESULTS[cursor['method']]
+    try:
+        items, cursor = await buscar_pagina(context, cursor['method'], cursor['params'], cursor['page'], cursor['index'],
+                                            cursor.get('seen_names', ()))
+    except (KeyError, ApiException) as e:
+        logging.error(f"{type(e).__name__}: {e}")
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="Ocurrió un error al procesar la búsqueda ⚠️. Prueba una búsqueda diferente.")
+        return
+
+    return await generate_buttons(items, callback_prefix, query, context, item_type, include_follow=include_follow, next_page=cursor is not None)
+
+async def generate_buttons(items, callback_prefix, update, context, item_type, chat_id=None, include_follow=False, next_page=False):
     keyboard = []
     seen_items = set()
 
@@ -252,18 +560,7 @@ async def generate_buttons(items, callback_prefix, update, context, item_type, c
             continue
         seen_items.add(item_name)
 
-        item_id_hash = hashlib.sha1(str(item_id).encode()).hexdigest()
-
-        # Check byte length and truncate if necessary
-        base_length = len(f"{callback_prefix}_{item_id_hash}_".encode('utf-8'))
-        if base_length + len(item_name.encode('utf-8')) > 64:
-            remaining_space = 64 - base_length
-            i = 0
-            while len(item_name[:i].encode('utf-8')) <= remaining_space:
-                i += 1
-            item_name = item_name[:i-1]
-
-        buttons_row = [InlineKeyboardButton(item_name, callback_data=f"{callback_prefix}_{item_id_hash}_{item_name}")]
+        buttons_row = [InlineKeyboardButton(item_name, callback_data=callback_codec.encode(callback_prefix, item_id, item_name))]
 
         if include_follow:
             if item_id in followed_items:
@@ -273,14 +570,16 @@ async def generate_buttons(items, callback_prefix, update, context, item_type, c
                 heart_emoji = "♡"
                 action = FOLLOW
 
-            buttons_row.append(InlineKeyboardButton(heart_emoji, callback_data=f"{action}_{item_id}_{item_name}"))
+            buttons_row.append(InlineKeyboardButton(heart_emoji, callback_data=callback_codec.encode(action, item_id, item_name)))
 
         keyboard.append(buttons_row)
 
-        if len(seen_items) >= 20:
+        if len(seen_items) >= MAX_BUTTONS:
             break
 
-    keyboard.append([InlineKeyboardButton("<-- Volver", callback_data=str(START_OVER))])
+    if next_page:
+        keyboard.append([InlineKeyboardButton("Siguiente página -->", callback_data=str(NEXT_PAGE))])
+    keyboard.append([BOTON_VOLVER])
 
     reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -302,8 +601,7 @@ async def showCreators(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    keyboard = [[InlineKeyboardButton("<-- Volver", callback_data=str(START_OVER))]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = TECLADO_VOLVER
 
     await context.bot.send_message(chat_id=update.effective_chat.id, text='<b>Creadores de este proyecto:</b>\n👤 Felipe Alcázar Gómez\n👤 Alonso Crespo Fernández\n👤 Marcos Isabel Lumbreras\n\n<i>*Este bot ha sido creado mediante la libreria Ticketpy de python para la asignatura de Integración de Sistemas Informáticos (Universidad De Castilla La Mancha).</i>', reply_markup=reply_markup, parse_mode='HTML')
     return END_ROUTES
@@ -311,69 +609,504 @@ async def showCreators(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def end(update: Update, context: ContextTypes.DEFAULT_TYPE):
     pass
 
-async def detectar_nuevos_eventos(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    followed_artists = context.user_data.get('followed_artists')
-    events = context.user_data.get('events', [])
-    for artist_id, artist_name in followed_artists.items():
-        current_events = tm_client.events.find(attraction_id=artist_id, source=["ticketmaster", "frontgate", "tmr"]).all()
+async def configurar_zona(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/zona [zona]: muestra o cambia la zona horaria (nombre IANA) en la que se calcula la hora de las notificaciones."""
+    if not context.args:
+        zona, hora = preferencia_notificacion(update.effective_user.id, context.user_data)
+        await update.message.reply_text(f"Recibes las notificaciones a las {hora:%H:%M} ({zona.zone}).\n"
+                                        "Para cambiar la zona horaria: /zona Europe/Madrid")
+        return
+    try:
+        zona = pytz.timezone(context.args[0])
+    except pytz.UnknownTimeZoneError:
+        await update.message.reply_text(f"No conozco la zona horaria {context.args[0]}. "
+                                        "Usa un nombre como Europe/Madrid o America/Mexico_City.")
+        return
+    context.user_data['zona_horaria'] = zona.zone
+    _, hora = preferencia_notificacion(update.effective_user.id, context.user_data)
+    await update.message.reply_text(f"Zona horaria guardada: {zona.zone}. Recibirás las notificaciones a las {hora:%H:%M}.")
+
+async def configurar_hora(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/hora [HH:MM]: muestra o cambia la hora local a la que se notifican los eventos nuevos."""
+    if not context.args:
+        zona, hora = preferencia_notificacion(update.effective_user.id, context.user_data)
+        await update.message.reply_text(f"Recibes las notificaciones a las {hora:%H:%M} ({zona.zone}).\n"
+                                        "Para cambiar la hora: /hora 20:30")
+        return
+    try:
+        hora = datetime.datetime.strptime(context.args[0], '%H:%M').time()
+    except ValueError:
+        await update.message.reply_text("Indica la hora en formato HH:MM, por ejemplo /hora 20:30.")
+        return
+    context.user_data['hora_notificacion'] = f"{hora:%H:%M}"
+    zona, _ = preferencia_notificacion(update.effective_user.id, context.user_data)
+    await update.message.reply_text(f"Hora guardada: recibirás las notificaciones a las {hora:%H:%M} ({zona.zone}).")
+
+def indice_suscriptores(users):
+    """Devuelve el índice inverso artist_id -> {user_id} a partir de los datos de los usuarios."""
+    suscriptores = {}
+    for user_id, user_data in users.items():
+        for artist_id in user_data.get('followed_artists') or {}:
+            suscriptores.setdefault(artist_id, set()).add(user_id)
+    return suscriptores
+
+async def buscar_eventos_artistas(artist_ids, ritmo=None):
+    """
+    Consulta los eventos de cada artista una sola vez, con como mucho MAX_ARTISTAS_CONCURRENTES consultas a la vez.
+
+    Con ritmo (un PriorityBucket), cada petición a Ticketmaster, una por página de resultados, espera antes su
+    turno. Devuelve artist_id -> eventos; los artistas cuya consulta falla no aparecen.
+    """
+    semaphore = asyncio.Semaphore(MAX_ARTISTAS_CONCURRENTES)
+    # Solo eventos desde hoy (los pasados ya no se notifican), en páginas del tamaño máximo
+    desde = datetime.datetime.now(pytz.utc).strftime('%Y-%m-%dT00:00:00Z')
+
+    async def buscar(artist_id):
+        async with semaphore:
+            try:
+                return artist_id, await tm_client.search('events', priority=PRIORITY_BULK, pace=ritmo, attraction_id=artist_id, source=["ticketmaster", "frontgate", "tmr"],
+                                                         start_date_time=desde, size=TAMANO_PAGINA_REVISION)
+            except (KeyError, ApiException) as e:
+                logging.error(f"{type(e).__name__}: {e}")
+                return artist_id, None
+
+    resultados = await asyncio.gather(*(buscar(artist_id) for artist_id in artist_ids))
+    return {artist_id: events for artist_id, events in resultados if events is not None}
+
+def caducidad_evento(event, ahora):
+    """Momento (epoch) a partir del cual un evento ya celebrado puede olvidarse."""
+    if event.utc_datetime:
+        return event.utc_datetime.replace(tzinfo=pytz.utc).timestamp() + MARGEN_CADUCIDAD
+    try:
+        fecha = datetime.datetime.strptime(event.local_start_date, '%Y-%m-%d').replace(tzinfo=pytz.utc)
+        return fecha.timestamp() + 2 * MARGEN_CADUCIDAD
+    except (TypeError, ValueError):
+        return ahora + 365 * MARGEN_CADUCIDAD
+
+def registrar_eventos(vistos, current_events, ahora):
+    """
+    Actualiza la instantánea compartida de los eventos de un artista (event_id -> EventSnapshot).
+
+    Los eventos nuevos se anotan con la fecha de esta revisión, los que cambian de estado, precio o fecha
+    anotan la fecha del cambio y se olvidan los que ya caducaron. Devuelve los ids nuevos y los cambiados.
+    """
+    return diff_events(vistos, current_events, ahora, caducidad_evento)
+
+def describir_cambios(cambios):
+    return ", ".join(DESCRIPCION_CAMBIOS[campo] for campo in cambios)
+
+async def detectar_nuevos_eventos(context: ContextTypes.DEFAULT_TYPE, chat_id, user_data, eventos_por_artista, eventos_vistos, ultimos_cambios=None, ritmo=None, estado=None):
+    """
+    Envía al usuario, en un solo lote, los eventos nuevos o cambiados de sus artistas que todavía no se le han notificado.
+
+    Cada usuario tiene por artista la marca 'vistos_hasta' (en estado, o en user_data si no se da): la fecha del
+    último cambio de la instantánea compartida que ya se le notificó. Un evento es nuevo para él si se vio por
+    primera vez después de su marca, y ha cambiado si su estado, precio o fecha cambió después. Los artistas cuyo
+    último cambio (ultimos_cambios, o calculado si no se da) no pasa de la marca no se revisan. ritmo se pasa a
+    enviar_eventos_nuevos.
+    """
+    marcas = (user_data if estado is None else estado).setdefault('vistos_hasta', {})
+    marcas_nuevas = {}
+    nuevos = []
+    # Usuarios anteriores al índice: lista con los ids ya notificados, solo para los artistas aún sin marca
+    legacy_events = set(user_data.get('events') or ())
+    for artist_id, artist_name in (user_data.get('followed_artists') or {}).items():
+        current_events = eventos_por_artista.get(artist_id)
+        if not current_events:
+            continue
+        vistos = eventos_vistos[artist_id]
+        marca = marcas.get(artist_id)
+        ultimo = ultimos_cambios[artist_id] if ultimos_cambios is not None else last_change(vistos)
+        if marca is not None and ultimo <= marca:
+            continue
         for event in current_events:
-            if event.id not in events:
-                event_info = f"<b><i>{event.name}</i></b>\n\n"
-            
-                if event.status.lower() == 'onsale':
-                    event_info += f"🟢 <b>EN VENTA</b>\n"
-                else:
-                    event_info += f"🟠 <b>{event.status.upper()}</b>\n"
-
-                if event.price_ranges:
-                    min_price = event.price_ranges[0]['min']
-                    max_price = event.price_ranges[0]['max']
-                    event_info += f"Desde <b>{min_price}€</b> hasta <b>{max_price}€</b>\n\n"
-                else:
-                    event_info += "\n"
-
-                try:
-                    if event.utc_datetime:
-                        utc_datetime = event.utc_datetime.replace(tzinfo=pytz.utc)
-                        spain_datetime = utc_datetime.astimezone(pytz.timezone('Europe/Madrid'))
-                    elif event.local_datetime:
-                        spain_datetime = event.local_datetime
-                    spain_date_str = spain_datetime.strftime('%d-%m-%Y')
-                    spain_time_str = spain_datetime.strftime('%H:%M')
-                except AttributeError:
-                    spain_date_str = 'No disponible'
-                    spain_time_str = 'No disponible'
-
-                event_info += f"<b>Fecha (España):</b> {spain_date_str}\n"
-                event_info += f"<b>Hora (España):</b> {spain_time_str}\n"
-                event_info += f"<b>Lugar:</b> {', '.join([f'{venue.name}, {venue.city}' for venue in event.venues])}\n\n"
-
-                try:
-                    url = event.json['url']
-                except KeyError:
-                    url = 'No disponible'
-
-                event_info += "<b>Link:</b> <a href='" + url + "'>" + url + "</a>\n"
-
-                images = event.json['images']
-                main_image = images[0]['url']
-                await context.bot.send_message(chat_id=update.effective_chat.id, text=f"🎫 Evento nuevo de {artist_name}", disable_notification=False)
-                await context.bot.send_photo(chat_id=update.effective_chat.id, photo=main_image, caption=event_info, parse_mode='HTML', disable_notification=False)
-                events.append(event.id)
-    context.user_data['events'] = events
-
-async def notificar_nuevos_eventos(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            entrada = vistos[event.id]
+            if marca is None and event.id in legacy_events:
+                continue
+            if marca is None or entrada.first_seen > marca:
+                cambios = ()
+            elif entrada.changed > marca:
+                cambios = entrada.changes
+            else:
+                continue
+            event_info, main_image = renderizar_evento(event)
+            nuevos.append((artist_name, event.name, event_info, main_image, cambios))
+        marcas_nuevas[artist_id] = max(vistos[event.id].changed for event in current_events)
+
+    await enviar_eventos_nuevos(context, chat_id, nuevos, ritmo)
+    cambiados = sum(1 for *_, cambios in nuevos if cambios)
+    EVENTOS_NOTIFICADOS.inc(len(nuevos) - cambiados, kind='new')
+    EVENTOS_NOTIFICADOS.inc(cambiados, kind='changed')
+    marcas.update(marcas_nuevas)
+
+async def enviar_eventos_nuevos(context: ContextTypes.DEFAULT_TYPE, chat_id, nuevos, ritmo=None):
+    """
+    Envía los eventos nuevos o cambiados de un usuario con las mínimas llamadas posibles y prioridad baja.
+
+    Un único evento va en una foto con su información; varios, en un mensaje resumen seguido
+    de álbumes de hasta MAX_ALBUM fotos. Los eventos sin imagen van en mensajes de texto.
+    Con ritmo (un PriorityBucket), cada envío espera antes su turno.
+    """
+    if not nuevos:
+        return
+
+    async def turno():
+        if ritmo is not None:
+            await ritmo.acquire(PRIORITY_BULK)
+
+    if len(nuevos) == 1:
+        artist_name, _, event_info, main_image, cambios = nuevos[0]
+        if cambios:
+            titulo = f"🔄 Cambios en un evento de {html.escape(artist_name)}: {describir_cambios(cambios)}"
+        else:
+            titulo = f"🎫 Evento nuevo de {html.escape(artist_name)}"
+        await turno()
+        if main_image is None:
+            await context.bot.send_message(chat_id=chat_id, text=f"{titulo}\n\n{event_info}", parse_mode='HTML', disable_notification=False, rate_limit_args=PRIORITY_BULK)
+            return
+        await context.bot.send_photo(chat_id=chat_id, photo=main_image, caption=f"{titulo}\n\n{event_info}", parse_mode='HTML', disable_notification=False, rate_limit_args=PRIORITY_BULK)
+        return
+
+    lineas = [f"• {html.escape(artist_name)}: {html.escape(event_name)}"
+              + (f" ({describir_cambios(cambios)})" if cambios else "")
+              for artist_name, event_name, _, _, cambios in nuevos[:MAX_LINEAS_RESUMEN]]
+    if len(nuevos) > MAX_LINEAS_RESUMEN:
+        lineas.append(f"… y {len(nuevos) - MAX_LINEAS_RESUMEN} más")
+    cambiados = sum(1 for *_, cambios in nuevos if cambios)
+    partes = []
+    if len(nuevos) > cambiados:
+        partes.append(f"{len(nuevos) - cambiados} eventos nuevos" if len(nuevos) - cambiados > 1 else "1 evento nuevo")
+    if cambiados:
+        partes.append(f"{cambiados} eventos con cambios" if cambiados > 1 else "1 evento con cambios")
+    resumen = f"🎫 <b>{' y '.join(partes)}</b> de artistas que sigues:\n\n" + "\n".join(lineas)
+    await turno()
+    await context.bot.send_message(chat_id=chat_id, text=resumen, parse_mode='HTML', disable_notification=False, rate_limit_args=PRIORITY_BULK)
+
+    con_imagen = [nuevo for nuevo in nuevos if nuevo[3] is not None]
+    for inicio in range(0, len(con_imagen), MAX_ALBUM):
+        album = con_imagen[inicio:inicio + MAX_ALBUM]
+        await turno()
+        if len(album) == 1:
+            _, _, event_info, main_image, _ = album[0]
+            await context.bot.send_photo(chat_id=chat_id, photo=main_image, caption=event_info, parse_mode='HTML', disable_notification=True, rate_limit_args=PRIORITY_BULK)
+        else:
+            media = [InputMediaPhoto(media=main_image, caption=event_info, parse_mode='HTML') for _, _, event_info, main_image, _ in album]
+            await context.bot.send_media_group(chat_id=chat_id, media=media, disable_notification=True, rate_limit_args=PRIORITY_BULK)
+
+    fichas = [event_info for _, _, event_info, main_image, _ in nuevos if main_image is None]
+    while fichas:
+        texto = fichas.pop(0)
+        while fichas and len(texto) + 1 + len(fichas[0]) <= MAX_TEXTO:
+            texto += "\n" + fichas.pop(0)
+        await turno()
+        await context.bot.send_message(chat_id=chat_id, text=texto, parse_mode='HTML', disable_notification=True, rate_limit_args=PRIORITY_BULK)
+
+def varios_procesos(application):
+    return isinstance(application.update_processor, ShardedUpdateProcessor)
+
+async def cargar_usuarios(application):
+    """
+    Devuelve los datos de todos los usuarios, incluidos los que se registraron en otros procesos del bot.
+
+    Con un solo proceso todos están ya en memoria. Con varios, solo se leen de la base de datos las filas que
+    otros procesos han escrito desde la última vez: cada una la escribe solo el proceso que atiende al usuario,
+    así que sustituye a la copia en memoria.
+    """
+    persistence = application.persistence
+    if varios_procesos(application) and persistence is not None and persistence.store_data.user_data:
+        for user_id, data in (await persistence.get_user_data_changes()).items():
+            user_data = application.user_data[user_id]
+            user_data.clear()
+            user_data.update(data)
+    return dict(application.user_data)
+
+def preferencia_notificacion(user_id, user_data):
+    """
+    Zona horaria (pytz) y hora local (datetime.time) a las que el usuario recibe las notificaciones.
+
+    Quien no ha elegido hora con /hora tiene una fija entre HORA_NOTIFICACION y REPARTO_NOTIFICACION minutos
+    después, calculada a partir de su id, para que no se revise a todos los usuarios a la vez.
+    """
+    try:
+        zona = pytz.timezone(user_data.get('zona_horaria') or ZONA_NOTIFICACION)
+    except pytz.UnknownTimeZoneError:
+        zona = pytz.timezone(ZONA_NOTIFICACION)
+    hora = user_data.get('hora_notificacion')
+    if hora:
+        return zona, datetime.datetime.strptime(hora, '%H:%M').time()
+    franjas = max(1, REPARTO_NOTIFICACION // MINUTOS_FRANJA)
+    minutos = HORA_NOTIFICACION[0] * 60 + HORA_NOTIFICACION[1] + zlib.crc32(str(user_id).encode()) % franjas * MINUTOS_FRANJA
+    return zona, datetime.time(minutos // 60 % 24, minutos % 60)
+
+def estado_notificacion(user_id, user_data):
+    """Lo que la revisión guarda del usuario en estados_notificacion; los usuarios anteriores tenían sus marcas en user_data."""
+    estado = estados_notificacion.get(user_id)
+    if estado is None:
+        estado = estados_notificacion[user_id] = {'vistos_hasta': dict(user_data.get('vistos_hasta') or {})}
+    return estado
+
+def usuarios_pendientes(users, estados, ahora):
+    """
+    Usuarios que siguen a algún artista y aún no han recibido la notificación de la última vez que pasó su hora local.
+
+    Esa vez es hoy o, si hoy aún no ha llegado, ayer: así una hora entre la última franja del día y medianoche
+    se atiende en la primera franja del día siguiente. estados es estados_notificacion, con la fecha local de la
+    última notificación de cada usuario.
+
+    Devuelve una lista de (momento en que les tocaba, user_id, fecha local de ese momento), de la más antigua a la más reciente.
+    """
+    pendientes = []
+    for user_id, user_data in users.items():
+        if not user_data.get('followed_artists'):
+            continue
+        zona, hora = preferencia_notificacion(user_id, user_data)
+        dia = ahora.astimezone(zona).date()
+        vence = zona.localize(datetime.datetime.combine(dia, hora))
+        if vence > ahora:
+            dia -= datetime.timedelta(days=1)
+            vence = zona.localize(datetime.datetime.combine(dia, hora))
+        if estados.get(user_id, {}).get('ultima_notificacion', '') < dia.isoformat():
+            pendientes.append((vence, user_id, dia.isoformat()))
+    pendientes.sort(key=lambda pendiente: pendiente[0])
+    return pendientes
+
+def repartir_franja(pendientes, users, disponibles, max_peticiones, max_envios, paginas=None):
+    """
+    Elige, por orden de llegada, los usuarios pendientes que caben en esta franja; los demás esperan a la siguiente.
+
+    Cada usuario cuesta, por cada artista suyo que no está en disponibles ni lo busca ya otro usuario elegido,
+    tantas peticiones a Ticketmaster como páginas de eventos se esperan de él (paginas, función artist_id -> páginas;
+    una si no se da), y un envío. Siempre se elige al menos uno. Devuelve los elegidos y los artistas a buscar.
+    """
+    elegidos = []
+    por_buscar = set()
+    peticiones = 0
+    for pendiente in pendientes:
+        artistas = set(users[pendiente[1]].get('followed_artists') or ()) - disponibles - por_buscar
+        coste = len(artistas) if paginas is None else sum(paginas(artist_id) for artist_id in artistas)
+        if elegidos and (peticiones + coste > max_peticiones or len(elegidos) >= max_envios):
+            break
+        elegidos.append(pendiente)
+        por_buscar |= artistas
+        peticiones += coste
+    return elegidos, por_buscar
+
+def paginas_previstas(artist_id):
+    """Páginas de eventos que se esperan de un artista en la revisión, según los que tenía en la última."""
+    return max(1, -(-len(eventos_vistos.get(artist_id) or ()) // TAMANO_PAGINA_REVISION))
+
+def ritmo_por_minuto(por_minuto):
+    """PriorityBucket que reparte por_minuto turnos a lo largo de cada minuto (con ráfagas de una décima parte)."""
+    return PriorityBucket(TokenBucket(por_minuto / 60, max(1, por_minuto // 10)))
+
+async def renovar_lease(persistence, revision):
+    """Renueva el lease 'notificaciones' mientras dura la revisión y la cancela si otro proceso se lo ha quedado."""
     while True:
-        now = datetime.datetime.now()
-        target_time = datetime.datetime.combine(now, datetime.time(*HORA_NOTIFICACION))
-        if target_time < now:
-            target_time += datetime.timedelta(days=1)
-        await asyncio.sleep((target_time - now).total_seconds())
-        await detectar_nuevos_eventos(update, context)
-          
-def main():
-    persistence = PicklePersistence(filepath='conversationbot.pickle')
-    application = ApplicationBuilder().token(telegram_token).persistence(persistence).build()
+        await asyncio.sleep(DURACION_LEASE / 2)
+        if not await persistence.acquire_lease('notificaciones', WORKER_ID, DURACION_LEASE):
+            logger.warning("Otro proceso tiene ahora el lease de las notificaciones, se detiene la revisión")
+            revision.cancel()
+            return
+
+async def notificar_nuevos_eventos(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Tarea de cada franja: busca eventos nuevos para los usuarios a los que ya les toca la notificación de hoy.
+
+    Si la base de datos es compartida por varios procesos, solo la ejecuta el que obtiene el lease 'notificaciones',
+    que se renueva mientras dura la revisión. Si el lease se pierde, la revisión se detiene: lo ya notificado
+    está guardado usuario a usuario.
+    """
+    application = context.application
+    persistence = application.persistence
+    lease = isinstance(persistence, SQLitePersistence)
+    if not lease:
+        await medir_revision(context)
+        return
+    if not await persistence.acquire_lease('notificaciones', WORKER_ID, DURACION_LEASE):
+        logger.info("Otro proceso está revisando los eventos nuevos")
+        return
+    try:
+        revision = asyncio.create_task(medir_revision(context, persistence))
+        renovacion = asyncio.create_task(renovar_lease(persistence, revision))
+        try:
+            await revision
+        except asyncio.CancelledError:
+            if not renovacion.done():
+                raise
+        finally:
+            renovacion.cancel()
+    finally:
+        await persistence.release_lease('notificaciones', WORKER_ID)
+
+async def medir_revision(context: ContextTypes.DEFAULT_TYPE, persistence=None):
+    """
+    Ejecuta revisar_eventos_nuevos midiendo su duración.
+
+    Si la variable de entorno PERFIL_REVISION indica un fichero, la revisión se perfila por muestreo y las pilas
+    se guardan en ese fichero en formato 'folded' (el que leen las herramientas de flame graphs).
+    """
+    ruta_perfil = os.getenv('PERFIL_REVISION')
+    profiler = SamplingProfiler().start() if ruta_perfil else None
+    try:
+        with DURACION_REVISION.time():
+            await revisar_eventos_nuevos(context, persistence)
+    finally:
+        if profiler is not None:
+            profiler.stop().save(ruta_perfil)
+            logger.info("Perfil de la revisión diaria guardado en %s", ruta_perfil)
+
+async def revisar_eventos_nuevos(context: ContextTypes.DEFAULT_TYPE, persistence=None):
+    """
+    Revisión de una franja de notificar_nuevos_eventos.
+
+    Solo se revisa a los usuarios cuya hora de notificación ya pasó hoy, hasta llenar el cupo de la franja
+    (MAX_PETICIONES_MINUTO peticiones a Ticketmaster, una por página, y MAX_ENVIOS_MINUTO envíos por minuto, configurables con
+    variables de entorno del mismo nombre); los demás quedan para la siguiente. Los eventos de un artista se
+    reutilizan durante FRESCURA_EVENTOS segundos. Con persistence, los datos de cada usuario se releen antes de revisarlo
+    y su estado en estados_notificacion se guarda en cuanto se le notifica, sin tocar sus datos; de eventos_vistos
+    solo se guardan los artistas que cambian.
+    """
+    application = context.application
+    if persistence is not None and (varios_procesos(application) or not estados_notificacion):
+        # Lo escribe solo quien tiene el lease, que puede haber sido otro proceso en una franja anterior
+        estados_notificacion.update(await persistence.get_job_user_data_changes('notificaciones'))
+    if persistence is not None and (varios_procesos(application) or not eventos_vistos):
+        eventos_vistos.update(await persistence.get_job_data_changes('eventos_vistos'))
+    # Las versiones anteriores guardaban la instantánea en bot_data
+    anterior = application.bot_data.pop('eventos_vistos', None)
+    if anterior and not eventos_vistos:
+        eventos_vistos.update(anterior)
+        if persistence is not None:
+            await persistence.update_job_data('eventos_vistos', anterior)
+    max_peticiones = int(os.getenv('MAX_PETICIONES_MINUTO', MAX_PETICIONES_MINUTO))
+    max_envios = int(os.getenv('MAX_ENVIOS_MINUTO', MAX_ENVIOS_MINUTO))
+    users = await cargar_usuarios(application)
+    suscriptores = indice_suscriptores(users)
+    sin_suscriptores = [artist_id for artist_id in eventos_vistos if artist_id not in suscriptores]
+    for artist_id in sin_suscriptores:
+        del eventos_vistos[artist_id]
+    if persistence is not None and sin_suscriptores:
+        await persistence.drop_job_data('eventos_vistos', sin_suscriptores)
+    reloj = time.monotonic()
+    for artist_id in [artist_id for artist_id, (consultado, _) in eventos_recientes.items()
+                      if reloj - consultado > FRESCURA_EVENTOS or artist_id not in eventos_vistos]:
+        del eventos_recientes[artist_id]
+
+    pendientes = usuarios_pendientes(users, estados_notificacion, datetime.datetime.now(pytz.utc))
+    elegidos, por_buscar = repartir_franja(pendientes, users, set(eventos_recientes),
+                                           max_peticiones * MINUTOS_FRANJA, max_envios * MINUTOS_FRANJA, paginas_previstas)
+    USUARIOS_PENDIENTES.set(len(pendientes) - len(elegidos))
+    if len(elegidos) < len(pendientes):
+        logger.info("%s usuarios pendientes de notificar pasan a la siguiente franja", len(pendientes) - len(elegidos))
+    if not elegidos:
+        return
+
+    ahora = time.time()
+    cambiados = {}
+    for artist_id, current_events in (await buscar_eventos_artistas(por_buscar, ritmo_por_minuto(max_peticiones))).items():
+        vistos = eventos_vistos.setdefault(artist_id, {})
+        antes = dict(vistos)
+        registrar_eventos(vistos, current_events, ahora)
+        if vistos != antes:
+            cambiados[artist_id] = vistos
+        eventos_recientes[artist_id] = (time.monotonic(), current_events)
+    if persistence is not None and cambiados:
+        # Antes de notificar a nadie: las marcas de los usuarios no deben ir por delante de la instantánea guardada
+        await persistence.update_job_data('eventos_vistos', cambiados)
+    eventos_por_artista = {artist_id: events for artist_id, (_, events) in eventos_recientes.items()}
+    ultimos_cambios = {artist_id: last_change(eventos_vistos[artist_id]) for artist_id in eventos_por_artista}
+
+    ritmo_envios = ritmo_por_minuto(max_envios)
+    for _, user_id, hoy in elegidos:
+        user_data = users[user_id]
+        if persistence is not None:
+            # El proceso que atiende al usuario puede haber cambiado sus artistas
+            await persistence.refresh_user_data(user_id, user_data)
+        artistas = user_data.get('followed_artists') or {}
+        if artistas and not any(artist_id in eventos_por_artista for artist_id in artistas):
+            # Ticketmaster no respondió para ninguno de sus artistas (circuito abierto, cuota agotada...):
+            # sigue pendiente para la siguiente franja
+            continue
+        estado = estado_notificacion(user_id, user_data)
+        marcas = estado.setdefault('vistos_hasta', {})
+        for artist_id in [artist_id for artist_id in marcas if artist_id not in artistas]:
+            del marcas[artist_id]
+        try:
+            await detectar_nuevos_eventos(context, user_data.get('chat_id', user_id), user_data, eventos_por_artista,
+                                          eventos_vistos, ultimos_cambios, ritmo_envios, estado)
+        except TelegramError as e:
+            logger.warning("No se pudo notificar al usuario %s: %s", user_id, e)
+        except Exception:
+            # Un evento con datos inesperados no debe detener la franja para los demás usuarios ni repetirse en cada franja
+            logger.exception("Error al notificar al usuario %s", user_id)
+        estado['ultima_notificacion'] = hoy
+        if persistence is not None:
+            await persistence.update_job_user_data('notificaciones', user_id, estado)
+
+async def programar_notificaciones(application):
+    """
+    Registra en la JobQueue de la aplicación la tarea de notificaciones, que se ejecuta cada MINUTOS_FRANJA minutos.
+
+    Se registra una sola vez por proceso, al arrancar, así que es independiente de cuántas veces se use /start.
+    Las franjas empiezan en múltiplos de MINUTOS_FRANJA; los usuarios cuya hora pasó con el bot parado se
+    revisan en la primera.
+    """
+    if application.job_queue.get_jobs_by_name('notificaciones'):
+        return
+    intervalo = MINUTOS_FRANJA * 60
+    application.job_queue.run_repeating(notificar_nuevos_eventos, interval=intervalo,
+                                        first=intervalo - time.time() % intervalo, name='notificaciones')
+
+async def iniciar_servicios(application, metrics_port=None):
+    """post_init: programa las notificaciones y, con metrics_port, sirve las métricas en /metrics."""
+    global servidor_metricas
+    await programar_notificaciones(application)
+    if metrics_port:
+        servidor_metricas = start_metrics_server(metrics_port, os.getenv('METRICS_LISTEN', '127.0.0.1'))
+
+async def cerrar_clientes(application):
+    global servidor_metricas
+    if getattr(tm_client, 'creado', True):
+        await tm_client.aclose()
+        if tm_client.index is not None:
+            tm_client.index.close()
+    if servidor_metricas is not None:
+        servidor_metricas.stop()
+        servidor_metricas = None
+
+def instrumentar(handler):
+    """Mide la duración y los errores del callback de un handler en las métricas bot_handler_*."""
+    callback = handler.callback
+    nombre = getattr(callback, 'func', callback).__name__
+    handler.callback = timed(DURACION_HANDLER, ERRORES_HANDLER, handler=nombre)(callback)
+    return handler
+
+def construir_aplicacion(token, persistence=None, base_url=None, max_concurrent_updates=MAX_UPDATES_CONCURRENTES,
+                         update_processor=None, rate_limiter=None, metrics_port=None):
+    """
+    Construye la aplicación con sus handlers, lista para run_polling o run_webhook.
+
+    Las actualizaciones se procesan en paralelo (como mucho max_concurrent_updates a la vez), pero las de una
+    misma conversación se atienden de una en una y en orden. Con varios procesos se pasa un
+    ShardedUpdateProcessor como update_processor. Si no se indica rate_limiter, los envíos se limitan
+    con TelegramRateLimiter. Con metrics_port, las métricas se sirven en ese puerto.
+    """
+    if update_processor is None:
+        update_processor = OrderedUpdateProcessor(max_concurrent_updates)
+    if rate_limiter is None:
+        rate_limiter = TelegramRateLimiter()
+    builder = (ApplicationBuilder().token(token)
+               .request(PeticionTelegram(connection_pool_size=256))
+               .get_updates_request(PeticionTelegram())
+               .concurrent_updates(update_processor)
+               .rate_limiter(rate_limiter)
+               .post_init(functools.partial(iniciar_servicios, metrics_port=metrics_port))
+               .post_shutdown(cerrar_clientes))
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    if base_url is not None:
+        builder = builder.base_url(base_url)
+    application = builder.build()
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('start', start)],
@@ -395,6 +1128,7 @@ def main():
                 CallbackQueryHandler(mostrar_info_evento, pattern="^" + str(EVENT_INFO)),
                 CallbackQueryHandler(functools.partial(seguir_dejar_seguir_artista, follow=True), pattern="^" + str(FOLLOW)),
                 CallbackQueryHandler(functools.partial(seguir_dejar_seguir_artista, follow=False), pattern="^" + str(UNFOLLOW)),
+                CallbackQueryHandler(siguiente_pagina, pattern="^" + str(NEXT_PAGE) + "$"),
                 CallbackQueryHandler(start_over, pattern="^" + str(START_OVER) + "$"),
                 CallbackQueryHandler(end, pattern="^" + str(END) + "$"),
             ]
@@ -402,9 +1136,68 @@ def main():
         fallbacks=[CommandHandler('start', start)]
     )
 
-    
+    for handlers in [conv_handler.entry_points, conv_handler.fallbacks, *conv_handler.states.values()]:
+        for handler in handlers:
+            instrumentar(handler)
+    # Fuera de la conversación y antes que ella, para que funcionen en cualquier estado
+    application.add_handler(instrumentar(CommandHandler('zona', configurar_zona)))
+    application.add_handler(instrumentar(CommandHandler('hora', configurar_hora)))
     application.add_handler(conv_handler)
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    application.add_handler(instrumentar(InlineQueryHandler(consulta_inline)))
+
+    REGISTRY.gauge_callback('bot_update_queue_size', "Updates received and not yet handled",
+                            application.update_queue.qsize)
+    if isinstance(rate_limiter, TelegramRateLimiter):
+        REGISTRY.gauge_callback('telegram_send_queue_size', "Requests waiting for the global Telegram rate limit",
+                                lambda: rate_limiter.overall.queued)
+    return application
+
+
+def main():
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    cargar_entorno()
+    telegram_token = variable_obligatoria('API_TELEGRAM_TOKEN')
+    # El cliente de Ticketmaster se crea al usarlo por primera vez, pero sin token no merece la pena arrancar
+    variable_obligatoria('API_TICKETMASTER_TOKEN')
+
+    max_concurrent_updates = int(os.getenv('MAX_UPDATES_CONCURRENTES', MAX_UPDATES_CONCURRENTES))
+    webhook_url = os.getenv('WEBHOOK_URL')
+    secret_token = os.getenv('WEBHOOK_SECRET')
+    # Modo multiproceso: WORKER_URLS lista el webhook interno de cada proceso y WORKER_INDEX indica cuál es este
+    worker_urls = [url.strip() for url in os.getenv('WORKER_URLS', '').split(',') if url.strip()]
+
+    update_processor = None
+    if worker_urls:
+        if not webhook_url:
+            raise ValueError('WORKER_URLS requires WEBHOOK_URL')
+        update_processor = ShardedUpdateProcessor(max_concurrent_updates, int(os.getenv('WORKER_INDEX', 0)),
+                                                  worker_urls, secret_token=secret_token)
+
+    # Con varios procesos también basta un volcado por minuto: la revisión de eventos guarda su estado por su cuenta
+    # y cada usuario lo atiende siempre el mismo proceso
+    persistence = SQLitePersistence(os.getenv('DATABASE_PATH', 'conversationbot.sqlite3'),
+                                    migrate_from='conversationbot.pickle', update_interval=60)
+    application = construir_aplicacion(telegram_token, persistence, max_concurrent_updates=max_concurrent_updates,
+                                       update_processor=update_processor,
+                                       metrics_port=int(os.getenv('METRICS_PORT', 0)) or None)
+
+    if webhook_url:
+        # Detrás de un balanceador: Telegram envía las actualizaciones a WEBHOOK_URL y el balanceador
+        # las reenvía a WEBHOOK_LISTEN:WEBHOOK_PORT
+        application.run_webhook(
+            listen=os.getenv('WEBHOOK_LISTEN', '0.0.0.0'),
+            port=int(os.getenv('WEBHOOK_PORT', 8443)),
+            url_path=os.getenv('WEBHOOK_PATH', ''),
+            webhook_url=webhook_url,
+            secret_token=secret_token,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
     
 
 if __name__ == '__main__':
@@ -0,0 +1,93 @@
+"""Compact ``callback_data`` encoding for inline keyboard buttons.
+
+Telegram limits ``callback_data`` to 64 bytes. Buttons carry
+``<prefix>_<id>_<name>``: Ticketmaster ids (short and alphanumeric) are
+embedded as they are, anything else is replaced by a short token that the bot
+maps back to the id in memory, and the name is cut to the bytes left.
+"""
+import hashlib
+import string
+import time
+from collections import OrderedDict
+
+CALLBACK_DATA_LIMIT = 64
+TOKEN_LENGTH = 16
+TOKEN_MARK = '~'
+#: Ids up to this length made of ``ID_CHARS`` are embedded verbatim
+MAX_RAW_ID_LENGTH = 24
+ID_CHARS = frozenset(string.ascii_letters + string.digits + '-.')
+
+
+def truncate_utf8(text, max_bytes):
+    """Longest prefix of ``text`` whose UTF-8 encoding fits in ``max_bytes``, in linear time."""
+    encoded = text.encode('utf-8')
+    if len(encoded) <= max_bytes:
+        return text
+    # A multi-byte character cut in half is dropped by 'ignore'
+    return encoded[:max(max_bytes, 0)].decode('utf-8', 'ignore')
+
+
+class CallbackTokens:
+    """Server-side map from short callback tokens to the ids they stand for.
+
+    Tokens are derived from the id, so rendering the same item twice reuses
+    its entry. Entries expire after ``ttl`` seconds and the oldest ones are
+    dropped once ``maxsize`` is reached.
+    """
+
+    def __init__(self, ttl=24 * 60 * 60, maxsize=50000, clock=time.monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._clock = clock
+        self._ids = OrderedDict()
+
+    @staticmethod
+    def token_for(item_id):
+        return hashlib.sha1(str(item_id).encode()).hexdigest()[:TOKEN_LENGTH]
+
+    def register(self, item_id):
+        """Returns the token for ``item_id`` and (re)starts its expiry."""
+        token = self.token_for(item_id)
+        self._ids[token] = (self._clock() + self.ttl, item_id)
+        self._ids.move_to_end(token)
+        while len(self._ids) > self.maxsize:
+            self._ids.popitem(last=False)
+        return token
+
+    def resolve(self, token):
+        """Returns the id behind ``token`` or ``None`` if unknown or expired."""
+        entry = self._ids.get(token)
+        if entry is None:
+            return None
+        expires, item_id = entry
+        if expires <= self._clock():
+            del self._ids[token]
+            return None
+        return item_id
+
+
+class CallbackCodec:
+    """Encodes ``(prefix, id, name)`` into ``callback_data`` and back.
+
+    The result never exceeds ``CALLBACK_DATA_LIMIT`` bytes and ``decode``
+    returns the original id (``None`` if its token has expired).
+    """
+
+    def __init__(self, tokens=None):
+        self.tokens = tokens if tokens is not None else CallbackTokens()
+
+    def encode(self, prefix, item_id, name=''):
+        item_id = str(item_id)
+        if 0 < len(item_id) <= MAX_RAW_ID_LENGTH and ID_CHARS.issuperset(item_id):
+            id_field = item_id
+        else:
+            id_field = TOKEN_MARK + self.tokens.register(item_id)
+        head = f"{prefix}_{id_field}_"
+        return head + truncate_utf8(name, CALLBACK_DATA_LIMIT - len(head.encode('utf-8')))
+
+    def decode(self, data):
+        """Returns ``(prefix, item_id, name)``."""
+        prefix, id_field, name = (data.split('_', 2) + ['', ''])[:3]
+        if id_field.startswith(TOKEN_MARK):
+            return prefix, self.tokens.resolve(id_field[len(TOKEN_MARK):]), name
+        return prefix, id_field, name
@@ -0,0 +1,72 @@
+"""Incremental change detection for the events of followed artists.
+
+The daily scan keeps, per artist, a compact snapshot of every known event:
+when it was first seen, when it can be forgotten, a fingerprint of the fields
+users are notified about (status, price range and date) and when that
+fingerprint last changed. Comparing a fresh listing with the snapshot costs one
+tuple comparison per event, and ``last_change`` lets the per-user pass skip
+artists with nothing new without looking at their events.
+"""
+from collections import namedtuple
+
+#: Fingerprint fields, in order, as reported in ``EventSnapshot.changes``
+FIELDS = ('status', 'price', 'date')
+
+EventSnapshot = namedtuple('EventSnapshot', 'first_seen expires fingerprint changed changes')
+EventSnapshot.__doc__ = """What the scan remembers about one event.
+
+``changed`` is when the event was first seen or its fingerprint last changed
+and ``changes`` names the fields that changed then (empty for new events).
+"""
+
+
+def fingerprint(event):
+    """Tuple of the ``FIELDS`` of a ``ticketpy.model.Event``."""
+    price_range = (event.price_ranges[0].get('min'), event.price_ranges[0].get('max')) if event.price_ranges else None
+    return event.status, price_range, event.utc_datetime or event.local_start_date
+
+
+def _upgrade(entry):
+    """Converts ``(first_seen, expires)`` entries stored before fingerprints existed."""
+    if isinstance(entry, EventSnapshot):
+        return entry
+    first_seen, expires = entry[:2]
+    return EventSnapshot(first_seen, expires, None, first_seen, ())
+
+
+def diff_events(snapshot, events, now, expires_for):
+    """Brings ``snapshot`` (event id -> ``EventSnapshot``) up to date with a fresh listing.
+
+    Expired entries are dropped. An entry without a fingerprint (older format)
+    takes the current one without being reported as changed.
+
+    :param expires_for: ``expires_for(event, now)`` returns the epoch after which the event can be forgotten
+    :return: ``(new_ids, changed_ids)``
+    """
+    for event_id in [event_id for event_id, entry in snapshot.items() if _upgrade(entry).expires < now]:
+        del snapshot[event_id]
+
+    new_ids, changed_ids = [], []
+    for event in events:
+        current = fingerprint(event)
+        entry = snapshot.get(event.id)
+        if entry is None:
+            snapshot[event.id] = EventSnapshot(now, expires_for(event, now), current, now, ())
+            new_ids.append(event.id)
+            continue
+        entry = _upgrade(entry)
+        if entry.fingerprint == current:
+            snapshot[event.id] = entry
+        elif entry.fingerprint is None:
+            snapshot[event.id] = entry._replace(fingerprint=current)
+        else:
+            changes = tuple(field for field, old, new in zip(FIELDS, entry.fingerprint, current) if old != new)
+            snapshot[event.id] = entry._replace(expires=expires_for(event, now), fingerprint=current,
+                                                changed=now, changes=changes)
+            changed_ids.append(event.id)
+    return new_ids, changed_ids
+
+
+def last_change(snapshot):
+    """Latest ``changed`` stamp of an artist's snapshot, ``None`` if it is empty."""
+    return max((_upgrade(entry).changed for entry in snapshot.values()), default=None)
@@ -0,0 +1,178 @@
+"""Local stand-ins for the Telegram Bot API and the Ticketmaster Discovery API.
+
+Used by the integration tests and by ``benchmark.py`` to run the bot end to
+end without network access. Both servers answer every request after
+``latency`` seconds, so benchmarks can emulate slow upstreams.
+"""
+import asyncio
+import json
+import zlib
+
+import tornado.httpserver
+import tornado.netutil
+import tornado.web
+
+
+class _FakeServer:
+    """Runs a tornado application on a free local port."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.requests = 0
+        self.port = None
+        self._server = None
+
+    def routes(self):
+        raise NotImplementedError
+
+    def base_url(self):
+        raise NotImplementedError
+
+    async def start(self):
+        """Starts listening and returns the URL to use as the client's base URL."""
+        sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+        self.port = sockets[0].getsockname()[1]
+        self._server = tornado.httpserver.HTTPServer(tornado.web.Application(self.routes()))
+        self._server.add_sockets(sockets)
+        return self.base_url()
+
+    async def stop(self):
+        self._server.stop()
+        await self._server.close_all_connections()
+
+    async def delay(self):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+class FakeTelegram(_FakeServer):
+    """Answers the Bot API methods the bot uses and records every call.
+
+    ``calls`` holds ``(method, params)`` tuples in arrival order.
+    """
+
+    def __init__(self, latency=0.0, record=True):
+        super().__init__(latency)
+        self.record = record
+        self.calls = []
+        self._new_call = asyncio.Event()
+        self._message_ids = 0
+
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    def _message(self, params, **fields):
+        self._message_ids += 1
+        return {'message_id': self._message_ids, 'date': 0,
+                'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'}, **fields}
+
+    def result(self, method, params):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'BeatTracker', 'username': 'beattracker_bot'}
+        if method == 'sendPhoto':
+            return self._message(params, photo=[{'file_id': 'photo', 'file_unique_id': 'photo', 'width': 1, 'height': 1}])
+        if method == 'sendMediaGroup':
+            media = params.get('media') or []
+            if isinstance(media, str):
+                media = json.loads(media)
+            return [self._message(params) for _ in media]
+        if method.startswith('send') or method.startswith('edit'):
+            return self._message(params)
+        return True
+
+    def routes(self):
+        fake = self
+
+        class Handler(tornado.web.RequestHandler):
+            async def post(self, method):
+                await fake.delay()
+                if self.request.headers.get('Content-Type', '').startswith('application/json'):
+                    params = json.loads(self.request.body or b'{}')
+                else:
+                    params = {k: v[0].decode() for k, v in self.request.body_arguments.items()}
+                if fake.record:
+                    fake.calls.append((method, params))
+                    fake._new_call.set()
+                self.write({'ok': True, 'result': fake.result(method, params)})
+
+        return [(r"/bot[^/]+/(\w+)", Handler)]
+
+    async def wait_for(self, method, timeout=5):
+        """Waits until ``method`` has been called at least once."""
+        async def called():
+            while not any(m == method for m, _ in self.calls):
+                self._new_call.clear()
+                await self._new_call.wait()
+        await asyncio.wait_for(called(), timeout)
+
+
+class FakeTicketmaster(_FakeServer):
+    """Serves deterministic attractions and events for any search.
+
+    Every keyword or attraction id maps to ``catalog_size`` results, split in
+    pages of the requested ``size``; ids depend on the query, so different
+    searches do not hit the same cache entries.
+    """
+
+    def __init__(self, latency=0.0, catalog_size=60):
+        super().__init__(latency)
+        self.catalog_size = catalog_size
+
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/discovery/v2"
+
+    @staticmethod
+    def _seed(query):
+        return format(zlib.crc32(query.encode()), '08x')
+
+    @staticmethod
+    def attraction(attraction_id, name):
+        return {'id': attraction_id, 'name': name, 'url': f"https://example.com/{attraction_id}",
+                'classifications': [], 'images': []}
+
+    @staticmethod
+    def event(event_id, name, day=1):
+        return {
+            'id': event_id, 'name': name, 'url': f"https://example.com/{event_id}",
+            'dates': {'start': {'localDate': f"2030-01-{day:02d}", 'dateTime': f"2030-01-{day:02d}T20:00:00Z"},
+                      'status': {'code': 'onsale'}},
+            'priceRanges': [{'min': 20.0, 'max': 60.0}],
+            'images': [{'url': f"https://example.com/{event_id}.jpg"}],
+            '_embedded': {'venues': [{'name': 'Sala', 'city': {'name': 'Madrid'}}]},
+        }
+
+    def _page(self, kind, query, page, size):
+        seed = self._seed(query)
+        first = page * size
+        items = []
+        for n in range(first, min(first + size, self.catalog_size)):
+            item_id = f"{kind[0].upper()}{seed}{n:04d}"
+            name = f"{query} {n}"
+            items.append(self.attraction(item_id, name) if kind == 'attractions' else self.event(item_id, name, n % 28 + 1))
+        total_pages = -(-self.catalog_size // size)
+        body = {'page': {'number': page, 'size': size, 'totalPages': total_pages, 'totalElements': self.catalog_size}}
+        if items:
+            body['_embedded'] = {kind: items}
+        return body
+
+    def routes(self):
+        fake = self
+
+        class Search(tornado.web.RequestHandler):
+            async def get(self, kind):
+                await fake.delay()
+                query = self.get_argument('keyword', None) or self.get_argument('attractionId', '')
+                page = int(self.get_argument('page', 0))
+                size = int(self.get_argument('size', 20))
+                self.write(fake._page(kind, query, page, size))
+
+        class EventById(tornado.web.RequestHandler):
+            async def get(self, event_id):
+                await fake.delay()
+                self.write(fake.event(event_id, event_id))
+
+        return [
+            (r"/discovery/v2/(attractions|events)\.json", Search),
+            (r"/discovery/v2/events/([^/]+)\.json", EventById),
+        ]
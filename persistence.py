@@ -0,0 +1,357 @@
+"""SQLite persistence backend for python-telegram-bot.
+
+``PicklePersistence`` rewrites one pickle holding every user on each flush, so
+load time and writes grow with the user base. ``SQLitePersistence`` keeps one
+row per user/chat in a WAL-mode database and only rewrites the rows whose
+content actually changed.
+
+Several bot processes on the same host can share the same database. WAL mode
+relies on shared memory, so the file must be on a local disk: neither network
+filesystems nor processes on other machines are supported. Each row has a single
+writer: a user's row is only written by the process that owns the user, and
+what a job stores about a user lives in ``job_user_data``, written only by the
+process holding the job's lease. Other state of a job lives in ``job_data``,
+one row per key, written by the same process; it stays out of ``bot_data``,
+which every process rewrites whole. ``refresh_*`` re-reads rows that another
+process rewrote, ``get_*_changes`` returns only the rows rewritten by other
+processes since the last call (every write stamps its row with a version
+taken from a per-table counter), and leases let one process at a time run a job.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL,
+                                      version INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS chat_data (chat_id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS bot_data (id INTEGER PRIMARY KEY CHECK (id = 0), data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS callback_data (id INTEGER PRIMARY KEY CHECK (id = 0), data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS conversations (name TEXT NOT NULL, key TEXT NOT NULL, state BLOB NOT NULL,
+                                          PRIMARY KEY (name, key));
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS job_user_data (job TEXT NOT NULL, user_id INTEGER NOT NULL, data BLOB NOT NULL,
+                                          version INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (job, user_id));
+CREATE TABLE IF NOT EXISTS job_data (job TEXT NOT NULL, key TEXT NOT NULL, data BLOB NOT NULL,
+                                     version INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (job, key));
+"""
+
+#: Tables whose rows carry a ``version``, added to databases created before it existed
+VERSIONED_TABLES = ('user_data', 'job_user_data')
+
+INDEXES = """
+CREATE INDEX IF NOT EXISTS user_data_version ON user_data (version);
+CREATE INDEX IF NOT EXISTS job_user_data_version ON job_user_data (job, version);
+CREATE INDEX IF NOT EXISTS job_data_version ON job_data (job, version);
+"""
+
+
+class _PickleFileUnpickler(pickle.Unpickler):
+    """Reads ``PicklePersistence`` files, where bot instances are stored as persistent ids."""
+
+    def persistent_load(self, pid):
+        return None
+
+
+class SQLitePersistence(BasePersistence):
+    """``BasePersistence`` implementation storing one row per user and chat.
+
+    :param filepath: Path of the SQLite database
+    :param migrate_from: Optional ``PicklePersistence`` file imported once into an empty database
+    :param store_data: Which kinds of data to persist (default: all)
+    :param update_interval: Seconds between persistence updates (see ``BasePersistence``)
+    """
+
+    def __init__(self, filepath, migrate_from=None, store_data=None, update_interval=60):
+        super().__init__(store_data=store_data or PersistenceInput(), update_interval=update_interval)
+        self.filepath = filepath
+        self.migrate_from = migrate_from
+        self._connection = None
+        self._lock = threading.Lock()
+        # Digest of the last row written for every key, to skip unchanged writes
+        self._digests = {}
+        # ``PRAGMA data_version`` at which every key was last compared with the database
+        self._validated = {}
+        # First row version not read yet, per table (and job)
+        self._versions = {}
+
+    def _connect(self):
+        if self._connection is None:
+            connection = sqlite3.connect(self.filepath, check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            for table in VERSIONED_TABLES:
+                if 'version' not in {column[1] for column in connection.execute(f"PRAGMA table_info({table})")}:
+                    try:
+                        connection.execute(f"ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+                    except sqlite3.OperationalError:
+                        # Another worker starting at the same time added it first
+                        if 'version' not in {c[1] for c in connection.execute(f"PRAGMA table_info({table})")}:
+                            raise
+            connection.executescript(INDEXES)
+            self._connection = connection
+            if self.migrate_from:
+                self._migrate_pickle(self.migrate_from)
+        return self._connection
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._connect().execute(sql, params).fetchall()
+
+    async def _run(self, sql, params=()):
+        return await asyncio.to_thread(self._execute, sql, params)
+
+    async def _write(self, digest_key, sql, params, data):
+        """Writes ``data`` unless it is byte-for-byte what was last stored under ``digest_key``."""
+        blob = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        digest = hashlib.blake2b(blob, digest_size=16).digest()
+        if self._digests.get(digest_key) == digest:
+            return
+        await self._run(sql, (*params, blob))
+        self._digests[digest_key] = digest
+
+    def _reload(self, digest_key, sql, params):
+        """Returns the row's value if another connection rewrote it since we last saw it, else ``None``."""
+        with self._lock:
+            connection = self._connect()
+            # Only changes committed by other connections move data_version
+            version = connection.execute("PRAGMA data_version").fetchone()[0]
+            if self._validated.get(digest_key) == version:
+                return None
+            row = connection.execute(sql, params).fetchone()
+            self._validated[digest_key] = version
+        if row is None:
+            return None
+        digest = hashlib.blake2b(row[0], digest_size=16).digest()
+        if self._digests.get(digest_key) == digest:
+            return None
+        self._digests[digest_key] = digest
+        return pickle.loads(row[0])
+
+    async def _refresh(self, digest_key, sql, params, data):
+        fresh = await asyncio.to_thread(self._reload, digest_key, sql, params)
+        if fresh is not None:
+            data.clear()
+            data.update(fresh)
+
+    def _load(self, digest_key, blob):
+        self._digests[digest_key] = hashlib.blake2b(blob, digest_size=16).digest()
+        return pickle.loads(blob)
+
+    def _read_versioned(self, cursor_key, digest_key, sql, params, only_changed):
+        """Rows ``(id, blob, version)`` from ``version >= `` the cursor on, which then moves past them.
+
+        With ``only_changed``, rows identical to what this process last wrote or read are skipped unread.
+        """
+        with self._lock:
+            rows = self._connect().execute(sql, (*params, self._versions.get(cursor_key, 0))).fetchall()
+        result = {}
+        for item_id, blob, version in rows:
+            self._versions[cursor_key] = max(self._versions.get(cursor_key, 0), version + 1)
+            key = (*digest_key, item_id)
+            if only_changed and self._digests.get(key) == hashlib.blake2b(blob, digest_size=16).digest():
+                continue
+            result[item_id] = self._load(key, blob)
+        return result
+
+    def _migrate_pickle(self, path):
+        """Imports a ``PicklePersistence`` single-file pickle once, even when several workers start together."""
+        connection = self._connection
+        if connection.execute("SELECT 1 FROM meta WHERE key = 'migrated_from'").fetchone():
+            return
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as file:
+            data = _PickleFileUnpickler(file).load()
+
+        dumps = lambda value: pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with connection:
+            # Checks again holding the write lock: another worker may have migrated it meanwhile
+            connection.execute("BEGIN IMMEDIATE")
+            if connection.execute("SELECT 1 FROM meta WHERE key = 'migrated_from'").fetchone():
+                return
+            connection.executemany("INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+                                   [(k, dumps(v)) for k, v in (data.get('user_data') or {}).items()])
+            connection.executemany("INSERT OR REPLACE INTO chat_data VALUES (?, ?)",
+                                   [(k, dumps(v)) for k, v in (data.get('chat_data') or {}).items()])
+            if data.get('bot_data') is not None:
+                connection.execute("INSERT OR REPLACE INTO bot_data VALUES (0, ?)", (dumps(data['bot_data']),))
+            if data.get('callback_data') is not None:
+                connection.execute("INSERT OR REPLACE INTO callback_data VALUES (0, ?)", (dumps(data['callback_data']),))
+            for name, conversations in (data.get('conversations') or {}).items():
+                connection.executemany("INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)",
+                                       [(name, json.dumps(list(key)), dumps(state))
+                                        for key, state in conversations.items() if state is not None])
+            connection.execute("INSERT INTO meta VALUES ('migrated_from', ?)", (path,))
+        logger.info("Migrated %s into %s", path, self.filepath)
+
+    async def get_user_data(self):
+        self._versions.pop('user', None)
+        return await asyncio.to_thread(self._read_versioned, 'user', ('user',),
+                                       "SELECT user_id, data, version FROM user_data WHERE version >= ?", (), False)
+
+    async def get_user_data_changes(self):
+        """Users whose row another process wrote since the last ``get_user_data``/``get_user_data_changes``."""
+        return await asyncio.to_thread(self._read_versioned, 'user', ('user',),
+                                       "SELECT user_id, data, version FROM user_data WHERE version >= ?", (), True)
+
+    async def get_chat_data(self):
+        rows = await self._run("SELECT chat_id, data FROM chat_data")
+        return {chat_id: self._load(('chat', chat_id), blob) for chat_id, blob in rows}
+
+    async def get_bot_data(self):
+        rows = await self._run("SELECT data FROM bot_data WHERE id = 0")
+        return self._load(('bot',), rows[0][0]) if rows else {}
+
+    async def get_callback_data(self):
+        rows = await self._run("SELECT data FROM callback_data WHERE id = 0")
+        return self._load(('callback',), rows[0][0]) if rows else None
+
+    async def get_conversations(self, name):
+        rows = await self._run("SELECT key, state FROM conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(key)): self._load(('conversation', name, key), state) for key, state in rows}
+
+    async def update_user_data(self, user_id, data):
+        await self._write(('user', user_id), "INSERT OR REPLACE INTO user_data VALUES "
+                          "(?1, ?2, (SELECT COALESCE(MAX(version), 0) + 1 FROM user_data))", (user_id,), data)
+
+    async def update_chat_data(self, chat_id, data):
+        await self._write(('chat', chat_id), "INSERT OR REPLACE INTO chat_data VALUES (?, ?)", (chat_id,), data)
+
+    async def update_bot_data(self, data):
+        await self._write(('bot',), "INSERT OR REPLACE INTO bot_data VALUES (0, ?)", (), data)
+
+    async def update_callback_data(self, data):
+        await self._write(('callback',), "INSERT OR REPLACE INTO callback_data VALUES (0, ?)", (), data)
+
+    async def update_conversation(self, name, key, new_state):
+        key = json.dumps(list(key))
+        if new_state is None:
+            self._digests.pop(('conversation', name, key), None)
+            await self._run("DELETE FROM conversations WHERE name = ? AND key = ?", (name, key))
+            return
+        await self._write(('conversation', name, key), "INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)",
+                          (name, key), new_state)
+
+    async def drop_user_data(self, user_id):
+        self._digests.pop(('user', user_id), None)
+        self._validated.pop(('user', user_id), None)
+        await self._run("DELETE FROM user_data WHERE user_id = ?", (user_id,))
+
+    async def drop_chat_data(self, chat_id):
+        self._digests.pop(('chat', chat_id), None)
+        self._validated.pop(('chat', chat_id), None)
+        await self._run("DELETE FROM chat_data WHERE chat_id = ?", (chat_id,))
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self._refresh(('user', user_id), "SELECT data FROM user_data WHERE user_id = ?", (user_id,), user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._refresh(('chat', chat_id), "SELECT data FROM chat_data WHERE chat_id = ?", (chat_id,), chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        await self._refresh(('bot',), "SELECT data FROM bot_data WHERE id = 0", (), bot_data)
+
+    async def get_job_user_data(self, job):
+        """What ``job`` stores about every user (``user_id -> data``), kept apart from the users' own rows."""
+        self._versions.pop(('job', job), None)
+        return await asyncio.to_thread(self._read_versioned, ('job', job), ('job', job),
+                                       "SELECT user_id, data, version FROM job_user_data WHERE job = ? AND version >= ?",
+                                       (job,), False)
+
+    async def get_job_user_data_changes(self, job):
+        """Like ``get_user_data_changes`` for the rows of ``job``; the first call returns them all."""
+        return await asyncio.to_thread(self._read_versioned, ('job', job), ('job', job),
+                                       "SELECT user_id, data, version FROM job_user_data WHERE job = ? AND version >= ?",
+                                       (job,), True)
+
+    async def update_job_user_data(self, job, user_id, data):
+        await self._write(('job', job, user_id), "INSERT OR REPLACE INTO job_user_data VALUES "
+                          "(?1, ?2, ?3, (SELECT COALESCE(MAX(version), 0) + 1 FROM job_user_data WHERE job = ?1))",
+                          (job, user_id), data)
+
+    async def get_job_data(self, job):
+        """Every row of ``job`` in ``job_data`` (``key -> data``)."""
+        self._versions.pop(('job_data', job), None)
+        return await asyncio.to_thread(self._read_versioned, ('job_data', job), ('job_data', job),
+                                       "SELECT key, data, version FROM job_data WHERE job = ? AND version >= ?",
+                                       (job,), False)
+
+    async def get_job_data_changes(self, job):
+        """Like ``get_user_data_changes`` for the rows of ``job`` in ``job_data``; the first call returns them all."""
+        return await asyncio.to_thread(self._read_versioned, ('job_data', job), ('job_data', job),
+                                       "SELECT key, data, version FROM job_data WHERE job = ? AND version >= ?",
+                                       (job,), True)
+
+    def _write_job_data(self, job, items):
+        rows = []
+        for key, data in items.items():
+            blob = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+            digest = hashlib.blake2b(blob, digest_size=16).digest()
+            if self._digests.get(('job_data', job, key)) != digest:
+                rows.append((key, blob, digest))
+        if not rows:
+            return
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute("BEGIN IMMEDIATE")
+                version = connection.execute("SELECT COALESCE(MAX(version), 0) + 1 FROM job_data WHERE job = ?",
+                                             (job,)).fetchone()[0]
+                connection.executemany("INSERT OR REPLACE INTO job_data VALUES (?, ?, ?, ?)",
+                                       [(job, key, blob, version) for key, blob, _ in rows])
+        for key, _, digest in rows:
+            self._digests[('job_data', job, key)] = digest
+
+    async def update_job_data(self, job, items):
+        """Writes ``items`` (``key -> data``) in one transaction, skipping the unchanged ones.
+
+        Pickling happens off the event loop, so large values do not block it.
+        """
+        await asyncio.to_thread(self._write_job_data, job, items)
+
+    def _drop_job_data(self, job, keys):
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute("BEGIN")
+                connection.executemany("DELETE FROM job_data WHERE job = ? AND key = ?", [(job, key) for key in keys])
+
+    async def drop_job_data(self, job, keys):
+        for key in keys:
+            self._digests.pop(('job_data', job, key), None)
+        await asyncio.to_thread(self._drop_job_data, job, list(keys))
+
+    async def acquire_lease(self, name, owner, ttl):
+        """Takes or renews the lease ``name`` for ``ttl`` seconds.
+
+        :return: ``False`` if another owner holds it and it has not expired
+        """
+        now = time.time()
+        rows = await self._run(
+            "INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, "
+            "expires = excluded.expires WHERE leases.owner = excluded.owner OR leases.expires <= ? RETURNING owner",
+            (name, owner, now + ttl, now))
+        return bool(rows)
+
+    async def release_lease(self, name, owner):
+        await self._run("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    async def flush(self):
+        if self._connection is not None:
+            with self._lock:
+                self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                self._connection.close()
+            self._connection = None
@@ -0,0 +1,176 @@
+"""Rate limiter for requests to the Telegram Bot API.
+
+Plugged into python-telegram-bot through ``ApplicationBuilder.rate_limiter``.
+Every request takes a token from a per-chat bucket and from a global bucket;
+when the global bucket is exhausted, waiting requests are served by priority
+so replies to users go before notification bursts.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import OrderedDict
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+#: Values for the ``rate_limit_args`` argument of the bot methods
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+REQUESTS = REGISTRY.counter('telegram_requests_total', "Bot API requests by method and priority",
+                            ('endpoint', 'priority'))
+RETRY_AFTER = REGISTRY.counter('telegram_retry_after_total', "Flood limit (HTTP 429) answers", ('endpoint',))
+WAIT_SECONDS = REGISTRY.histogram('telegram_rate_limit_wait_seconds', "Time requests wait for the rate limiter",
+                                  ('priority',))
+
+
+class TokenBucket:
+    """Classic token bucket refilled at ``rate`` tokens per second up to ``capacity``."""
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._clock = clock
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self, amount=1):
+        """Takes ``amount`` tokens if available. Returns 0, or the seconds to wait before retrying."""
+        amount = min(amount, self.capacity)
+        self._refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0
+        return (amount - self.tokens) / self.rate
+
+    def pause(self, seconds):
+        """Empties the bucket so no token is available for ``seconds``."""
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    @property
+    def idle(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class PriorityBucket:
+    """Hands out tokens of a ``TokenBucket`` to waiters in priority order (lower first)."""
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self._waiters = []
+        self._counter = itertools.count()
+        self._dispatcher = None
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    async def acquire(self, priority=PRIORITY_INTERACTIVE, amount=1):
+        if not self._waiters and not self.bucket.take(amount):
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), amount, future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    async def _dispatch(self):
+        while self._waiters:
+            _, _, amount, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            wait = self.bucket.take(amount)
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+            heapq.heappop(self._waiters)
+            future.set_result(None)
+
+
+class TelegramRateLimiter(BaseRateLimiter):
+    """Global and per-chat token buckets with priority lanes and ``RetryAfter`` handling.
+
+    Telegram allows about 30 messages per second overall, one per second in a
+    private chat and 20 per minute in a group. A media group counts as one
+    message per item. On a ``RetryAfter`` (HTTP 429) all requests are held back
+    for the time Telegram asks and the request is retried up to ``max_retries``
+    times.
+
+    Pass ``rate_limit_args=PRIORITY_BULK`` to the bot methods for traffic that
+    can wait, such as notifications.
+    """
+
+    def __init__(self, overall_rate=30, private_rate=1, private_burst=3, group_rate=20 / 60, group_burst=5,
+                 max_retries=3, max_idle_chats=10000):
+        self.overall = PriorityBucket(TokenBucket(overall_rate, overall_rate))
+        self.private_rate = private_rate
+        self.private_burst = private_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.max_idle_chats = max_idle_chats
+        self.retries = 0
+        self._chats = OrderedDict()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        self._chats.clear()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if isinstance(chat_id, str) or chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.private_rate, self.private_burst)
+            self._chats[chat_id] = bucket
+            if len(self._chats) > self.max_idle_chats:
+                # Full buckets carry no state worth keeping
+                for idle_chat in [c for c, b in self._chats.items() if b.idle and c != chat_id]:
+                    del self._chats[idle_chat]
+        self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = rate_limit_args if rate_limit_args is not None else PRIORITY_INTERACTIVE
+        chat_id = data.get('chat_id')
+        if isinstance(chat_id, str) and chat_id.lstrip('-').isdigit():
+            chat_id = int(chat_id)
+        amount = len(data.get('media') or ()) if endpoint == 'sendMediaGroup' else 1
+
+        for attempt in range(self.max_retries + 1):
+            if chat_id is not None:
+                with WAIT_SECONDS.time(priority=priority):
+                    bucket = self._chat_bucket(chat_id)
+                    wait = bucket.take(amount)
+                    while wait:
+                        await asyncio.sleep(wait)
+                        wait = bucket.take(amount)
+                    await self.overall.acquire(priority, amount)
+            REQUESTS.inc(endpoint=endpoint, priority=priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                RETRY_AFTER.inc(endpoint=endpoint)
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                logger.warning("Telegram flood limit on %s, retrying in %s seconds", endpoint, e.retry_after)
+                self.overall.bucket.pause(e.retry_after)
+                await asyncio.sleep(e.retry_after)
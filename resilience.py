@@ -0,0 +1,100 @@
+"""Circuit breaker and retry backoff for calls to an unreliable upstream.
+
+``TicketmasterClient`` combines them with a shared ``rate_limiter.TokenBucket``
+sized to the Discovery API quota: requests wait for a token, failed requests
+are retried after a jittered delay and, once the API keeps failing, the
+breaker rejects calls immediately so handlers answer from the cache or the
+local index instead of waiting for timeouts.
+"""
+import logging
+import random
+import time
+
+from ticketpy.client import ApiException
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+#: Value of the state gauge for every state
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+STATE = REGISTRY.gauge('circuit_breaker_state', "Circuit breaker state (0 closed, 1 half-open, 2 open)", ('name',))
+TRANSITIONS = REGISTRY.counter('circuit_breaker_transitions_total', "Circuit breaker state changes", ('name', 'state'))
+REJECTED = REGISTRY.counter('circuit_breaker_rejected_total', "Calls rejected while the breaker was open", ('name',))
+
+
+class CircuitOpenError(ApiException):
+    """Raised instead of calling the upstream while the breaker is open."""
+
+
+def backoff(attempt, base=0.2, cap=5.0, rng=random.random):
+    """Seconds to wait before retry number ``attempt`` (from 0): full jitter over ``min(cap, base * 2**attempt)``."""
+    return rng() * min(cap, base * 2 ** attempt)
+
+
+class CircuitBreaker:
+    """Stops calling an upstream that keeps failing.
+
+    After ``failure_threshold`` consecutive failures the breaker opens and
+    ``allow()`` returns False for ``reset_timeout`` seconds. Then a single trial
+    call is let through (half-open): its success closes the breaker, its failure
+    opens it again. A trial that never reports back is replaced by another one
+    after ``reset_timeout``.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self._clock = clock
+        self._opened_at = None
+        self._trial_started = None
+        STATE.set(STATE_VALUES[CLOSED], name=name)
+
+    def _set_state(self, state):
+        if state != self.state:
+            logger.warning("Circuit breaker %s: %s -> %s", self.name, self.state, state)
+            self.state = state
+            STATE.set(STATE_VALUES[state], name=self.name)
+            TRANSITIONS.inc(name=self.name, state=state)
+
+    def allow(self):
+        """Whether a call may go ahead now. Callers must then report ``record_success`` or ``record_failure``."""
+        if self.state == CLOSED:
+            return True
+        now = self._clock()
+        if self.state == OPEN:
+            if now - self._opened_at < self.reset_timeout:
+                REJECTED.inc(name=self.name)
+                return False
+            self._set_state(HALF_OPEN)
+        if self._trial_started is not None and now - self._trial_started < self.reset_timeout:
+            REJECTED.inc(name=self.name)
+            return False
+        self._trial_started = now
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self._trial_started = None
+        self._set_state(CLOSED)
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_started = None
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self._opened_at = self._clock()
+            self._set_state(OPEN)
+
+    def retry_in(self):
+        """Seconds until the breaker lets a trial call through, 0 if it is not open."""
+        if self.state != OPEN:
+            return 0
+        return max(0.0, self._opened_at + self.reset_timeout - self._clock())
+
+    def stats(self):
+        return {'state': self.state, 'failures': self.failures, 'retry_in': self.retry_in()}
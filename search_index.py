@@ -0,0 +1,275 @@
+"""Local index of the attractions and events seen in Ticketmaster results.
+
+Every search result page and event fetched by ``TicketmasterClient`` is
+stored in a small SQLite file, together with an FTS5 trigram index over the
+normalized names. Names starting with the query come from a B-tree index and
+names containing it from the FTS5 index, in a few milliseconds even with
+hundreds of thousands of items, which is fast enough for search-as-you-type;
+only when those find too little are names sharing its trigrams ranked, to
+tolerate typos. The index keeps searches answering while the Discovery API is
+slow, rate-limited or down. Results are written by a background thread
+(``add_later``) and lookups use their own connection, so neither searches nor
+lookups wait for the disk writes.
+"""
+import asyncio
+import json
+import logging
+import queue
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import zlib
+
+from ticketpy.model import Attraction, Event
+
+logger = logging.getLogger(__name__)
+
+MODELS = {'attractions': Attraction, 'events': Event}
+
+#: Share of the query trigrams a name must contain to be a match
+MIN_SIMILARITY = 0.3
+#: Batches waiting for the writer thread; beyond it new results are not indexed
+MAX_PENDING = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (rowid INTEGER PRIMARY KEY, kind TEXT NOT NULL, id TEXT NOT NULL,
+                                    name TEXT NOT NULL, norm TEXT NOT NULL, data BLOB NOT NULL, updated REAL NOT NULL,
+                                    UNIQUE (kind, id));
+CREATE INDEX IF NOT EXISTS entries_norm ON entries (kind, norm);
+CREATE INDEX IF NOT EXISTS entries_updated ON entries (updated);
+CREATE VIRTUAL TABLE IF NOT EXISTS names USING fts5(norm, tokenize='trigram');
+"""
+
+#: Index files written before the FTS5 index kept names in these tables
+MIGRATION = """
+BEGIN;
+INSERT OR IGNORE INTO entries (kind, id, name, norm, data, updated) SELECT kind, id, name, norm, data, updated FROM items;
+INSERT INTO names (rowid, norm) SELECT rowid, norm FROM entries;
+DROP TABLE items;
+DROP TABLE grams;
+COMMIT;
+"""
+
+
+def normalize(text):
+    """Lower case, no accents, words separated by single spaces."""
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    without_accents = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(re.split(r'\W+', without_accents.casefold())).strip()
+
+
+def trigrams(norm):
+    """Trigrams of every word, padded like PostgreSQL's pg_trgm (``"  word "``)."""
+    grams = set()
+    for word in norm.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def _fts_phrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _pieces(word):
+    """Overlapping 4-letter pieces of a word (the word itself if shorter): a typo spoils few of them, and
+    they match far fewer names than single trigrams, so ranking the names sharing them stays cheap."""
+    return {word[i:i + 4] for i in range(max(1, len(word) - 3))}
+
+
+class SearchIndex:
+    """Attractions and events by id and by (fuzzy) name.
+
+    :param filepath: SQLite file, created on first use
+    :param max_items: Items kept per kind; the least recently refreshed ones are dropped beyond it
+    """
+
+    def __init__(self, filepath, max_items=200000):
+        self.filepath = filepath
+        self.max_items = max_items
+        self._connection = None
+        self._lock = threading.Lock()
+        self._reader = None
+        self._read_lock = threading.Lock()
+        self._writes = 0
+        self._pending = queue.Queue(MAX_PENDING)
+        self._writer = None
+        self.dropped = 0
+
+    def _connect(self):
+        if self._connection is None:
+            connection = sqlite3.connect(self.filepath, check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            if connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'grams'").fetchone():
+                connection.executescript(MIGRATION)
+            self._connection = connection
+        return self._connection
+
+    def _read_connection(self):
+        """Connection for lookups: in WAL mode they read while the writer thread writes."""
+        if self._reader is None:
+            with self._lock:
+                self._connect()
+            self._reader = sqlite3.connect(self.filepath, check_same_thread=False, isolation_level=None)
+        return self._reader
+
+    def add_sync(self, kind, items, now=None):
+        """Stores or refreshes ``ticketpy.model`` objects of ``kind`` (*attractions* or *events*)."""
+        now = time.time() if now is None else now
+        rows = [(kind, item.id, item.name, normalize(item.name), zlib.compress(json.dumps(item.json).encode()), now)
+                for item in items if item.id and item.name]
+        if not rows:
+            return
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN")
+            try:
+                for row in rows:
+                    previous = connection.execute("SELECT rowid, norm FROM entries WHERE kind = ? AND id = ?",
+                                                  row[:2]).fetchone()
+                    if previous is None:
+                        rowid = connection.execute("INSERT INTO entries (kind, id, name, norm, data, updated) "
+                                                   "VALUES (?, ?, ?, ?, ?, ?)", row).lastrowid
+                        connection.execute("INSERT INTO names (rowid, norm) VALUES (?, ?)", (rowid, row[3]))
+                        continue
+                    rowid, norm = previous
+                    connection.execute("UPDATE entries SET name = ?, norm = ?, data = ?, updated = ? WHERE rowid = ?",
+                                       (*row[2:], rowid))
+                    if norm != row[3]:
+                        connection.execute("UPDATE names SET norm = ? WHERE rowid = ?", (row[3], rowid))
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            self._writes += len(rows)
+            if self._writes >= 1000:
+                self._writes = 0
+                self._evict(connection, kind)
+
+    def _evict(self, connection, kind):
+        (count,) = connection.execute("SELECT COUNT(*) FROM entries WHERE kind = ?", (kind,)).fetchone()
+        if count <= self.max_items:
+            return
+        stale = connection.execute("SELECT rowid FROM entries WHERE kind = ? ORDER BY updated LIMIT ?",
+                                   (kind, count - self.max_items)).fetchall()
+        connection.execute("BEGIN")
+        connection.executemany("DELETE FROM entries WHERE rowid = ?", stale)
+        connection.executemany("DELETE FROM names WHERE rowid = ?", stale)
+        connection.execute("COMMIT")
+
+    def _load(self, kind, blob):
+        return MODELS[kind].from_json(json.loads(zlib.decompress(blob)))
+
+    def get_sync(self, kind, item_id):
+        with self._read_lock:
+            row = self._read_connection().execute("SELECT data FROM entries WHERE kind = ? AND id = ?",
+                                                  (kind, item_id)).fetchone()
+        return self._load(kind, row[0]) if row else None
+
+    def search_sync(self, kind, query, limit=20):
+        """Best matches for ``query``: names starting with it first, then words starting with it, then similar names."""
+        norm = normalize(query)
+        if not norm:
+            return []
+        grams = trigrams(norm)
+        # CROSS JOIN keeps the FTS5 lookup first; otherwise SQLite may scan every entry of the kind and match each one
+        matching = "SELECT e.id, e.name, e.norm, e.data FROM names CROSS JOIN entries e ON e.rowid = names.rowid " \
+                   "WHERE names MATCH ? AND e.kind = ?"
+        with self._read_lock:
+            connection = self._read_connection()
+            # Names starting with the query come straight from the index on norm
+            rows = connection.execute(
+                "SELECT id, name, norm, data FROM entries WHERE kind = ? AND norm >= ? AND norm < ? LIMIT ?",
+                (kind, norm, norm + '\uffff', limit)).fetchall()
+            if len(norm) >= 3:
+                rows += connection.execute(f"{matching} LIMIT ?", (_fts_phrase(norm), kind, limit * 10)).fetchall()
+                pieces = {piece for word in norm.split() if len(word) >= 3 for piece in _pieces(word)}
+                if len({row[0] for row in rows}) < limit and pieces:
+                    # Too few names contain the query: the best ranked ones sharing pieces of it may be typos of it
+                    rows += connection.execute(f"{matching} ORDER BY rank LIMIT ?",
+                                               (' OR '.join(map(_fts_phrase, pieces)), kind,
+                                                max(limit * 10, 100))).fetchall()
+
+        ranked = {}
+        for item_id, name, item_norm, data in rows:
+            shared = len(grams & trigrams(item_norm))
+            if item_norm.startswith(norm):
+                rank = 0
+            elif (' ' + item_norm).find(' ' + norm) >= 0:
+                rank = 1
+            elif shared / len(grams) >= MIN_SIMILARITY:
+                rank = 2
+            else:
+                continue
+            key = (rank, -shared / len(grams), len(name), name)
+            if item_id not in ranked or key < ranked[item_id][0]:
+                ranked[item_id] = (key, data)
+        best = sorted(ranked.values(), key=lambda entry: entry[0])[:limit]
+        return [self._load(kind, data) for _, data in best]
+
+    def add_later(self, kind, items):
+        """Queues items for the writer thread and returns at once. Best effort: dropped if the queue is full."""
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_pending, name='search-index-writer', daemon=True)
+                self._writer.start()
+        try:
+            self._pending.put_nowait((kind, list(items)))
+        except queue.Full:
+            self.dropped += 1
+            logger.warning("Search index writer is behind, %s results not indexed", kind)
+
+    def _write_pending(self):
+        while True:
+            batches = [self._pending.get()]
+            # Whatever queued up meanwhile goes in the same transactions
+            while True:
+                try:
+                    batches.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batches
+            by_kind = {}
+            for batch in batches:
+                if batch is not None:
+                    kind, items = batch
+                    by_kind.setdefault(kind, {}).update((item.id, item) for item in items)
+            for kind, items in by_kind.items():
+                try:
+                    self.add_sync(kind, items.values())
+                except sqlite3.Error:
+                    logger.exception("Could not index %s", kind)
+            for _ in batches:
+                self._pending.task_done()
+            if stop:
+                return
+
+    def flush(self):
+        """Waits until every queued result has been written."""
+        self._pending.join()
+
+    async def get(self, kind, item_id):
+        return await asyncio.to_thread(self.get_sync, kind, item_id)
+
+    async def search(self, kind, query, limit=20):
+        return await asyncio.to_thread(self.search_sync, kind, query, limit)
+
+    def close(self):
+        """Writes the queued results, stops the writer thread and closes the database."""
+        with self._lock:
+            writer, self._writer = self._writer, None
+        if writer is not None:
+            self._pending.put(None)
+            writer.join()
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+        with self._read_lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
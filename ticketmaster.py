@@ -0,0 +1,452 @@
+"""Async access layer for the Ticketmaster Discovery API.
+
+ticketpy only offers a blocking client built on ``requests``; calling it from
+the bot handlers stalls the whole python-telegram-bot event loop. This module
+talks to the same endpoints through a pooled ``httpx.AsyncClient`` and returns
+the usual ``ticketpy.model`` objects, so the handlers keep working with
+``Event``/``Attraction`` instances as before.
+"""
+import asyncio
+import logging
+import time
+import weakref
+from collections import OrderedDict
+
+import httpx
+import ticketpy
+from ticketpy.client import ApiException
+from ticketpy.model import Event, Page
+from ticketpy.query import BaseQuery
+
+from metrics import REGISTRY
+from rate_limiter import PRIORITY_INTERACTIVE, PriorityBucket, TokenBucket
+from resilience import CircuitBreaker, CircuitOpenError, backoff
+
+logger = logging.getLogger(__name__)
+
+SOURCES = ["ticketmaster", "frontgate", "tmr"]
+
+#: Seconds a cached response stays valid, per endpoint
+CACHE_TTLS = {
+    'attractions': 60 * 60,
+    'events': 10 * 60,
+    'event': 10 * 60,
+}
+
+#: Free-text parameters; identifiers such as ``id`` or ``attractionId`` are case-sensitive
+TEXT_PARAMS = frozenset({'keyword'})
+
+#: The Discovery API rejects requests where ``page * size`` reaches this value
+MAX_DEEP_PAGING = 1000
+
+REQUESTS = REGISTRY.counter('ticketmaster_requests_total', "Discovery API requests by endpoint and HTTP status "
+                            "(error: no response)", ('endpoint', 'outcome'))
+REQUEST_SECONDS = REGISTRY.histogram('ticketmaster_request_seconds', "Discovery API response time", ('endpoint',))
+CACHE_LOOKUPS = REGISTRY.counter('ticketmaster_cache_lookups_total', "Response cache lookups", ('endpoint', 'result'))
+RETRIES = REGISTRY.counter('ticketmaster_retries_total', "Requests repeated after a failed attempt",
+                           ('endpoint', 'reason'))
+QUOTA_WAIT_SECONDS = REGISTRY.histogram('ticketmaster_quota_wait_seconds', "Time requests wait for the shared "
+                                        "request quota", ('priority',))
+QUOTA_AVAILABLE = REGISTRY.gauge('ticketmaster_quota_available', "Requests left in the daily API quota, as reported "
+                                 "by Ticketmaster")
+INDEX_FALLBACKS = REGISTRY.counter('ticketmaster_index_fallbacks_total', "Requests answered from the local search "
+                                   "index instead of the API (reason: error or slow)", ('endpoint', 'reason'))
+
+
+class _Retry(Exception):
+    """A failed attempt worth repeating; ``error`` is raised if no retries are left."""
+
+    def __init__(self, error, reason, wait=0.0):
+        super().__init__(error)
+        self.error = error
+        self.reason = reason
+        self.wait = wait
+
+
+def endpoint_name(path):
+    """Metric label for a request path: ``/events.json`` is *events*, ``/events/<id>.json`` is *event*."""
+    parts = path.strip('/').split('/')
+    return parts[0][:-1] if len(parts) > 1 else parts[0].removesuffix('.json')
+
+
+def next_page_number(page_number, page):
+    """Number of the page that follows ``page`` (page ``page_number`` of a search), or None if it was the last."""
+    page_number += 1
+    if page_number >= (page.total_pages or 0) or page_number * (page.size or 0) >= MAX_DEEP_PAGING:
+        return None
+    return page_number
+
+
+class ResponseCache:
+    """Bounded in-process cache for API responses.
+
+    Entries are keyed by ``(endpoint, normalized params)``, where only the
+    free-text ``TEXT_PARAMS`` ignore case and spacing, and they expire after the
+    TTL configured for their endpoint and the least recently used entry is
+    evicted once ``maxsize`` is reached. Concurrent lookups of the same key
+    share a single upstream request. Expired entries are kept for another
+    ``stale_ttl`` seconds and returned when refreshing them fails.
+    """
+
+    def __init__(self, maxsize=1024, ttls=None, default_ttl=5 * 60, clock=time.monotonic, stale_ttl=24 * 60 * 60):
+        self.maxsize = maxsize
+        self.ttls = dict(CACHE_TTLS if ttls is None else ttls)
+        self.default_ttl = default_ttl
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._inflight = {}
+
+    @staticmethod
+    def _normalize(value, text=False):
+        if isinstance(value, str):
+            return ' '.join(value.split()).casefold() if text else value
+        if isinstance(value, (list, tuple, set)):
+            return tuple(sorted(ResponseCache._normalize(v, text) for v in value))
+        return value
+
+    @classmethod
+    def make_key(cls, endpoint, params):
+        return endpoint, tuple(sorted((k, cls._normalize(v, k in TEXT_PARAMS))
+                                      for k, v in params.items() if v is not None))
+
+    def get(self, key):
+        """Returns ``(True, value)`` for a fresh entry, ``(False, None)`` otherwise."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        expires, value = entry
+        now = self._clock()
+        if expires <= now:
+            if expires + self.stale_ttl <= now:
+                del self._entries[key]
+            return False, None
+        self._entries.move_to_end(key)
+        return True, value
+
+    def get_stale(self, key):
+        """Like ``get``, but also returns entries that expired less than ``stale_ttl`` seconds ago."""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] + self.stale_ttl <= self._clock():
+            return False, None
+        return True, entry[1]
+
+    def set(self, key, value):
+        ttl = self.ttls.get(key[0], self.default_ttl)
+        self._entries[key] = (self._clock() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    async def get_or_fetch(self, endpoint, params, fetch):
+        """Returns the cached value for the request or awaits ``fetch()`` once to fill it."""
+        key = self.make_key(endpoint, params)
+        found, value = self.get(key)
+        if found:
+            self.hits += 1
+            CACHE_LOOKUPS.inc(endpoint=endpoint, result='hit')
+            return value
+
+        loop = asyncio.get_running_loop()
+        pending = self._inflight.get(key)
+        if pending is not None and pending.get_loop() is loop:
+            self.hits += 1
+            CACHE_LOOKUPS.inc(endpoint=endpoint, result='shared')
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        CACHE_LOOKUPS.inc(endpoint=endpoint, result='miss')
+        future = loop.create_future()
+        self._inflight[key] = future
+        try:
+            value = await fetch()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            found, value = self.get_stale(key)
+            if found:
+                self.stale_hits += 1
+                CACHE_LOOKUPS.inc(endpoint=endpoint, result='stale')
+                logger.warning("Serving a stale %s response after %r", endpoint, e)
+                future.set_result(value)
+                return value
+            future.set_exception(e)
+            # Nobody else may be waiting; mark the exception as retrieved
+            future.exception()
+            raise
+        else:
+            self.set(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale_hits': self.stale_hits,
+            'size': len(self._entries),
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+    def clear(self):
+        self._entries.clear()
+
+
+class TicketmasterClient:
+    """Non-blocking replacement for ``ticketpy.ApiClient`` searches.
+
+    Connections are kept alive and reused between requests, at most
+    ``max_concurrency`` requests are in flight at once and every request is
+    bounded by ``timeout`` seconds. Network failures and non-200 responses are
+    raised as ``ticketpy.client.ApiException``. When a ``ResponseCache`` is
+    given, search results are served from it. ``base_url`` points the client at
+    another server implementing the Discovery API, such as a local fake, and
+    ``verify`` is passed to httpx (an ``ssl.SSLContext`` can be shared).
+
+    With a ``search_index.SearchIndex``, every result is also stored locally,
+    in the background.
+    Keyword searches and event lookups are then answered from the index when
+    the API fails or, if ``fallback_after`` is set, takes longer than that many
+    seconds; a slow request keeps running and refreshes the cache and the index
+    when it completes.
+
+    Requests take a token from a bucket refilled at ``requests_per_second``
+    (the Discovery API allows 5 per second), handed out by priority so
+    interactive searches go before ``PRIORITY_BULK`` traffic such as the daily
+    scan. Connection errors, 5xx and 429 answers are retried up to
+    ``max_retries`` times after a jittered backoff; timeouts are not, since a
+    slow API is not helped by more requests. Consecutive failures open the
+    circuit ``breaker``, which then fails requests at once with
+    ``resilience.CircuitOpenError`` (an ``ApiException``), and an exhausted
+    daily quota fails them until it resets. The cache answers those failures
+    with stale entries when it has them.
+    """
+
+    url = ticketpy.ApiClient.url
+
+    def __init__(self, api_key, max_connections=20, max_concurrency=10, timeout=10.0, transport=None, cache=None,
+                 base_url=None, index=None, fallback_after=None, requests_per_second=5, max_retries=2, breaker=None,
+                 verify=True):
+        self.api_key = api_key
+        self.base_url = base_url or self.url
+        self.cache = cache
+        self.index = index
+        self.fallback_after = fallback_after
+        self.max_retries = max_retries
+        self.breaker = breaker if breaker is not None else CircuitBreaker('ticketmaster')
+        # Shared by every loop and request; None disables the request quota
+        self.quota = TokenBucket(requests_per_second, requests_per_second) if requests_per_second else None
+        self.quota_available = None
+        self._quota_reset = 0.0
+        self.max_concurrency = max_concurrency
+        self._limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self._timeout = httpx.Timeout(timeout)
+        self._transport = transport
+        self._verify = verify
+        # httpx clients and semaphores are bound to the loop that created them
+        self._per_loop = weakref.WeakKeyDictionary()
+
+    def _session(self):
+        loop = asyncio.get_running_loop()
+        session = self._per_loop.get(loop)
+        if session is None or session[0].is_closed:
+            http = httpx.AsyncClient(base_url=self.base_url, limits=self._limits, timeout=self._timeout,
+                                     transport=self._transport, verify=self._verify)
+            session = (http, asyncio.Semaphore(self.max_concurrency),
+                       PriorityBucket(self.quota) if self.quota is not None else None)
+            self._per_loop[loop] = session
+        return session
+
+    async def _request(self, path, params, priority=PRIORITY_INTERACTIVE):
+        params = {k: v for k, v in params.items() if v is not None}
+        params['apikey'] = self.api_key
+        endpoint = endpoint_name(path)
+        attempt = 0
+        while True:
+            try:
+                return await self._attempt(path, params, endpoint, priority)
+            except _Retry as retry:
+                if attempt >= self.max_retries:
+                    raise retry.error from retry.__cause__
+                RETRIES.inc(endpoint=endpoint, reason=retry.reason)
+                await asyncio.sleep(retry.wait + backoff(attempt))
+                attempt += 1
+
+    async def _attempt(self, path, params, endpoint, priority):
+        if time.time() < self._quota_reset:
+            raise ApiException(429, "Daily quota exhausted", path)
+        if not self.breaker.allow():
+            raise CircuitOpenError(None, f"Circuit breaker open, next try in {self.breaker.retry_in():.0f}s", path)
+        http, semaphore, bucket = self._session()
+        if bucket is not None:
+            with QUOTA_WAIT_SECONDS.time(priority=priority):
+                await bucket.acquire(priority)
+        async with semaphore:
+            try:
+                with REQUEST_SECONDS.time(endpoint=endpoint):
+                    response = await http.get(path, params=params)
+            except httpx.HTTPError as e:
+                REQUESTS.inc(endpoint=endpoint, outcome='error')
+                self.breaker.record_failure()
+                logger.error("Ticketmaster request to %s failed: %r", path, e)
+                error = ApiException(None, repr(e), path)
+                if isinstance(e, httpx.TimeoutException):
+                    raise error from e
+                raise _Retry(error, 'error') from e
+        REQUESTS.inc(endpoint=endpoint, outcome=str(response.status_code))
+        self._track_quota(response)
+        if response.status_code == 429:
+            # The API is up, only throttling us: hold every request back instead of opening the breaker
+            self.breaker.record_success()
+            try:
+                wait = float(response.headers.get('Retry-After', 1))
+            except ValueError:
+                wait = 1.0
+            if self.quota is not None:
+                self.quota.pause(wait)
+            logger.error("Ticketmaster returned 429 for %s", path)
+            error = ApiException(429, response.text, path)
+            if time.time() < self._quota_reset:
+                raise error
+            raise _Retry(error, 'throttled', wait)
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+            logger.error("Ticketmaster returned %s for %s", response.status_code, path)
+            raise _Retry(ApiException(response.status_code, response.text, path), 'server_error')
+        self.breaker.record_success()
+        if response.status_code != 200:
+            logger.error("Ticketmaster returned %s for %s", response.status_code, path)
+            raise ApiException(response.status_code, response.text, path)
+        return response.json()
+
+    def _track_quota(self, response):
+        """Reads the daily quota headers (``Rate-Limit-Available``, ``Rate-Limit-Reset`` in epoch ms)."""
+        try:
+            available = int(response.headers['Rate-Limit-Available'])
+            reset = int(response.headers.get('Rate-Limit-Reset', 0)) / 1000
+        except (KeyError, ValueError):
+            return
+        self.quota_available = available
+        QUOTA_AVAILABLE.set(available)
+        if available <= 0 and reset > time.time():
+            logger.error("Ticketmaster daily quota exhausted until %s", time.strftime('%H:%M:%S', time.localtime(reset)))
+            self._quota_reset = reset
+
+    def stats(self):
+        """Resilience state, for monitoring."""
+        return {
+            'breaker': self.breaker.stats(),
+            'quota_available': self.quota_available,
+            'quota_exhausted': time.time() < self._quota_reset,
+            'cache': self.cache.stats() if self.cache is not None else None,
+        }
+
+    @staticmethod
+    def _search_params(params):
+        """Maps ticketpy-style argument names (``attraction_id``...) to API names."""
+        return {BaseQuery.attr_map.get(k, k): v for k, v in params.items()}
+
+    async def page(self, method, page_number=0, priority=PRIORITY_INTERACTIVE, **params):
+        """Equivalent to ``tm_client.<method>.find(page=page_number, **params).one()``.
+
+        :param priority: Place in the request quota queue, ``rate_limiter.PRIORITY_BULK`` for background work
+        :return: A single ``ticketpy.model.Page`` of results
+        """
+        params = self._search_params(params)
+        if method == 'events':
+            params.setdefault('sort', 'date,asc')
+        params['page'] = page_number
+        fetch = lambda: self._page(method, params, priority)
+        request = fetch() if self.cache is None else self.cache.get_or_fetch(method, params, fetch)
+        if self.index is None or page_number or not params.get('keyword'):
+            return await request
+
+        async def local():
+            items = await self.index.search(method, params['keyword'], params.get('size') or 20)
+            if not items:
+                return None
+            page = Page(0, len(items), len(items), 1)
+            page += items
+            return page
+        return await self._or_local(request, method, local)
+
+    async def _page(self, method, params, priority=PRIORITY_INTERACTIVE):
+        page = Page.from_json(await self._request(f"/{method}.json", params, priority))
+        if method == 'events' and self.cache is not None:
+            # Search results already carry everything the detail view needs
+            for event in page:
+                self.cache.set(self.cache.make_key('event', {'id': event.id}), event)
+        if self.index is not None:
+            self.index.add_later(method, page)
+        return page
+
+    async def _or_local(self, request, endpoint, local):
+        """Awaits ``request``; on failure or after ``fallback_after`` seconds returns ``await local()`` if not None."""
+        task = asyncio.ensure_future(request)
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), self.fallback_after)
+        except (asyncio.TimeoutError, ApiException) as e:
+            result = await local()
+            if result is None:
+                if isinstance(e, ApiException):
+                    raise
+                return await task
+            reason = 'error' if isinstance(e, ApiException) else 'slow'
+            INDEX_FALLBACKS.inc(endpoint=endpoint, reason=reason)
+            logger.warning("Answering a Ticketmaster %s request from the local index (%s)", endpoint, reason)
+            # The request may still fail after the fallback; nobody is left to see it
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            return result
+
+    async def search_pages(self, method, start_page=0, priority=PRIORITY_INTERACTIVE, pace=None, **params):
+        """Yields result pages one at a time, requesting each only when needed.
+
+        :param pace: Optional ``rate_limiter.PriorityBucket`` charged one token before every page request
+        """
+        page_number = start_page
+        while page_number is not None:
+            if pace is not None:
+                await pace.acquire(priority)
+            page = await self.page(method, page_number, priority, **params)
+            yield page
+            page_number = next_page_number(page_number, page)
+
+    async def search(self, method, priority=PRIORITY_INTERACTIVE, pace=None, **params):
+        """Equivalent to ``tm_client.<method>.find(**params).all()``.
+
+        :param method: *events* or *attractions*
+        :param pace: See ``search_pages``
+        :return: Flat list of ``Event``/``Attraction`` from every page
+        """
+        items = []
+        async for page in self.search_pages(method, priority=priority, pace=pace, **params):
+            items += page
+        return items
+
+    async def event_by_id(self, event_id):
+        """Equivalent to ``tm_client.events.by_id(event_id)``."""
+        fetch = lambda: self._event_by_id(event_id)
+        request = fetch() if self.cache is None else self.cache.get_or_fetch('event', {'id': event_id}, fetch)
+        if self.index is None:
+            return await request
+        return await self._or_local(request, 'event', lambda: self.index.get('events', event_id))
+
+    async def _event_by_id(self, event_id):
+        event = Event.from_json(await self._request(f"/events/{event_id}.json", {}))
+        if self.index is not None:
+            self.index.add_later('events', [event])
+        return event
+
+    async def aclose(self):
+        """Closes the pooled connections opened from the running loop."""
+        session = self._per_loop.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session[0].aclose()
@@ -0,0 +1,185 @@
+"""Concurrent update processing that keeps each conversation in order.
+
+``ConversationHandler`` expects the updates of a conversation to be handled
+one at a time, which is why python-telegram-bot processes updates
+sequentially by default. ``OrderedUpdateProcessor`` handles up to
+``max_concurrent_updates`` updates at once, but never two updates of the same
+(chat, user) pair, the key ``ConversationHandler`` uses for its state.
+Updates without a chat, such as inline queries, belong to no conversation and
+are handled as they arrive, so a user's newer keystrokes never wait behind an
+older search. An update takes its turn in the conversation before a slot of the
+pool, so updates queued behind their own conversation never hold slots that
+other users' updates could use.
+
+``ShardedUpdateProcessor`` extends that ordering to several bot processes by
+sending each user's updates to the one process that owns the user.
+"""
+import asyncio
+import contextlib
+import logging
+import zlib
+
+import httpx
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+IN_PROGRESS = REGISTRY.gauge('bot_updates_in_progress', "Updates being handled")
+WAITING = REGISTRY.gauge('bot_updates_waiting', "Updates waiting for an earlier update of the same conversation")
+FORWARDED = REGISTRY.counter('bot_updates_forwarded_total', "Updates forwarded to the worker owning the user")
+FORWARD_FAILED = REGISTRY.counter('bot_updates_forward_failed_total',
+                                  "Updates dropped because the worker owning the user could not be reached")
+
+
+def conversation_key(update):
+    """Returns the ``(chat_id, user_id)`` an update belongs to, or ``None``."""
+    if not isinstance(update, Update):
+        return None
+    chat = update.effective_chat
+    user = update.effective_user
+    if chat is None and user is None:
+        return None
+    return (chat.id if chat else None, user.id if user else None)
+
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """Bounded worker pool with per-conversation ordering.
+
+    Updates of the same conversation wait for each other in arrival order;
+    updates of different conversations and updates without a chat run concurrently.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        # key -> [lock, number of updates holding or waiting for it]
+        self._locks = {}
+
+    @property
+    def active_conversations(self):
+        return len(self._locks)
+
+    @contextlib.asynccontextmanager
+    async def turn(self, update):
+        """Waits until the earlier updates of the update's conversation are done; immediate without a chat."""
+        key = conversation_key(update)
+        if key is None or key[0] is None:
+            yield
+            return
+
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        WAITING.inc()
+        waiting = True
+        try:
+            async with entry[0]:
+                WAITING.dec()
+                waiting = False
+                yield
+        finally:
+            if waiting:
+                WAITING.dec()
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def process_update(self, update, coroutine):
+        # Replaces BaseUpdateProcessor.process_update, which takes the pool semaphore before do_process_update
+        async with self.turn(update):
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+
+    async def do_process_update(self, update, coroutine):
+        IN_PROGRESS.inc()
+        try:
+            await coroutine
+        finally:
+            IN_PROGRESS.dec()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def shard_for(key, workers):
+    """Index of the worker that owns a conversation, stable across processes."""
+    owner_id = key[1] if key[1] is not None else key[0]
+    return zlib.crc32(str(owner_id).encode()) % workers
+
+
+class ShardedUpdateProcessor(OrderedUpdateProcessor):
+    """Update processor for one of several bot workers behind a load balancer.
+
+    Every user belongs to one worker (see ``shard_for``), which is the only one
+    handling that user's updates, so conversation state and ``user_data`` never
+    change in two processes at once. Updates reaching any other worker are
+    forwarded to the owner's webhook, one at a time per conversation so they
+    arrive in order. If the owner cannot be reached the forward is retried with
+    exponential backoff and, once ``retries`` are used up, the update is dropped
+    and logged: handling it here would break the single owner. Telegram has
+    already been answered by then, so it will not deliver the update again.
+
+    :param worker_index: Position of this worker in ``worker_urls``
+    :param worker_urls: Webhook URL of every worker, in the same order for all of them
+    :param secret_token: Webhook secret token, sent along with forwarded updates
+    :param retries: Forwarding attempts after the first one; the n-th waits ``retry_delay * 2 ** n`` seconds
+    """
+
+    def __init__(self, max_concurrent_updates, worker_index, worker_urls, secret_token=None, timeout=10.0,
+                 transport=None, retries=5, retry_delay=0.5):
+        super().__init__(max_concurrent_updates)
+        if not 0 <= worker_index < len(worker_urls):
+            raise ValueError(f"worker_index {worker_index} out of range for {len(worker_urls)} workers")
+        self.worker_index = worker_index
+        self.worker_urls = list(worker_urls)
+        self.forwarded = 0
+        self._headers = {'X-Telegram-Bot-Api-Secret-Token': secret_token} if secret_token else {}
+        self._timeout = timeout
+        self._transport = transport
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._http = None
+
+    def owner(self, update):
+        key = conversation_key(update)
+        return self.worker_index if key is None else shard_for(key, len(self.worker_urls))
+
+    async def process_update(self, update, coroutine):
+        owner = self.owner(update)
+        if owner == self.worker_index:
+            await super().process_update(update, coroutine)
+            return
+        coroutine.close()
+        # Forwarding waits for no pool slot, but keeps the conversation's order
+        async with self.turn(update):
+            await self._forward(update, owner)
+
+    async def _forward(self, update, owner):
+        for attempt in range(self._retries + 1):
+            if attempt:
+                await asyncio.sleep(self._retry_delay * 2 ** (attempt - 1))
+            try:
+                response = await self._http.post(self.worker_urls[owner], json=update.to_dict(), headers=self._headers)
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                logger.warning("Could not forward update %s to worker %s (attempt %s): %r",
+                               update.update_id, owner, attempt + 1, e)
+            else:
+                self.forwarded += 1
+                FORWARDED.inc()
+                return
+        FORWARD_FAILED.inc()
+        logger.error("Dropping update %s: worker %s is unreachable", update.update_id, owner)
+
+    async def initialize(self):
+        if self._http is None:
+            self._http = httpx.AsyncClient(timeout=self._timeout, transport=self._transport)
+
+    async def shutdown(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None